@@ -0,0 +1,82 @@
+##
+# Micro-benchmark: City serialization cost and memory per record
+#
+# Compares the original City (format a string, json.loads it, json.dumps the
+# dict again) with City.toDict() encoded by the standard library and by
+# jsoncodec, as bulkload.encodeDocument() does, and with a whole CityBatch
+# encoded by one jsoncodec call, as bulkload.iterBatches() does for one.
+#
+# Usage: python benchmarks/bench_city.py [records]
+##
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from bulkload import encodeDocument, iterBatches
+from city import City, CityBatch
+
+
+class LegacyCity:
+    def __init__(self, name, population, longitude, latitude, countryCode):
+        self.name = name
+        self.population = population
+        self.longitude = longitude
+        self.latitude = latitude
+        self.countryCode = countryCode
+    def toJSON(self):
+        return json.loads("{\"name\" : \"%s\" , \"population\" : %d , \"longitude\" : %.4f , \"latitude\" : %.4f , \"countryCode\" : %d}"
+                      %(self.name, self.population, self.longitude, self.latitude, self.countryCode))
+
+
+def rows(count):
+    for i in range(count):
+        yield ("City %d" % i, 100000 + i, (i % 36000) / 100.0 - 180.0, (i % 18000) / 100.0 - 90.0, i % 250)
+
+
+def perDocument(label, serialize, records):
+    start = time.perf_counter()
+    size = 0
+    for record in records:
+        size += len(serialize(record))
+    elapsed = time.perf_counter() - start
+    print("%-22s %8.2f us/doc  %d bytes" % (label, 1e6 * elapsed / len(records), size))
+
+
+def perBatch(label, documents):
+    start = time.perf_counter()
+    size = sum(len(body) for count, body in iterBatches(documents))
+    elapsed = time.perf_counter() - start
+    print("%-22s %8.2f us/doc  %d bytes" % (label, 1e6 * elapsed / len(documents), size))
+
+
+def memoryPerRecord(label, build, count):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    built = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    used = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    print("%-22s %8.1f bytes/record" % (label, float(used) / count))
+    return built
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    legacy = memoryPerRecord("LegacyCity", lambda: [LegacyCity(*row) for row in rows(count)], count)
+    cities = memoryPerRecord("City (__slots__)", lambda: [City(*row) for row in rows(count)], count)
+    batch = memoryPerRecord("CityBatch", lambda: CityBatch(City(*row) for row in rows(count)), count)
+
+    perDocument("LegacyCity.toJSON", lambda c: json.dumps(c.toJSON()).encode("utf-8"), legacy)
+    perDocument("City.toDict+dumps", lambda c: json.dumps(c.toDict()).encode("utf-8"), cities)
+    perDocument("encodeDocument", encodeDocument, cities)
+    perBatch("iterBatches(City)", cities)
+    perBatch("iterBatches(CityBatch)", batch)
+
+
+if __name__ == "__main__":
+    main()
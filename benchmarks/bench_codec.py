@@ -0,0 +1,54 @@
+##
+# Benchmark: JSON encode/decode cost of each codec backend on the sample's documents
+#
+# Usage: python benchmarks/bench_codec.py [repeat]
+# JSON_CODEC is ignored here; every installed backend is measured.
+##
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import jsoncodec
+from city import City
+
+CITY = City("Kansas City", 467007, 39.0997, 94.5783, 1).toDict()
+
+SHAPES = {
+    # 2.1: a single insert body
+    "city document": CITY,
+    # 2.2: a multiple insert body
+    "city batch x1000": [dict(CITY, name="City %d" % i, population=i) for i in range(1000)],
+    # 3.4: count command reply
+    "count reply": [{"count": 7, "ok": 1.0}],
+    # 3.7: join output, one row per city with its country
+    "join result x1000": [{"name": "City %d" % i, "population": i, "longitude": 39.0997, "latitude": 94.5783,
+                           "countryCode": 1, "countryName": "United States of America"} for i in range(1000)],
+}
+
+
+def timeit(func, arg, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(arg)
+    return 1e6 * (time.perf_counter() - start) / repeat
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for backendName, _ in jsoncodec.BACKENDS:
+        try:
+            name, dumps, loads = jsoncodec.loadBackend(backendName)
+        except ImportError:
+            print("%-8s not installed" % backendName)
+            continue
+        for shape, doc in SHAPES.items():
+            encoded = dumps(doc)
+            print("%-8s %-18s encode %9.1f us  decode %9.1f us  (%d bytes)" % (
+                name, shape, timeit(dumps, doc, repeat), timeit(loads, encoded, repeat), len(encoded)))
+
+
+if __name__ == "__main__":
+    main()
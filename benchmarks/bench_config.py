@@ -0,0 +1,84 @@
+##
+# Benchmark: cost of finding the database url per request, and of starting up
+#
+# Usage: python benchmarks/bench_config.py [repeat]
+# Compares parsing VCAP_SERVICES on every call, as getDatabaseUrl() used to,
+# with the resolver that parses it once, for a typical and a large
+# VCAP_SERVICES; then times a cold import of the application.
+##
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+import config
+
+SERVICE_NAME = "timeseriesdatabase"
+
+
+def vcapServices(instances, otherServices):
+    """
+    A VCAP_SERVICES value with instances of the listener's service, and other
+    bound services of about the same size
+    """
+    def instance(name, index):
+        return {"name": "%s-%d" % (name, index), "label": name, "plan": "standard", "tags": ["database"],
+                "credentials": {"username": "user%d" % index, "password": "x" * 32, "host": "10.0.0.%d" % index,
+                                "rest_url": "http://user:pw@10.0.0.%d:27018/db" % index,
+                                "rest_url_ssl": "https://user:pw@10.0.0.%d:27019/db" % index,
+                                "ssl_certificate": "A" * 2048}}
+    services = {SERVICE_NAME: [instance(SERVICE_NAME, i) for i in range(instances)]}
+    for i in range(otherServices):
+        services["service%d" % i] = [instance("service%d" % i, 0)]
+    return json.dumps(services)
+
+
+def parseEachCall(environ):
+    # getDatabaseUrl() before the resolver
+    vcap_services = json.loads(environ['VCAP_SERVICES'])
+    return vcap_services[SERVICE_NAME][0]['credentials']['rest_url']
+
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return 1e6 * (time.perf_counter() - start) / repeat
+
+
+def importTime(runs=5):
+    """
+    Seconds to import the application in a fresh interpreter, best of runs
+    """
+    code = ("import time; start = time.perf_counter(); import python_rest_HelloGalaxy; "
+            "print(time.perf_counter() - start)")
+    best = None
+    for _ in range(runs):
+        seconds = float(subprocess.check_output([sys.executable, "-c", code], cwd=SRC).decode().strip())
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for label, instances, others in (("1 instance", 1, 2), ("4 instances, 40 services", 4, 40)):
+        environ = {"VCAP_SERVICES": vcapServices(instances, others)}
+        os.environ["VCAP_SERVICES"] = environ["VCAP_SERVICES"]
+        config.reload()
+        start = time.perf_counter()
+        config.getResolver("", SERVICE_NAME, False).url()
+        first = 1e6 * (time.perf_counter() - start)
+        print("%-26s parse each call %8.1f us  resolver %6.2f us  (first call %.1f us, %d bytes)" % (
+            label, timeit(lambda: parseEachCall(environ), repeat),
+            timeit(lambda: config.getResolver("", SERVICE_NAME, False).url(), repeat),
+            first, len(environ["VCAP_SERVICES"])))
+    print("cold import of the application: %.1f ms" % (1e3 * importTime()))
+
+
+if __name__ == "__main__":
+    main()
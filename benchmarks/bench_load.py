@@ -0,0 +1,164 @@
+##
+# Load benchmark: drive doEverything() and /databasetest at several concurrency levels
+#
+# Runs against a local FakeListener unless --url is given, and reports p50/p95/p99
+# latency, throughput and peak memory per concurrency level. Results are written
+# as JSON so runs on different commits can be compared:
+#
+#   python benchmarks/bench_load.py --output before.json
+#   python benchmarks/bench_load.py --output after.json --compare before.json
+##
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from fakelistener import FakeListener
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def peakMemoryKb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runTarget(galaxy, target):
+    """
+    :returns: (callable running one sample run)
+    """
+    if target == "doEverything":
+        return galaxy.doEverything
+    testClient = galaxy.app.test_client()
+    def request():
+        reply = testClient.get("/databasetest")
+        if reply.status_code != 200 or b"EXCEPTION" in reply.data:
+            raise RuntimeError("/databasetest failed")
+    return request
+
+
+def runLevel(run, concurrency, runs):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def one(_):
+        start = time.perf_counter()
+        try:
+            run()
+        except Exception:
+            with lock:
+                errors[0] += 1
+            return
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(runs)))
+    wall = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "runs": runs,
+        "errors": errors[0],
+        "p50Ms": 1000 * percentile(latencies, 0.50),
+        "p95Ms": 1000 * percentile(latencies, 0.95),
+        "p99Ms": 1000 * percentile(latencies, 0.99),
+        "throughputPerSec": len(latencies) / wall if wall else 0.0,
+        "peakRssKb": peakMemoryKb(),
+    }
+
+
+def compare(results, baseline):
+    previous = dict(((r["target"], r["concurrency"]), r) for r in baseline["results"])
+    print("\nChange against %s:" % (baseline.get("commit") or "baseline"))
+    for result in results:
+        old = previous.get((result["target"], result["concurrency"]))
+        if old is None:
+            continue
+        print("%-13s c=%-3d p50 %+6.1f%%  p99 %+6.1f%%  throughput %+6.1f%%" % (
+            result["target"], result["concurrency"],
+            100.0 * (result["p50Ms"] - old["p50Ms"]) / old["p50Ms"] if old["p50Ms"] else 0.0,
+            100.0 * (result["p99Ms"] - old["p99Ms"]) / old["p99Ms"] if old["p99Ms"] else 0.0,
+            100.0 * (result["throughputPerSec"] - old["throughputPerSec"]) / old["throughputPerSec"]
+            if old["throughputPerSec"] else 0.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark for the sample against a listener")
+    parser.add_argument("--url", help="listener url including the database; default: a local FakeListener")
+    parser.add_argument("--latency", type=float, default=0.002, help="FakeListener seconds per reply")
+    parser.add_argument("--jitter", type=float, default=0.0, help="FakeListener random extra seconds")
+    parser.add_argument("--seed", type=int, default=0, help="FakeListener documents per new collection")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated concurrency levels")
+    parser.add_argument("--runs", type=int, default=20, help="runs per concurrency level")
+    parser.add_argument("--target", choices=("doEverything", "databasetest", "both"), default="both")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    options = parser.parse_args()
+
+    import python_rest_HelloGalaxy as galaxy
+    listener = None
+    if options.url:
+        galaxy.URL = options.url
+    else:
+        listener = FakeListener(latency=options.latency, jitter=options.jitter, seed=options.seed).start()
+        galaxy.URL = listener.url()
+
+    targets = ("doEverything", "databasetest") if options.target == "both" else (options.target,)
+    results = []
+    for target in targets:
+        run = runTarget(galaxy, target)
+        for concurrency in [int(level) for level in options.concurrency.split(",")]:
+            # Concurrent runs share collection names, as concurrent /databasetest requests do
+            result = runLevel(run, concurrency, options.runs)
+            result["target"] = target
+            results.append(result)
+            print("%-13s c=%-3d runs=%-4d errors=%-3d p50=%7.1fms p95=%7.1fms p99=%7.1fms %7.1f runs/s  peak %d KB" % (
+                target, concurrency, result["runs"], result["errors"], result["p50Ms"], result["p95Ms"],
+                result["p99Ms"], result["throughputPerSec"], result["peakRssKb"]))
+
+    report = {
+        "commit": gitCommit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "listener": options.url or {"latency": options.latency, "jitter": options.jitter, "seed": options.seed},
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.load(f))
+    if listener is not None:
+        listener.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+##
+# Benchmark: pooled keep-alive client vs. a new connection per listener call
+#
+# Usage: python benchmarks/bench_pool.py [runs]
+# The listener url is taken from HELLOGALAXY_URL; without it a local FakeListener is used.
+##
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import python_rest_HelloGalaxy as galaxy
+from fakelistener import FakeListener
+from restclient import RestClient
+
+
+def timeRuns(client, runs):
+    galaxy.client = client
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        galaxy.doEverything()
+        timings.append(time.perf_counter() - start)
+    client.close()
+    return timings
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    print("%-10s runs=%d  mean=%.1fms  min=%.1fms  max=%.1fms" % (
+        label, len(timings), 1000 * sum(timings) / len(timings), 1000 * timings[0], 1000 * timings[-1]))
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    if os.getenv("HELLOGALAXY_URL"):
+        galaxy.URL = os.environ["HELLOGALAXY_URL"]
+    else:
+        galaxy.URL = FakeListener(latency=0.001).start().url()
+    report("unpooled", timeRuns(RestClient(poolSize=1, keepAlive=False, retries=0), runs))
+    report("pooled", timeRuns(RestClient(poolSize=galaxy.POOL_SIZE), runs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+##
+# Local stand-in for the Informix REST listener
+#
+# Implements the endpoints used by the sample, in memory, with configurable
+# artificial latency and seeded data sizes:
+#   GET/POST /<db>                          catalog / create collection
+#   GET/POST/PUT/DELETE /<db>/<name>        find (query, sort, fields, batchsize) / insert / update / delete or drop
+#   GET /<db>/$cmd                          create, count, distinct, transaction (with execute), collstats, dbstats
+#   GET /<db>/system.join                   $collections / $project / $condition joins
+#   GET /<db>/system.sql                    accepted and acknowledged, no SQL is run
+#
+# Usage: python benchmarks/fakelistener.py [--port 27018] [--latency 0.005] [--seed 1000]
+##
+
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+SESSION_COOKIE = "informixRestListener.sessionId"
+CURSOR_COOKIE = "cursorId"
+
+_OPERATORS = {
+    "$gt": lambda value, arg: value is not None and value > arg,
+    "$gte": lambda value, arg: value is not None and value >= arg,
+    "$lt": lambda value, arg: value is not None and value < arg,
+    "$lte": lambda value, arg: value is not None and value <= arg,
+    "$eq": lambda value, arg: value == arg,
+    "$ne": lambda value, arg: value != arg,
+    "$in": lambda value, arg: value in arg,
+    "$nin": lambda value, arg: value not in arg,
+}
+
+
+def matches(doc, query):
+    for field, condition in (query or {}).items():
+        value = doc.get(field)
+        if isinstance(condition, dict) and condition and all(key in _OPERATORS for key in condition):
+            if not all(_OPERATORS[op](value, arg) for op, arg in condition.items()):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def project(doc, fields):
+    if not fields:
+        return dict(doc)
+    include = [field for field, flag in fields.items() if flag and field != "_id"]
+    if include:
+        result = dict((field, doc[field]) for field in include if field in doc)
+        if fields.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+    return dict((field, value) for field, value in doc.items() if fields.get(field, 1))
+
+
+def seedDocument(i):
+    return {"name": "Seed City %d" % i, "population": 10000 + i, "longitude": (i % 36000) / 100.0 - 180.0,
+            "latitude": (i % 18000) / 100.0 - 90.0, "countryCode": (1, 44, 81, 34, 61)[i % 5]}
+
+
+class FakeDatabase:
+    """
+    Collections and tables of one database, kept in memory
+    """
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.collections = {}
+        self.tables = set()
+        self.cursors = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.RLock()
+
+    def create(self, name, table=False):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = []
+                if table:
+                    self.tables.add(name)
+                self.insert(name, [seedDocument(i) for i in range(self.seed)])
+
+    def drop(self, name):
+        with self.lock:
+            existed = self.collections.pop(name, None) is not None
+            self.tables.discard(name)
+            return existed
+
+    def insert(self, name, docs):
+        with self.lock:
+            if name not in self.collections:
+                self.create(name)
+            target = self.collections[name]
+            for doc in docs:
+                doc = dict(doc)
+                if name not in self.tables:
+                    doc.setdefault("_id", "%024x" % next(self.ids))
+                target.append(doc)
+            return len(docs)
+
+    def find(self, name, query=None, sort=None, fields=None):
+        with self.lock:
+            docs = [doc for doc in self.collections.get(name, []) if matches(doc, query)]
+        for field, direction in reversed(list((sort or {}).items())):
+            docs.sort(key=lambda doc: (doc.get(field) is None, doc.get(field)), reverse=direction < 0)
+        return [project(doc, fields) for doc in docs]
+
+    def update(self, name, query, update):
+        with self.lock:
+            count = 0
+            for doc in self.collections.get(name, []):
+                if matches(doc, query):
+                    doc.update(update.get("$set", {}))
+                    count += 1
+            return count
+
+    def delete(self, name, query):
+        with self.lock:
+            docs = self.collections.get(name, [])
+            kept = [doc for doc in docs if not matches(doc, query)]
+            self.collections[name] = kept
+            return len(docs) - len(kept)
+
+    def join(self, spec):
+        collections = spec.get("$collections", {})
+        names = list(collections)
+        rows = [{}]
+        for name in names:
+            docs = self.find(name, collections[name].get("$where"))
+            rows = [dict(row, **{name: doc}) for row in rows for doc in docs]
+        for left, right in spec.get("$condition", {}).items():
+            lName, lField = left.split(".", 1)
+            if isinstance(right, str) and right.split(".", 1)[0] in collections:
+                rName, rField = right.split(".", 1)
+                rows = [row for row in rows if row[lName].get(lField) == row[rName].get(rField)]
+            else:
+                rows = [row for row in rows if matches(row[lName], {lField: right})]
+        result = []
+        for row in rows:
+            joined = {}
+            for name in names:
+                projection = collections[name].get("$project")
+                for field, value in project(row[name], projection).items():
+                    if field != "_id" or projection:
+                        joined[field] = value
+            result.append(joined)
+        return result
+
+    def command(self, command):
+        kind = next(iter(command))
+        if kind == "create":
+            self.create(command["create"], table="columns" in command)
+            return {"ok": 1.0}
+        if kind == "drop":
+            return {"ok": 1.0 if self.drop(command["drop"]) else 0.0}
+        if kind == "count":
+            return [{"count": len(self.find(command["count"], command.get("query"))), "ok": 1.0}]
+        if kind == "distinct":
+            docs = self.find(command["distinct"], command.get("query"))
+            values = []
+            for doc in docs:
+                value = doc.get(command["key"])
+                if value not in values:
+                    values.append(value)
+            return values
+        if kind == "collstats":
+            docs = self.collections.get(command["collstats"], [])
+            return [{"ns": command["collstats"], "count": len(docs),
+                     "size": len(json.dumps(docs)), "ok": 1.0}]
+        if kind == "dbstats":
+            with self.lock:
+                objects = sum(len(docs) for docs in self.collections.values())
+                return [{"collections": len(self.collections), "objects": objects, "ok": 1.0}]
+        if kind == "transaction":
+            if command["transaction"] == "execute":
+                # Commands run in order; nothing is rolled back if one fails
+                results = []
+                for each in command["commands"]:
+                    if "insert" in each:
+                        results.append({"n": self.insert(each["insert"], each["documents"]), "ok": 1.0})
+                    else:
+                        results.append(self.command(each))
+                return [{"ok": 1.0, "results": results}]
+            return [{"ok": 1.0}]
+        return None
+
+    def openCursor(self, docs, batchSize):
+        with self.lock:
+            cursorId = "%x" % next(self.ids)
+            self.cursors[cursorId] = (docs, batchSize)
+            return cursorId
+
+    def nextBatch(self, cursorId):
+        with self.lock:
+            docs, batchSize = self.cursors.pop(cursorId, ([], 0))
+            if len(docs) > batchSize:
+                self.cursors[cursorId] = (docs[batchSize:], batchSize)
+                return docs[:batchSize], cursorId
+            return docs, None
+
+
+class FakeListener:
+    """
+    A threaded HTTP server that behaves like the listener for the sample
+
+    :param latency: (seconds added to every reply)
+    :param jitter: (random extra seconds, up to this much, added to every reply)
+    :param seed: (documents put into every collection or table when it is created)
+    """
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.databases = {}
+        self.seed = seed
+        self.sessions = itertools.count(1)
+        listener = self
+
+        class Handler(_Handler):
+            pass
+        Handler.listener = listener
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def url(self, database="db"):
+        return "http://%s:%d/%s" % (self.server.server_address[0], self.port, database)
+
+    def database(self, name):
+        if name not in self.databases:
+            self.databases[name] = FakeDatabase(self.seed)
+        return self.databases[name]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Write headers and body in one segment, as the real listener does
+    disable_nagle_algorithm = True
+    listener = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_PUT(self):
+        self.handle_request()
+
+    def do_DELETE(self):
+        self.handle_request()
+
+    def handle_request(self):
+        listener = self.listener
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if listener.latency or listener.jitter:
+            time.sleep(listener.latency + random.random() * listener.jitter)
+
+        parts = urlsplit(self.path)
+        segments = [unquote(segment) for segment in parts.path.strip("/").split("/")]
+        database = listener.database(segments[0])
+        name = "/".join(segments[1:]) or None
+        args = dict(parse_qsl(parts.query))
+        cookies = SimpleCookie(self.headers.get("Cookie", ""))
+        self.newCookies = {}
+        if SESSION_COOKIE not in cookies:
+            self.newCookies[SESSION_COOKIE] = "%d" % next(listener.sessions)
+        try:
+            status, reply = self.dispatch(database, name, args, parts.query, body, cookies)
+        except (ValueError, KeyError, TypeError, StopIteration) as e:
+            status, reply = 400, {"$err": str(e), "ok": 0.0}
+        self.send(status, reply)
+
+    def dispatch(self, database, name, args, rawQuery, body, cookies):
+        method = self.command
+        loads = lambda value: json.loads(value) if value else None
+        if name is None:
+            if method == "GET":
+                names = sorted(database.collections)
+                options = loads(args.get("options")) or {}
+                if options.get("includeSystem"):
+                    names += ["system.join", "system.sql"]
+                return 200, names
+            if method == "POST":
+                database.create(loads(body)["name"])
+                return 200, {"ok": 1.0}
+            return 405, {"ok": 0.0}
+
+        if name == "$cmd":
+            # The sample sends some commands as the whole query string
+            command = loads(args["query"]) if "query" in args else loads(unquote(rawQuery))
+            reply = database.command(command)
+            return (200, reply) if reply is not None else (400, {"$err": "unknown command", "ok": 0.0})
+        if name == "system.sql":
+            return 200, [{"n": 1}]
+        if name == "system.join":
+            return self.batch(database, database.join(loads(args["query"])), args, cookies)
+
+        if method == "GET":
+            if CURSOR_COOKIE in cookies:
+                docs, cursorId = database.nextBatch(cookies[CURSOR_COOKIE].value)
+                if cursorId:
+                    self.newCookies[CURSOR_COOKIE] = cursorId
+                return 200, docs
+            docs = database.find(name, loads(args.get("query")), loads(args.get("sort")), loads(args.get("fields")))
+            return self.batch(database, docs, args, cookies)
+        if method == "POST":
+            docs = loads(body)
+            if isinstance(docs, list):
+                return 202, {"n": database.insert(name, docs)}
+            return 200, {"n": database.insert(name, [docs])}
+        if method == "PUT":
+            return 200, {"n": database.update(name, loads(args.get("query")), loads(body))}
+        if method == "DELETE":
+            if "query" in args:
+                return 200, {"n": database.delete(name, loads(args["query"]))}
+            return 200, {"ok": 1.0 if database.drop(name) else 0.0}
+        return 405, {"ok": 0.0}
+
+    def batch(self, database, docs, args, cookies):
+        batchSize = int(args.get("batchsize", 0))
+        if batchSize and len(docs) > batchSize:
+            self.newCookies[CURSOR_COOKIE] = database.openCursor(docs[batchSize:], batchSize)
+            docs = docs[:batchSize]
+        return 200, docs
+
+    def send(self, status, reply):
+        data = json.dumps(reply).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in self.newCookies.items():
+            self.send_header("Set-Cookie", "%s=%s; Path=/" % (name, value))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Informix REST listener")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=27018)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every reply")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra seconds per reply")
+    parser.add_argument("--seed", type=int, default=0, help="documents in every new collection or table")
+    options = parser.parse_args()
+    listener = FakeListener(options.host, options.port, options.latency, options.jitter, options.seed)
+    print("Listening on " + listener.url())
+    listener.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+##
+# Batch sizes of listener queries, tuned from the batches they return
+#
+# Every collection, table or system.join, together with the shape of the
+# query sent to it, has a batch size of its own. It starts at a default and,
+# after every full batch, is scaled toward the size whose round trip takes
+# targetSeconds, but never beyond what keeps a batch under maxBytes. The sizes
+# are kept for the life of the process, so later requests start from what
+# earlier ones learned.
+##
+
+import collections
+import threading
+
+import jsoncodec
+
+DEFAULT_TARGET_SECONDS = 0.25
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 10000
+# Largest factor a batch size changes by after one batch, so one slow reply
+# cannot collapse it
+MAX_STEP = 2.0
+# Round trips this close to the target leave the batch size alone
+DEAD_BAND = 0.1
+
+
+def queryShape(value):
+    """
+    A query, sort or projection with its values left out: queries that differ
+    only in the values they look for share a shape
+
+    :returns: (dict, list or None)
+    """
+    if isinstance(value, dict):
+        return dict((field, queryShape(item)) for field, item in value.items())
+    if isinstance(value, list):
+        # $in and $or lists of any length share a shape
+        return [queryShape(item) for item in value[:1]]
+    return None
+
+
+class _Tuned:
+    def __init__(self, name, batchSize):
+        self.name = name
+        self.batchSize = batchSize
+        self.batches = 0
+        self.lastSeconds = None
+        self.bytesPerDocument = None
+
+    def toDict(self):
+        return {"name": self.name, "batchSize": self.batchSize, "batches": self.batches,
+                "lastSeconds": self.lastSeconds, "bytesPerDocument": self.bytesPerDocument}
+
+
+class BatchTuner:
+    """
+    Batch sizes per collection and query shape, shared by every query of a process
+    """
+    def __init__(self, default=100, targetSeconds=DEFAULT_TARGET_SECONDS, maxBytes=DEFAULT_MAX_BYTES,
+                 minSize=MIN_BATCH_SIZE, maxSize=MAX_BATCH_SIZE, maxKeys=1024):
+        self.default = default
+        self.targetSeconds = targetSeconds
+        self.maxBytes = maxBytes
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.maxKeys = maxKeys
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, url, query=None, sort=None, fields=None):
+        """
+        :param url: (url of the collection, table or system.join)
+        :returns: (hashable key of the collection and query shape)
+        """
+        # The projection is kept as is: it decides the size of every document
+        return (url.split("?", 1)[0], jsoncodec.dumpsText(queryShape(query)), jsoncodec.dumpsText(queryShape(sort)),
+                jsoncodec.dumpsText(fields))
+
+    def batchSize(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return self.default if entry is None else entry.batchSize
+
+    def observe(self, key, batchSize, count, seconds, size):
+        """
+        Learn from one batch of a query
+
+        :param batchSize: (the batch size the query was sent with)
+        :param count: (documents in the batch)
+        :param seconds: (round trip, from sending the request to the last byte of the reply)
+        :param size: (bytes in the reply)
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = _Tuned(key[0].rsplit("/", 1)[-1], self.default)
+                while len(self.entries) > self.maxKeys:
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.move_to_end(key)
+            entry.batches += 1
+            entry.lastSeconds = seconds
+            target = entry.batchSize
+            # Only a full batch was held back by its size; a shorter one was the end of the result
+            if count >= batchSize and seconds > 0:
+                ratio = self.targetSeconds / seconds
+                if abs(ratio - 1.0) > DEAD_BAND:
+                    target = batchSize * min(MAX_STEP, max(1.0 / MAX_STEP, ratio))
+            if count:
+                entry.bytesPerDocument = float(size) / count
+                target = min(target, self.maxBytes / entry.bytesPerDocument)
+            entry.batchSize = int(max(self.minSize, min(self.maxSize, target)))
+
+    def stats(self):
+        """
+        :returns: (dict, with the most recently used shapes last)
+        """
+        with self.lock:
+            shapes = [entry.toDict() for entry in self.entries.values()]
+        return {"default": self.default, "targetSeconds": self.targetSeconds, "maxBytes": self.maxBytes,
+                "shapes": shapes}
@@ -0,0 +1,148 @@
+##
+# Streaming bulk insert into collections and relational tables
+##
+
+import asyncio
+
+import requests
+
+import jsoncodec
+
+DEFAULT_BATCH_SIZE = 1000           # documents per POST
+DEFAULT_BATCH_BYTES = 1024 * 1024   # serialized bytes per POST
+DEFAULT_IN_FLIGHT = 4               # POSTs waiting on the listener at the same time
+
+# The listener replies 200 to a single insert and 202 to a multiple insert
+SUCCESS_CODES = (200, 201, 202)
+
+
+def encodeDocument(item):
+    """
+    Accept either a City-like object or a plain dict
+
+    :returns: (JSON bytes)
+    """
+    if hasattr(item, "toDict"):
+        item = item.toDict()
+    return jsoncodec.dumps(item)
+
+
+def iterBatches(documents, batchSize=DEFAULT_BATCH_SIZE, batchBytes=DEFAULT_BATCH_BYTES):
+    """
+    Serialize documents into JSON array bodies, one document at a time
+
+    A batch is closed when it holds batchSize documents or when the next
+    document would take it past batchBytes. A single document larger than
+    batchBytes is sent in a batch of its own. A CityBatch is serialized a
+    whole batch at a time instead.
+
+    :returns: (generator of (document count, body bytes))
+    """
+    if hasattr(documents, "toJSONBytes"):
+        for batch in _iterColumnBatches(documents, batchSize, batchBytes):
+            yield batch
+        return
+    buffer = bytearray(b"[")
+    count = 0
+    for item in documents:
+        encoded = encodeDocument(item)
+        if count and (count >= batchSize or len(buffer) + len(encoded) + 2 > batchBytes):
+            buffer += b"]"
+            yield count, bytes(buffer)
+            buffer = bytearray(b"[")
+            count = 0
+        if count:
+            buffer += b","
+        buffer += encoded
+        count += 1
+    if count:
+        buffer += b"]"
+        yield count, bytes(buffer)
+
+
+def _iterColumnBatches(documents, batchSize, batchBytes):
+    """
+    Serialize a CityBatch batchSize documents per encoder call. A body past
+    batchBytes is encoded again with half the documents, until it fits or
+    holds one document.
+    """
+    start = 0
+    while start < len(documents):
+        count = min(batchSize, len(documents) - start)
+        body = documents.toJSONBytes(start, start + count)
+        while count > 1 and len(body) > batchBytes:
+            count //= 2
+            body = documents.toJSONBytes(start, start + count)
+        yield count, body
+        start += count
+
+
+class BatchResult:
+    """
+    Outcome of one POST: how many documents were sent and how many the
+    listener reports as inserted in its 'n' field.
+    """
+    def __init__(self, index, count, reply=None, error=None):
+        self.index = index
+        self.count = count
+        self.reply = reply
+        self.error = error
+        self.inserted = 0
+        if reply is not None and reply.status_code in SUCCESS_CODES:
+            self.inserted = jsoncodec.loads(reply.content).get('n', 0)
+
+    @property
+    def ok(self):
+        return (self.error is None and self.reply.status_code in SUCCESS_CODES
+                and self.inserted == self.count)
+
+
+class BulkInsertReport:
+    def __init__(self, batches):
+        self.batches = batches
+
+    @property
+    def sent(self):
+        return sum(batch.count for batch in self.batches)
+
+    @property
+    def inserted(self):
+        return sum(batch.inserted for batch in self.batches)
+
+    @property
+    def failures(self):
+        return [batch for batch in self.batches if not batch.ok]
+
+
+async def bulkInsert(session, url, documents, batchSize=DEFAULT_BATCH_SIZE,
+                     batchBytes=DEFAULT_BATCH_BYTES, maxInFlight=DEFAULT_IN_FLIGHT):
+    """
+    Insert documents from any iterable or generator into a collection or table
+
+    Documents are pulled from the iterable only as batches are needed, and at
+    most maxInFlight batches are posted concurrently, so memory stays bounded
+    by maxInFlight * batchBytes however many documents there are. A failed
+    batch does not stop the load; it is reported in the result.
+
+    :param session: (AsyncListenerSession)
+    :param url: (url of the collection or table)
+    :returns: (BulkInsertReport)
+    """
+    async def send(index, count, body):
+        try:
+            reply = await session.post(url, body)
+        except requests.RequestException as e:
+            return BatchResult(index, count, error=str(e))
+        return BatchResult(index, count, reply)
+
+    tasks = []
+    pending = set()
+    for index, (count, body) in enumerate(iterBatches(documents, batchSize, batchBytes)):
+        if len(pending) >= maxInFlight:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        task = asyncio.ensure_future(send(index, count, body))
+        tasks.append(task)
+        pending.add(task)
+    if pending:
+        await asyncio.wait(pending)
+    return BulkInsertReport([task.result() for task in tasks])
@@ -0,0 +1,370 @@
+##
+# Bulk updates and deletes, grouped into $in predicates and run in partitions
+#
+# A mutation is a (query, update) pair; an update of None deletes. Mutations
+# whose query is an equality on one field, e.g. {"name": "Seattle"}, and that
+# share an update are merged into one {"name": {"$in": [...]}} call. Each such
+# call is a partition; partitions run concurrently, a bounded number at a
+# time. A journal file records every partition as it starts and finishes, so
+# a run that was interrupted can be repeated with the same journal and skips
+# the partitions already done.
+#
+# Ordering: by default, the outcome is the same as applying the mutations one
+# by one in order. Partitions run concurrently only within a wave: a run of
+# equality mutations on one field in which no value is mutated twice, and no
+# value one mutation writes to the field is matched by another. Any other
+# query, and an update whose new values of the field are not known, runs in a
+# wave of its own. With ordered=False, the caller
+# promises the mutations are independent and every partition may run at once.
+##
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+
+import requests
+
+import jsoncodec
+
+DEFAULT_PARTITION_SIZE = 200        # values per $in predicate
+DEFAULT_PARTITION_BYTES = 4096      # serialized bytes of a query, which travels in the url
+DEFAULT_IN_FLIGHT = 4               # partitions waiting on the listener at the same time
+
+UPDATE = "update"
+DELETE = "delete"
+
+
+def _equality(query):
+    """
+    :returns: ((field, value) if the query is an equality on one field, else None)
+    """
+    if not isinstance(query, dict) or len(query) != 1:
+        return None
+    field, value = next(iter(query.items()))
+    if field.startswith("$") or value is None or not isinstance(value, (str, int, float)):
+        return None
+    return field, value
+
+
+def _overlaps(path, field):
+    return path == field or path.startswith(field + ".") or field.startswith(path + ".")
+
+
+def _written(update, field):
+    """
+    The values an update gives to field, so that a later mutation matching one
+    of them is not run alongside it
+
+    :returns: (set of encoded values, or None if they cannot be told from the update)
+    """
+    if update is None:
+        return set()
+    if not isinstance(update, dict):
+        return None
+    if not any(name.startswith("$") for name in update):
+        # A replacement document: without the field, the documents lose it
+        update = {"$set": {field: update[field]}} if field in update else {}
+    written = set()
+    for operator, spec in update.items():
+        if not isinstance(spec, dict):
+            return None
+        for path, value in spec.items():
+            if operator == "$rename":
+                # Renaming the field away leaves no value to match; renaming onto it brings unknown ones
+                if not isinstance(value, str) or _overlaps(value, field) or (path != field and
+                                                                             _overlaps(path, field)):
+                    return None
+            elif path == field:
+                if operator == "$unset":
+                    continue
+                if operator not in ("$set", "$setOnInsert") or _equality({field: value}) is None:
+                    return None
+                written.add(jsoncodec.dumpsText(value))
+            elif _overlaps(path, field):
+                return None
+    return written
+
+
+class Partition:
+    """
+    One listener call: an update or delete by a query, standing for one or
+    more mutations
+    """
+    def __init__(self, kind, update, wave, field=None, values=None, query=None, count=1):
+        self.kind = kind
+        self.update = update
+        self.wave = wave
+        self.field = field
+        self.values = values
+        self._query = query
+        # Mutations merged into this partition
+        self.count = count
+        self.id = None
+
+    @property
+    def query(self):
+        if self._query is not None:
+            return self._query
+        if len(self.values) == 1:
+            return {self.field: self.values[0]}
+        return {self.field: {"$in": self.values}}
+
+    def digest(self):
+        # The standard library's encoding with sorted keys, so ids do not depend on the codec backend
+        body = json.dumps({"kind": self.kind, "query": self.query, "update": self.update}, sort_keys=True)
+        return hashlib.sha1(body.encode("utf-8")).hexdigest()[:16]
+
+
+class _Group:
+    def __init__(self, update):
+        self.update = update
+        self.values = []
+        self.seen = set()
+        self.bytes = 0
+        self.count = 0
+
+
+def iterPartitions(mutations, partitionSize=DEFAULT_PARTITION_SIZE, partitionBytes=DEFAULT_PARTITION_BYTES,
+                   ordered=True):
+    """
+    Group mutations from any iterable or generator into Partitions
+
+    Mutations are pulled only as partitions are needed: at most one open
+    group per field and update is held in memory. A value mutated twice
+    never shares a partition with itself, so non-idempotent updates such as
+    $inc are applied once per mutation.
+
+    :param mutations: (iterable of (query, update or None))
+    :returns: (generator of Partition, in wave order)
+    """
+    groups = {}
+    # Ordered mode: the field of the current wave, the values it has mutated and the values it has written
+    wave = 0
+    waveField = None
+    touched = set()
+    written = set()
+
+    def close(key):
+        group = groups.pop(key)
+        return Partition(DELETE if group.update is None else UPDATE, group.update, wave, key[0], group.values,
+                         count=group.count)
+
+    def closeAll():
+        return [close(key) for key in list(groups)]
+
+    for query, update in mutations:
+        equality = _equality(query)
+        writes = None if equality is None else _written(update, equality[0])
+        if equality is None or (ordered and writes is None):
+            if ordered:
+                # Any query may overlap any other mutation: a wave of its own
+                for partition in closeAll():
+                    yield partition
+                if waveField is not None or touched:
+                    wave += 1
+                yield Partition(DELETE if update is None else UPDATE, update, wave, query=query)
+                wave += 1
+                waveField = None
+                touched = set()
+                written = set()
+            else:
+                yield Partition(DELETE if update is None else UPDATE, update, wave, query=query)
+            continue
+
+        field, value = equality
+        encoded = jsoncodec.dumpsText(value)
+        key = (field, None if update is None else jsoncodec.dumpsText(update))
+        if ordered and ((waveField is not None and field != waveField) or encoded in touched or
+                        encoded in written or not writes.isdisjoint(touched)):
+            # This value, or documents of another field, were already mutated or written in this
+            # wave, or this update writes a value the wave matches
+            for partition in closeAll():
+                yield partition
+            wave += 1
+            touched = set()
+            written = set()
+        elif not ordered and key in groups and encoded in groups[key].seen:
+            yield close(key)
+        if ordered:
+            waveField = field
+            touched.add(encoded)
+            written.update(writes)
+
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = _Group(update)
+        group.values.append(value)
+        group.seen.add(encoded)
+        group.bytes += len(encoded) + 1
+        group.count += 1
+        if len(group.values) >= partitionSize or group.bytes >= partitionBytes:
+            yield close(key)
+
+    for partition in closeAll():
+        yield partition
+
+
+class Journal:
+    """
+    Append-only record of partitions started and done, one JSON object per line
+
+    A partition is done once its "done" line is on disk. A partition that
+    started but is not done may or may not have reached the listener, and is
+    sent again on the next run.
+    """
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+        self.lock = threading.Lock()
+        # Partition id to the n the listener reported
+        self.done = {}
+        self.started = set()
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                for line in file:
+                    try:
+                        entry = jsoncodec.loads(line)
+                    except ValueError:
+                        # The last line of an interrupted run may be cut short
+                        continue
+                    if entry.get("state") == "done":
+                        self.done[entry["id"]] = entry.get("n", 0)
+                    else:
+                        self.started.add(entry["id"])
+        self.file = open(path, "ab")
+
+    def start(self, partition):
+        self._append({"id": partition.id, "state": "started", "kind": partition.kind,
+                      "mutations": partition.count})
+
+    def finish(self, partition, n):
+        self.done[partition.id] = n
+        self._append({"id": partition.id, "state": "done", "n": n})
+
+    def _append(self, entry):
+        with self.lock:
+            self.file.write(jsoncodec.dumps(entry) + b"\n")
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class PartitionResult:
+    """
+    Outcome of one partition: the n the listener reported, or why it failed
+    """
+    def __init__(self, partition, n=0, reply=None, error=None, resumed=False, retried=False):
+        self.partition = partition
+        self.n = n
+        self.reply = reply
+        self.error = error
+        # Done by an earlier run, according to the journal
+        self.resumed = resumed
+        # Started by an earlier run that did not record it done, and sent again
+        self.retried = retried
+
+    @property
+    def ok(self):
+        return self.resumed or (self.error is None and self.reply.status_code == 200)
+
+    def toDict(self):
+        partition = self.partition
+        return {"id": partition.id, "kind": partition.kind, "field": partition.field, "wave": partition.wave,
+                "mutations": partition.count, "n": self.n, "ok": self.ok, "resumed": self.resumed,
+                "retried": self.retried,
+                "status": self.reply.status_code if self.reply is not None else None, "error": self.error}
+
+
+class BulkMutateReport:
+    def __init__(self, partitions):
+        self.partitions = partitions
+
+    @property
+    def mutations(self):
+        return sum(result.partition.count for result in self.partitions)
+
+    @property
+    def n(self):
+        return sum(result.n for result in self.partitions)
+
+    @property
+    def resumed(self):
+        return [result for result in self.partitions if result.resumed]
+
+    @property
+    def failures(self):
+        return [result for result in self.partitions if not result.ok]
+
+    def toDict(self):
+        return {"mutations": self.mutations, "calls": len(self.partitions) - len(self.resumed), "n": self.n,
+                "failed": len(self.failures), "resumed": len(self.resumed),
+                "partitions": [result.toDict() for result in self.partitions]}
+
+
+async def bulkMutate(session, url, mutations, partitionSize=DEFAULT_PARTITION_SIZE,
+                     partitionBytes=DEFAULT_PARTITION_BYTES, maxInFlight=DEFAULT_IN_FLIGHT, journal=None,
+                     ordered=True):
+    """
+    Apply updates and deletes from any iterable or generator to a collection or table
+
+    At most maxInFlight partitions are sent at a time, and a wave starts only
+    once the one before it has finished. A failed partition does not stop the
+    run; it is reported in the result and sent again when the run is repeated
+    with the same journal.
+
+    :param session: (AsyncListenerSession)
+    :param url: (url of the collection or table)
+    :param mutations: (iterable of (query, update or None); an update is a document such as {"$set": {...}})
+    :param journal: (Journal, to skip partitions done by an earlier run of the same mutations and settings)
+    :returns: (BulkMutateReport, with the partitions in the order they were formed)
+    """
+    async def send(partition):
+        retried = journal is not None and partition.id in journal.started
+        if journal is not None:
+            journal.start(partition)
+        params = {"query": jsoncodec.dumpsText(partition.query)}
+        try:
+            if partition.kind == DELETE:
+                reply = await session.delete(url, params=params)
+            else:
+                reply = await session.put(url, jsoncodec.dumps(partition.update), params=params)
+        except requests.RequestException as e:
+            return PartitionResult(partition, error=str(e), retried=retried)
+        if reply.status_code != 200:
+            return PartitionResult(partition, reply=reply, retried=retried)
+        n = jsoncodec.loads(reply.content).get('n', 0)
+        if journal is not None:
+            journal.finish(partition, n)
+        return PartitionResult(partition, n, reply, retried=retried)
+
+    # Identical partitions, e.g. the same $inc in two waves, are told apart by occurrence
+    occurrences = {}
+    results = []
+    pending = set()
+    wave = None
+    for partition in iterPartitions(mutations, partitionSize, partitionBytes, ordered):
+        digest = partition.digest()
+        occurrences[digest] = occurrences.get(digest, 0) + 1
+        partition.id = "%s-%d" % (digest, occurrences[digest])
+
+        if partition.wave != wave and pending:
+            await asyncio.wait(pending)
+            pending = set()
+        wave = partition.wave
+        if journal is not None and partition.id in journal.done:
+            results.append(PartitionResult(partition, journal.done[partition.id], resumed=True))
+            continue
+        if len(pending) >= maxInFlight:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        task = asyncio.ensure_future(send(partition))
+        results.append(task)
+        pending.add(task)
+    if pending:
+        await asyncio.wait(pending)
+    return BulkMutateReport([result if isinstance(result, PartitionResult) else result.result()
+                             for result in results])
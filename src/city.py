@@ -0,0 +1,98 @@
+##
+# City documents, one at a time or as a columnar batch
+##
+
+from array import array
+
+import jsoncodec
+
+# Field order of a City document, as in the cityTable definition
+FIELDS = ("name", "population", "longitude", "latitude", "countryCode")
+
+# Columns of the cityTable, as given to the listener's create command
+COLUMNS = [{"name": "name", "type": "varchar(50)"},
+           {"name": "population", "type": "int"},
+           {"name": "longitude", "type": "decimal(8,4)"},
+           {"name": "latitude", "type": "decimal(8,4)"},
+           {"name": "countryCode", "type": "int"}]
+
+
+class City:
+    """
+    A city document. Serializes straight to a dict, which jsoncodec encodes.
+    """
+    __slots__ = FIELDS
+
+    def __init__(self, name, population, longitude, latitude, countryCode):
+        self.name = name
+        self.population = population
+        self.longitude = longitude
+        self.latitude = latitude
+        self.countryCode = countryCode
+
+    def toDict(self):
+        return {"name": self.name, "population": self.population, "longitude": self.longitude,
+                "latitude": self.latitude, "countryCode": self.countryCode}
+
+    # Kept for callers of the original sample
+    toJSON = toDict
+
+    @classmethod
+    def fromDict(cls, doc):
+        return cls(doc["name"], doc["population"], doc["longitude"], doc["latitude"], doc["countryCode"])
+
+    def __eq__(self, other):
+        return isinstance(other, City) and all(getattr(self, f) == getattr(other, f) for f in FIELDS)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, f) for f in FIELDS))
+
+    def __repr__(self):
+        return "City(%r, %d, %r, %r, %d)" % (self.name, self.population, self.longitude,
+                                             self.latitude, self.countryCode)
+
+
+class CityBatch:
+    """
+    Many cities held as parallel columns.
+
+    Numeric columns are typed arrays, so a batch costs a few bytes per field
+    instead of one Python object per value. toJSONBytes serializes many
+    cities with one encoder call instead of one per city.
+    """
+    def __init__(self, cities=()):
+        self.names = []
+        self.populations = array("q")
+        self.longitudes = array("d")
+        self.latitudes = array("d")
+        self.countryCodes = array("q")
+        for city in cities:
+            self.append(city)
+
+    def append(self, city):
+        self.names.append(city.name)
+        self.populations.append(city.population)
+        self.longitudes.append(city.longitude)
+        self.latitudes.append(city.latitude)
+        self.countryCodes.append(city.countryCode)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for row in zip(self.names, self.populations, self.longitudes, self.latitudes, self.countryCodes):
+            yield City(*row)
+
+    def toDicts(self, start=0, stop=None):
+        """
+        :returns: ([dict] of the cities from start to stop, as City.toDict gives them)
+        """
+        columns = [column[start:stop] for column in (self.names, self.populations, self.longitudes,
+                                                      self.latitudes, self.countryCodes)]
+        return [dict(zip(FIELDS, row)) for row in zip(*columns)]
+
+    def toJSONBytes(self, start=0, stop=None):
+        """
+        :returns: (JSON array bytes of the cities from start to stop)
+        """
+        return jsoncodec.dumps(self.toDicts(start, stop))
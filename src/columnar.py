@@ -0,0 +1,315 @@
+##
+# Query results as typed columns, for export and aggregation
+#
+# Documents are gathered into ColumnBatches: numeric fields become contiguous
+# arrays (array.array, shared with NumPy without copying when it is
+# installed) and other fields lists. Batches can be written incrementally as
+# CSV, or as Parquet when pyarrow is installed, and aggregated by group
+# without a Python loop per document.
+##
+
+import csv
+import importlib.util
+import itertools
+import math
+from array import array
+
+INT = "int"
+FLOAT = "float"
+TEXT = "text"
+
+# array typecodes of the numeric kinds
+TYPECODES = {INT: "q", FLOAT: "d"}
+
+_INT_TYPES = ("int", "integer", "bigint", "int8", "smallint", "serial", "serial8", "bigserial")
+_FLOAT_TYPES = ("decimal", "numeric", "money", "float", "smallfloat", "real", "double precision")
+
+
+def columnKind(sqlType):
+    """
+    :param sqlType: (column type of a listener create command, e.g. "decimal(8,4)")
+    :returns: (INT, FLOAT or TEXT)
+    """
+    base = sqlType.split("(", 1)[0].strip().lower()
+    if base in _INT_TYPES:
+        return INT
+    if base in _FLOAT_TYPES:
+        return FLOAT
+    return TEXT
+
+
+def schemaFromColumns(columns):
+    """
+    :param columns: ([{"name": ..., "type": ...}] as in a create command)
+    :returns: ([(field, kind)])
+    """
+    return [(column["name"], columnKind(column["type"])) for column in columns]
+
+
+def inferSchema(docs):
+    """
+    Column kinds from sample documents: a field is INT if every value is an
+    integer, FLOAT if every value is a number, TEXT otherwise. _id is left out.
+
+    :returns: ([(field, kind)] in order of first appearance)
+    """
+    kinds = {}
+    for doc in docs:
+        for field, value in doc.items():
+            if field == "_id" or value is None:
+                kinds.setdefault(field, None)
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                kind = TEXT
+            else:
+                kind = INT if isinstance(value, int) else FLOAT
+            previous = kinds.get(field)
+            if previous is None or previous == kind:
+                kinds[field] = kind
+            elif TEXT in (previous, kind):
+                kinds[field] = TEXT
+            else:
+                kinds[field] = FLOAT
+    return [(field, kind or TEXT) for field, kind in kinds.items() if field != "_id"]
+
+
+def _numeric(kind, values):
+    """
+    A typed array of values. Missing values are stored as NaN, which turns an
+    INT column into a float one for that batch.
+    """
+    if kind == INT:
+        try:
+            return array("q", values)
+        except (TypeError, OverflowError):
+            pass
+    return array("d", [math.nan if value is None else value for value in values])
+
+
+class SchemaChanged(ValueError):
+    """
+    A column of a later batch holds values of another kind than the first batch
+    """
+
+
+class ColumnBatch:
+    """
+    Documents held as one column per field
+    """
+    def __init__(self, schema, columns):
+        self.schema = list(schema)
+        self.columns = columns
+
+    @classmethod
+    def fromDocuments(cls, schema, docs):
+        """
+        A numeric column holding a value that is not a number is widened to
+        TEXT, so the batch's schema may differ from the one given
+        """
+        columns = {}
+        kinds = []
+        for field, kind in schema:
+            values = [doc.get(field) for doc in docs]
+            if kind in TYPECODES:
+                try:
+                    values = _numeric(kind, values)
+                except TypeError:
+                    kind = TEXT
+            columns[field] = values
+            kinds.append((field, kind))
+        return cls(kinds, columns)
+
+    def __len__(self):
+        return len(self.columns[self.schema[0][0]]) if self.schema else 0
+
+    def rows(self):
+        """
+        :returns: (iterator of tuples in schema order)
+        """
+        return zip(*[self.columns[field] for field, kind in self.schema])
+
+    def toNumpy(self):
+        """
+        Numeric columns are views of the arrays, not copies
+
+        :returns: (dict of field to numpy array)
+        """
+        import numpy
+        result = {}
+        for field, kind in self.schema:
+            column = self.columns[field]
+            if isinstance(column, array):
+                result[field] = numpy.frombuffer(column, dtype="int64" if column.typecode == "q" else "float64")
+            else:
+                result[field] = numpy.array(column, dtype=object)
+        return result
+
+    def toArrow(self):
+        """
+        Numeric columns are wrapped, not copied
+
+        :returns: (pyarrow.RecordBatch)
+        """
+        import pyarrow
+        arrays = []
+        for field, kind in self.schema:
+            column = self.columns[field]
+            if isinstance(column, array) and kind == INT and column.typecode == "d":
+                # An integer column with missing values, stored as NaN
+                values = pyarrow.array(column.tolist(), type=pyarrow.float64(), from_pandas=True)
+                values = values.cast(pyarrow.int64())
+            elif isinstance(column, array):
+                arrowType = pyarrow.int64() if column.typecode == "q" else pyarrow.float64()
+                values = pyarrow.Array.from_buffers(arrowType, len(column), [None, pyarrow.py_buffer(column)])
+            else:
+                values = pyarrow.array([None if value is None else str(value) for value in column],
+                                       type=pyarrow.string())
+            arrays.append(values)
+        return pyarrow.RecordBatch.from_arrays(arrays, names=[field for field, kind in self.schema])
+
+
+def iterColumnBatches(docs, schema=None, batchSize=1000):
+    """
+    Gather documents from any iterator, such as iterQuery, into ColumnBatches
+
+    Only one batch of documents is held at a time. Without a schema, it is
+    inferred from the first batch. A column that turns out to hold text in a
+    later batch stays TEXT in the batches after it.
+
+    :returns: (generator of ColumnBatch)
+    """
+    docs = iter(docs)
+    while True:
+        chunk = list(itertools.islice(docs, batchSize))
+        if not chunk:
+            return
+        if schema is None:
+            schema = inferSchema(chunk)
+        batch = ColumnBatch.fromDocuments(schema, chunk)
+        schema = batch.schema
+        yield batch
+
+
+class CsvWriter:
+    """
+    Write batches to a text file object as CSV, header first
+    """
+    def __init__(self, file, schema):
+        self.writer = csv.writer(file)
+        self.writer.writerow([field for field, kind in schema])
+
+    def write(self, batch):
+        self.writer.writerows(batch.rows())
+
+
+def parquetAvailable():
+    """
+    :returns: (whether pyarrow, which ParquetWriter needs, is installed)
+    """
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+class ParquetWriter:
+    """
+    Write batches to a path or binary file object as Parquet, one row group
+    per batch. Needs pyarrow.
+    """
+    def __init__(self, where, schema):
+        import pyarrow
+        import pyarrow.parquet
+        types = {INT: pyarrow.int64(), FLOAT: pyarrow.float64(), TEXT: pyarrow.string()}
+        self.kinds = list(schema)
+        self.schema = pyarrow.schema([(field, types[kind]) for field, kind in schema])
+        self.writer = pyarrow.parquet.ParquetWriter(where, self.schema)
+
+    def write(self, batch):
+        """
+        :raises SchemaChanged: (a column of the batch is of another kind than the file's)
+        """
+        import pyarrow
+        for (field, kind), (batchField, batchKind) in zip(self.kinds, batch.schema):
+            if kind != batchKind:
+                raise SchemaChanged("Column %s holds %s values after %s ones; a Parquet file has one type "
+                                    "per column" % (field, batchKind, kind))
+        self.writer.write_table(pyarrow.Table.from_batches([batch.toArrow()], schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class GroupAggregate:
+    """
+    Count, sum and mean of a numeric field per value of a key field,
+    accumulated batch by batch.
+
+    With NumPy, each batch is reduced with unique and bincount, without a
+    Python loop per document. Without it, each batch is reduced in one pass
+    over its rows. Missing values, None or NaN, are skipped either way.
+    """
+    def __init__(self, key, field):
+        self.key = key
+        self.field = field
+        self.counts = {}
+        self.sums = {}
+        try:
+            import numpy
+            self.numpy = numpy
+        except ImportError:
+            self.numpy = None
+
+    def check(self, schema):
+        """
+        :raises ValueError: (the key or the field is not a column of schema)
+        """
+        fields = [field for field, kind in schema]
+        for name in (self.key, self.field):
+            if name not in fields:
+                raise ValueError("No field %s in the query result" % name)
+
+    def update(self, batch):
+        """
+        :raises ValueError: (the field holds a value that is not a number)
+        """
+        keys = batch.columns[self.key]
+        values = batch.columns[self.field]
+        if not isinstance(values, array) and any(value is not None and (isinstance(value, bool) or
+                                                 not isinstance(value, (int, float))) for value in values):
+            raise ValueError("Field %s holds values that are not numbers" % self.field)
+        if self.numpy is not None:
+            counts, sums = self._reduceNumpy(keys, values)
+        else:
+            counts, sums = self._reduce(keys, values)
+        for key in counts:
+            self.counts[key] = self.counts.get(key, 0) + counts[key]
+            self.sums[key] = self.sums.get(key, 0) + sums[key]
+
+    def _reduceNumpy(self, keys, values):
+        numpy = self.numpy
+        keys = numpy.frombuffer(keys, dtype="int64" if keys.typecode == "q" else "float64") \
+            if isinstance(keys, array) else numpy.array(keys, dtype=object)
+        values = numpy.frombuffer(values, dtype="int64" if values.typecode == "q" else "float64") \
+            if isinstance(values, array) else numpy.array(values, dtype="float64")
+        present = values == values
+        unique, inverse = numpy.unique(keys[present], return_inverse=True)
+        counts = numpy.bincount(inverse, minlength=len(unique))
+        sums = numpy.bincount(inverse, weights=values[present], minlength=len(unique))
+        return (dict(zip(unique.tolist(), counts.tolist())), dict(zip(unique.tolist(), sums.tolist())))
+
+    def _reduce(self, keys, values):
+        counts = {}
+        sums = {}
+        for key, value in zip(keys, values):
+            # NaN, a missing value in a numeric column, is the only value not equal to itself
+            if value is None or value != value:
+                continue
+            counts[key] = counts.get(key, 0) + 1
+            sums[key] = sums.get(key, 0) + value
+        return counts, sums
+
+    def result(self):
+        """
+        :returns: ({key: {"count": ..., "sum": ..., "mean": ...}})
+        """
+        return dict((key, {"count": self.counts[key], "sum": self.sums[key],
+                           "mean": self.sums[key] / self.counts[key] if self.counts[key] else None})
+                    for key in self.counts)
@@ -0,0 +1,192 @@
+##
+# Where the listener is, resolved once per process
+#
+# The database url is URL when it is set. Otherwise every instance of the
+# service bound in VCAP_SERVICES is an endpoint, each reachable by its
+# rest_url and rest_url_ssl: the preferred one first, the other as a
+# fall-back. The environment is parsed once, when the first url is asked for;
+# after that, asking costs a look at the endpoints' health marks only.
+#
+# An endpoint that fails to connect is passed over for retryAfter seconds,
+# then tried again. Nothing is re-read until reload() is called, e.g. from a
+# SIGHUP handler.
+##
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+class Endpoint:
+    """
+    One url of one bound service instance
+    """
+    def __init__(self, url, instance=None, ssl=False, credentials=None):
+        self.url = url
+        self.instance = instance
+        self.ssl = ssl
+        self.credentials = credentials or {}
+        # Passed over until this time, after a failure
+        self.downUntil = 0.0
+        self.failures = 0
+        self.lastError = None
+
+    def toDict(self, now=None):
+        now = time.time() if now is None else now
+        return {"instance": self.instance, "ssl": self.ssl, "up": self.downUntil <= now,
+                "failures": self.failures, "lastError": self.lastError}
+
+
+def loadEndpoints(url="", serviceName="timeseriesdatabase", useSsl=False, environ=None):
+    """
+    Parse the endpoints from URL or VCAP_SERVICES
+
+    :returns: ([Endpoint] in order of preference)
+    """
+    if url:
+        return [Endpoint(url, ssl=url.startswith("https:"))]
+    environ = os.environ if environ is None else environ
+    if environ.get('VCAP_SERVICES') is None:
+        raise Exception("VCAP_SERVICES not set in the environment")
+    vcap_services = json.loads(environ['VCAP_SERVICES'])
+    keys = ('rest_url_ssl', 'rest_url') if useSsl else ('rest_url', 'rest_url_ssl')
+    try:
+        instances = vcap_services[serviceName]
+        endpoints = []
+        for index, instance in enumerate(instances):
+            credentials = instance['credentials']
+            for key in keys:
+                if credentials.get(key):
+                    endpoints.append(Endpoint(credentials[key], instance.get('name', str(index)),
+                                              key == 'rest_url_ssl', credentials))
+        if not endpoints:
+            raise KeyError(keys[0])
+        return endpoints
+    except KeyError as e:
+        logging.error(e)
+        raise Exception("Error parsing VCAP_SERVICES. Key " + str(e) + " not found.")
+
+
+class ServiceResolver:
+    """
+    The url to use now: the first endpoint that is not marked down, or the
+    one that comes back soonest when all are
+    """
+    def __init__(self, endpoints, retryAfter=30.0, source=None):
+        self.endpoints = list(endpoints)
+        self.retryAfter = retryAfter
+        # What the endpoints were read from, to tell when they are stale
+        self.source = source
+        self.lock = threading.Lock()
+
+    def url(self):
+        now = time.time()
+        for endpoint in self.endpoints:
+            if endpoint.downUntil <= now:
+                return endpoint.url
+        return min(self.endpoints, key=lambda endpoint: endpoint.downUntil).url
+
+    def endpointFor(self, url):
+        """
+        :param url: (database url, or any listener url under it)
+        :returns: (Endpoint or None)
+        """
+        for endpoint in self.endpoints:
+            if url == endpoint.url or url.startswith(endpoint.url + "/") or url.startswith(endpoint.url + "?"):
+                return endpoint
+        return None
+
+    def markDown(self, url, error=None):
+        endpoint = self.endpointFor(url)
+        if endpoint is None:
+            return
+        with self.lock:
+            if endpoint.downUntil <= time.time():
+                logging.warning("Listener endpoint of instance %s unreachable, failing over: %s",
+                                endpoint.instance, error)
+            endpoint.downUntil = time.time() + self.retryAfter
+            endpoint.failures += 1
+            endpoint.lastError = None if error is None else str(error)
+
+    def markUp(self, url):
+        # Called after every successful call; usually nothing is down
+        if not any(endpoint.downUntil for endpoint in self.endpoints):
+            return
+        endpoint = self.endpointFor(url)
+        if endpoint is not None and endpoint.downUntil:
+            with self.lock:
+                endpoint.downUntil = 0.0
+
+    def check(self, probe):
+        """
+        Probe every endpoint and mark it up or down
+
+        :param probe: (called with an endpoint url, returns True if it is healthy)
+        :returns: ([dict] in order of preference)
+        """
+        for endpoint in self.endpoints:
+            try:
+                healthy = probe(endpoint.url)
+                error = None if healthy else "unhealthy reply"
+            except Exception as e:
+                healthy = False
+                error = "%s: %s" % (type(e).__name__, e)
+            if healthy:
+                self.markUp(endpoint.url)
+            else:
+                self.markDown(endpoint.url, error)
+        return self.status()
+
+    def status(self):
+        now = time.time()
+        return [endpoint.toDict(now) for endpoint in self.endpoints]
+
+
+_resolver = None
+_resolverLock = threading.Lock()
+
+
+def getResolver(url="", serviceName="timeseriesdatabase", useSsl=False, retryAfter=30.0):
+    """
+    This process's resolver, created from the environment on first use
+
+    The arguments are the settings the endpoints are read with; if they
+    differ from those of the current resolver, it is replaced.
+
+    :returns: (ServiceResolver)
+    """
+    global _resolver
+    source = (url, serviceName, useSsl)
+    resolver = _resolver
+    if resolver is not None and resolver.source == source:
+        return resolver
+    with _resolverLock:
+        if _resolver is None or _resolver.source != source:
+            _resolver = ServiceResolver(loadEndpoints(url, serviceName, useSsl), retryAfter, source)
+        return _resolver
+
+
+def markDown(url, error=None):
+    """
+    Mark the endpoint of a listener url down, if the current resolver has one
+    """
+    resolver = _resolver
+    if resolver is not None:
+        resolver.markDown(url, error)
+
+
+def markUp(url):
+    resolver = _resolver
+    if resolver is not None:
+        resolver.markUp(url)
+
+
+def reload():
+    """
+    Forget the endpoints so the next url is read from the environment again
+    """
+    global _resolver
+    with _resolverLock:
+        _resolver = None
@@ -0,0 +1,37 @@
+##
+# Production server settings: python_rest_HelloGalaxy:app under gunicorn
+#
+#   gunicorn -c gunicorn.conf.py python_rest_HelloGalaxy:app
+#
+# WEB_CONCURRENCY   worker processes (default: one per CPU core)
+# WEB_THREADS       threads per worker (default 4)
+# VCAP_APP_PORT     port to listen on, as for the development server (default 8080)
+##
+
+import multiprocessing
+import os
+
+bind = "0.0.0.0:" + os.getenv('VCAP_APP_PORT', os.getenv('PORT', '8080'))
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.getenv('WEB_THREADS', 4))
+worker_class = "gthread"
+
+# Import the application once in the master so workers fork with it loaded
+preload_app = True
+
+# A /databasetest run makes about 50 listener calls; give in-flight requests
+# time to finish on shutdown before workers are killed
+timeout = int(os.getenv('WEB_TIMEOUT', 120))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 60))
+
+
+def post_fork(server, worker):
+    # The client created in the master must not be shared across processes. The
+    # worker's snapshot refresher starts with its first snapshot; the master runs none.
+    import python_rest_HelloGalaxy
+    python_rest_HelloGalaxy.initClient()
+
+
+def worker_exit(server, worker):
+    import python_rest_HelloGalaxy
+    python_rest_HelloGalaxy.closeClient()
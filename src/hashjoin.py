@@ -0,0 +1,180 @@
+##
+# Joins of collections and tables, on the listener or in this process
+#
+# A join is described with the same spec as system.join:
+#   {"$collections": {name: {"$project": {...}, "$where": {...}}, ...},
+#    "$condition": {"a.field": "b.field", ...}}
+##
+
+import jsoncodec
+from querystream import aiterQuery
+
+SERVER = "server"
+LOCAL = "local"
+AUTO = "auto"
+
+# Largest build side, in documents, that is joined in this process
+DEFAULT_BUILD_LIMIT = 10000
+
+
+class JoinPlan:
+    """
+    How a join is carried out. For a local join, build is the smaller side,
+    loaded into a hash table, and probe is the side streamed past it.
+    """
+    def __init__(self, strategy, counts=None, build=None, probe=None, keys=None):
+        self.strategy = strategy
+        self.counts = counts or {}
+        self.build = build
+        self.probe = probe
+        # [(build field, probe field)] for every equality in $condition
+        self.keys = keys or []
+
+
+def equalityKeys(spec):
+    """
+    Split $condition into field pairs of a two-way equi-join
+
+    :returns: ((left name, right name, [(left field, right field)]), or None if
+              the join is not a plain equi-join of two collections)
+    """
+    collections = spec.get("$collections", {})
+    condition = spec.get("$condition", {})
+    if len(collections) != 2 or not condition:
+        return None
+    left, right = list(collections)
+    pairs = []
+    for a, b in condition.items():
+        if not isinstance(b, str) or "." not in a or "." not in b:
+            return None
+        aName, aField = a.split(".", 1)
+        bName, bField = b.split(".", 1)
+        if (aName, bName) == (left, right):
+            pairs.append((aField, bField))
+        elif (aName, bName) == (right, left):
+            pairs.append((bField, aField))
+        else:
+            return None
+    return left, right, pairs
+
+
+async def countDocuments(session, url, name, where=None):
+    """
+    Cardinality estimate from the listener's count command
+
+    :returns: (count, or None if the listener did not give one)
+    """
+    command = {"count": name}
+    if where:
+        command["query"] = where
+    reply = await session.get(url + "/$cmd", params={"query": jsoncodec.dumpsText(command)})
+    if reply.status_code != 200:
+        return None
+    result = jsoncodec.loads(reply.content)
+    if isinstance(result, list):
+        result = result[0] if result else {}
+    for key in ("count", "n"):
+        if isinstance(result, dict) and key in result:
+            return int(result[key])
+    return None
+
+
+async def planJoin(session, url, spec, strategy=AUTO, buildLimit=DEFAULT_BUILD_LIMIT):
+    """
+    Choose between system.join and a local hash join
+
+    In AUTO, the join runs locally when it is a two-way equi-join and the
+    smaller side has at most buildLimit documents; otherwise the listener
+    joins.
+
+    :returns: (JoinPlan)
+    """
+    split = equalityKeys(spec)
+    if strategy == SERVER or split is None:
+        return JoinPlan(SERVER)
+    left, right, pairs = split
+    collections = spec["$collections"]
+    counts = {}
+    for name in (left, right):
+        counts[name] = await countDocuments(session, url, name, collections[name].get("$where"))
+    if strategy == AUTO and None in counts.values():
+        return JoinPlan(SERVER, counts)
+    if counts[left] is not None and counts[right] is not None and counts[right] < counts[left]:
+        build, probe, keys = right, left, [(b, a) for a, b in pairs]
+    else:
+        build, probe, keys = left, right, pairs
+    if strategy == AUTO and counts[build] > buildLimit:
+        return JoinPlan(SERVER, counts)
+    return JoinPlan(LOCAL, counts, build, probe, keys)
+
+
+def _project(doc, projection):
+    if not projection:
+        return doc
+    return dict((field, doc[field]) for field in projection if projection[field] and field in doc)
+
+
+def _fetchFields(projection, keyFields):
+    """
+    The projected fields plus the join keys, which the probe and build need
+    """
+    if not projection:
+        return None
+    fields = dict((field, 1) for field in projection if projection[field])
+    for field in keyFields:
+        fields[field] = 1
+    return fields
+
+
+async def aiterJoin(session, url, spec, strategy=AUTO, buildLimit=DEFAULT_BUILD_LIMIT,
+                    batchSize=None, plan=None, tuner=None):
+    """
+    Join collections and tables described by a system.join spec
+
+    The local path loads the build side into a hash table keyed on the join
+    fields and streams the probe side past it batch by batch, so memory is
+    bounded by the build side. Each result merges the projected fields of the
+    probe document and of its matching build document.
+
+    :param url: (database url)
+    :param tuner: (BatchTuner for the batch sizes of the queries, when batchSize is None)
+    :returns: (async generator of joined documents)
+    """
+    if plan is None:
+        plan = await planJoin(session, url, spec, strategy, buildLimit)
+    if plan.strategy == SERVER:
+        async for doc in aiterQuery(session, url + "/system.join", query=spec, batchSize=batchSize, tuner=tuner):
+            yield doc
+        return
+
+    collections = spec["$collections"]
+    buildSpec = collections[plan.build]
+    probeSpec = collections[plan.probe]
+    buildFields = [build for build, probe in plan.keys]
+    probeFields = [probe for build, probe in plan.keys]
+
+    table = {}
+    async for doc in aiterQuery(session, url + "/" + plan.build, query=buildSpec.get("$where"),
+                                fields=_fetchFields(buildSpec.get("$project"), buildFields),
+                                batchSize=batchSize, tuner=tuner):
+        try:
+            key = tuple(doc[field] for field in buildFields)
+        except KeyError:
+            continue
+        table.setdefault(key, []).append(_project(doc, buildSpec.get("$project")))
+
+    async for doc in aiterQuery(session, url + "/" + plan.probe, query=probeSpec.get("$where"),
+                                fields=_fetchFields(probeSpec.get("$project"), probeFields),
+                                batchSize=batchSize, tuner=tuner):
+        try:
+            key = tuple(doc[field] for field in probeFields)
+        except KeyError:
+            continue
+        matches = table.get(key)
+        if not matches:
+            continue
+        projected = _project(doc, probeSpec.get("$project"))
+        for match in matches:
+            joined = dict(projected)
+            joined.update(match)
+            yield joined
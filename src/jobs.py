@@ -0,0 +1,167 @@
+##
+# Background jobs: sample runs that outlive the request that submitted them
+##
+
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from steprunner import StepsCancelled
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class QueueFull(Exception):
+    """
+    Too many jobs are waiting for a worker; submit again later
+    """
+
+
+class Job:
+    """
+    One submitted run. func is called as func(emit, cancelled): it passes
+    every output line to emit as soon as it is produced and stops starting
+    new work once cancelled() returns True.
+    """
+    def __init__(self, func):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.state = QUEUED
+        self.lines = []
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelRequested = False
+        self.condition = threading.Condition()
+
+    def emit(self, line):
+        with self.condition:
+            self.lines.append(line)
+            self.condition.notify_all()
+
+    def cancelled(self):
+        return self.cancelRequested
+
+    def cancel(self):
+        """
+        A queued job never starts; a running job stops before its next step
+        """
+        with self.condition:
+            if self.state in FINISHED_STATES:
+                return
+            self.cancelRequested = True
+            if self.state == QUEUED:
+                self._finish(CANCELLED)
+
+    def wait(self, offset, timeout):
+        """
+        Block until there are lines past offset or the job has finished
+
+        :returns: (new lines, whether the job has finished)
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.lines) > offset or self.state in FINISHED_STATES, timeout)
+            return self.lines[offset:], self.state in FINISHED_STATES
+
+    def toDict(self, offset=0):
+        with self.condition:
+            return {"id": self.id, "state": self.state, "submitted": self.submitted, "started": self.started,
+                    "finished": self.finished, "error": self.error, "cancelRequested": self.cancelRequested,
+                    "lines": self.lines[offset:], "next": max(offset, len(self.lines))}
+
+    def _finish(self, state):
+        self.state = state
+        self.finished = time.time()
+        self.condition.notify_all()
+
+    def _run(self):
+        with self.condition:
+            if self.state != QUEUED:
+                return
+            self.state = RUNNING
+            self.started = time.time()
+        try:
+            self.func(self.emit, self.cancelled)
+        except StepsCancelled:
+            with self.condition:
+                self._finish(CANCELLED)
+        except Exception as e:
+            logging.exception(e)
+            with self.condition:
+                self.error = str(e)
+                self.lines.append("EXCEPTION (see log for details): " + str(e))
+                self._finish(FAILED)
+        else:
+            with self.condition:
+                self._finish(DONE)
+
+
+class JobQueue:
+    """
+    Bounded pool of workers that run jobs in submission order.
+
+    At most maxQueued jobs wait for a worker; finished jobs are kept for
+    retention seconds so their output can still be fetched.
+    """
+    def __init__(self, workers=2, maxQueued=8, retention=600.0):
+        self.maxQueued = maxQueued
+        self.retention = retention
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, func):
+        """
+        :returns: (Job)
+        :raises QueueFull: (maxQueued jobs are already waiting)
+        """
+        with self.lock:
+            self._expire()
+            queued = sum(1 for job in self.jobs.values() if job.state == QUEUED)
+            if queued >= self.maxQueued:
+                raise QueueFull("%d jobs are already queued" % queued)
+            job = Job(func)
+            self.jobs[job.id] = job
+        self.executor.submit(job._run)
+        return job
+
+    def get(self, jobId):
+        """
+        :returns: (Job, or None if unknown or expired)
+        """
+        with self.lock:
+            self._expire()
+            return self.jobs.get(jobId)
+
+    def stats(self):
+        with self.lock:
+            counts = dict((state, 0) for state in (QUEUED, RUNNING) + FINISHED_STATES)
+            for job in self.jobs.values():
+                counts[job.state] += 1
+            return counts
+
+    def shutdown(self):
+        """
+        Cancel every job, then wait for the running ones to stop
+        """
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            job.cancel()
+        self.executor.shutdown(wait=True)
+
+    def _expire(self):
+        now = time.time()
+        for jobId, job in list(self.jobs.items()):
+            if job.finished is not None and job.finished + self.retention < now:
+                del self.jobs[jobId]
@@ -0,0 +1,60 @@
+##
+# JSON codec used for every listener request body and reply
+#
+# The fastest available backend is picked at import time: orjson, then ujson,
+# then the standard library. Set JSON_CODEC to force one of them.
+##
+
+import json
+import os
+
+
+def _orjson():
+    import orjson
+    return orjson.dumps, orjson.loads
+
+
+def _ujson():
+    import ujson
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode("utf-8")
+    return dumps, ujson.loads
+
+
+def _stdlib():
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return dumps, json.loads
+
+
+BACKENDS = (("orjson", _orjson), ("ujson", _ujson), ("json", _stdlib))
+
+
+def loadBackend(name=None):
+    """
+    Load the named backend, or the first one that is installed
+
+    :returns: (name, dumps, loads)
+    """
+    for backendName, load in BACKENDS:
+        if name and name != backendName:
+            continue
+        try:
+            dumps, loads = load()
+        except ImportError:
+            if name:
+                raise
+            continue
+        return backendName, dumps, loads
+    raise ValueError("Unknown JSON codec " + str(name))
+
+
+# dumps(obj) encodes straight to UTF-8 JSON bytes; loads(data) decodes bytes or str
+BACKEND, dumps, loads = loadBackend(os.getenv('JSON_CODEC'))
+
+
+def dumpsText(obj):
+    """
+    Encode obj as a JSON str, for url query parameters
+    """
+    return dumps(obj).decode("utf-8")
@@ -0,0 +1,343 @@
+##
+# Declarative plans of listener operations, merged into fewer round trips
+#
+# A plan is a list of operations. runPlan() merges neighbouring operations
+# that the listener can carry out in one call, sends the calls in order and
+# reports the outcome of every operation in plan order. Only operations and
+# groups created with merge=True are merged, so a plan can keep the calls it
+# means to show as they are written.
+#
+# Merge modes:
+#   none     one call per operation, as written
+#   inserts  neighbouring inserts into the same collection or table are sent
+#            as one multiple-document insert
+#   all      also runs each Group and committed Transaction as one
+#            {"transaction": "execute", "commands": [...]} command; if the
+#            listener rejects it, the operations are sent one by one instead
+##
+
+import math
+
+import jsoncodec
+from bulkload import DEFAULT_BATCH_SIZE, SUCCESS_CODES, bulkInsert
+from city import City, CityBatch
+
+NONE = "none"
+INSERTS = "inserts"
+ALL = "all"
+
+
+class Operation:
+    """
+    One listener call as written in a plan.
+
+    header lines are output before the outcome. On success, done is output,
+    formatted with n (documents affected) and reply (the decoded reply); on
+    failure, error is reported with the listener's reply. With merge, the
+    operation may share a call with its neighbours.
+    """
+    def __init__(self, done, error, header=(), merge=False):
+        self.done = done
+        self.error = error
+        self.header = list(header)
+        self.merge = merge
+
+    def calls(self):
+        """
+        :returns: (round trips when sent on its own)
+        """
+        return 1
+
+    def asCommand(self):
+        """
+        :returns: (the operation as a command document for transaction execute, or None)
+        """
+        return None
+
+    def report(self, output, n=None, reply=None):
+        output.append(self.done.format(n=n, reply=reply))
+
+
+class Insert(Operation):
+    def __init__(self, name, documents, done="Inserted {n} documents", error="Unable to insert documents",
+                 header=(), merge=False):
+        Operation.__init__(self, done, error, header, merge)
+        self.name = name
+        self.documents = list(documents)
+
+    def calls(self):
+        return max(1, int(math.ceil(len(self.documents) / float(DEFAULT_BATCH_SIZE))))
+
+    def asCommand(self):
+        documents = [doc.toDict() if hasattr(doc, "toDict") else doc for doc in self.documents]
+        return {"insert": self.name, "documents": documents}
+
+
+class Command(Operation):
+    """
+    A $cmd command, such as create, drop or transaction
+    """
+    def __init__(self, command, done, error, header=()):
+        Operation.__init__(self, done, error, header)
+        self.command = command
+
+    def asCommand(self):
+        return self.command
+
+
+class Sql(Operation):
+    """
+    One statement through system.sql, which takes a single statement per call
+    """
+    def __init__(self, statement, done, error, header=()):
+        Operation.__init__(self, done, error, header)
+        self.statement = statement
+
+
+class Find(Operation):
+    """
+    A query whose documents are output one per line after done
+    """
+    def __init__(self, name, done="query result: ", error="Unable to query documents in collection",
+                 header=()):
+        Operation.__init__(self, done, error, header)
+        self.name = name
+
+    def report(self, output, n=None, reply=None):
+        output.append(self.done)
+        for doc in reply:
+            output.append(str(doc))
+
+
+class Group:
+    """
+    Operations that may be carried out atomically in one call, with merge
+    """
+    def __init__(self, operations, merge=False):
+        self.operations = list(operations)
+        self.merge = merge
+        self.then = []
+
+
+class Transaction(Group):
+    """
+    Operations inside an explicit listener transaction that is committed, or
+    rolled back when commit is False. then are operations sent after the
+    commit or rollback, while transactions are still enabled. Neighbouring
+    transactions share one enable and disable.
+    """
+    def __init__(self, operations, commit=True, then=(), merge=False):
+        Group.__init__(self, operations, merge)
+        self.commit = commit
+        self.then = list(then)
+
+
+def _transactionCommand(action, done, error):
+    return Command({"transaction": action}, done, error)
+
+
+def _explicit(transaction, enable, disable):
+    """
+    A transaction spelled out as its enable, commit or rollback and disable commands
+
+    :returns: ([Operation])
+    """
+    operations = []
+    if enable:
+        operations.append(_transactionCommand("enable", "Transactions enabled: {reply}",
+                                              "Unable to enable transactions"))
+    operations.extend(transaction.operations)
+    if transaction.commit:
+        operations.append(_transactionCommand("commit", "Transactions committed: {reply}",
+                                              "Unable to commit transactions"))
+    else:
+        operations.append(_transactionCommand("rollback", "Transactions rolled back: {reply}",
+                                              "Unable to roll back transactions"))
+    operations.extend(transaction.then)
+    if disable:
+        operations.append(_transactionCommand("disable", "Transactions disabled",
+                                              "Unable to disable transactions"))
+    return operations
+
+
+def _executable(item):
+    """
+    Whether a Group or Transaction can be sent as one transaction execute command.
+    A rolled back transaction cannot: execute commits when every command succeeds.
+    """
+    if not isinstance(item, Group) or not item.merge or item.then or \
+            (isinstance(item, Transaction) and not item.commit):
+        return False
+    return all(op.asCommand() is not None for op in item.operations)
+
+
+class _Call:
+    """
+    One round trip after merging, standing for one or more operations
+    """
+    def __init__(self, kind, operations, fallback=None):
+        self.kind = kind
+        self.operations = operations
+        # What to send instead if the listener rejects a transaction execute
+        self.fallback = fallback
+
+    def calls(self):
+        if self.kind == "insert":
+            return max(1, int(math.ceil(sum(len(op.documents) for op in self.operations)
+                                        / float(DEFAULT_BATCH_SIZE))))
+        return 1
+
+
+def mergeCalls(plan, mode=INSERTS):
+    """
+    :returns: ([_Call] in plan order)
+    """
+    merged = [mode == ALL and _executable(item) for item in plan]
+
+    def explicit(index):
+        return 0 <= index < len(plan) and isinstance(plan[index], Transaction) and not merged[index]
+
+    calls = []
+    for index, item in enumerate(plan):
+        if merged[index]:
+            calls.append(_Call("execute", item.operations, mergeCalls([item], INSERTS)))
+            continue
+        if isinstance(item, Transaction):
+            # Neighbouring explicit transactions share one enable and disable
+            operations = _explicit(item, not explicit(index - 1), not explicit(index + 1))
+        elif isinstance(item, Group):
+            operations = item.operations
+        else:
+            operations = [item]
+        for operation in operations:
+            previous = calls[-1] if calls else None
+            if isinstance(operation, Insert) and operation.merge and mode != NONE and previous is not None \
+                    and previous.kind == "insert" and previous.operations[-1].merge \
+                    and previous.operations[-1].name == operation.name:
+                previous.operations.append(operation)
+            else:
+                calls.append(_Call("insert" if isinstance(operation, Insert) else "single", [operation]))
+    return calls
+
+
+class PlanReport:
+    def __init__(self, planned, merged):
+        # Round trips with one call per operation, and after merging
+        self.planned = planned
+        self.merged = merged
+        # Round trips actually made, including fallbacks
+        self.sent = 0
+        self.fallbacks = 0
+
+
+async def runPlan(session, url, plan, output, printError, mode=INSERTS):
+    """
+    Carry out a plan against the listener
+
+    Operations run one after another, so later operations see the effect of
+    earlier ones. Every operation reports its header and outcome in plan
+    order whether or not it was merged.
+
+    :param url: (database url)
+    :param plan: ([Operation, Group or Transaction])
+    :param printError: (called as printError(output, message, reply) for a failed operation)
+    :returns: (PlanReport)
+    """
+    calls = mergeCalls(plan, mode)
+    report = PlanReport(sum(call.calls() for call in mergeCalls(plan, NONE)), sum(call.calls() for call in calls))
+    for call in calls:
+        await _send(session, url, call, output, printError, report)
+    return report
+
+
+async def _send(session, url, call, output, printError, report):
+    if call.kind == "insert":
+        await _sendInsert(session, url, call.operations, output, printError, report)
+        return
+    if call.kind == "execute":
+        command = {"transaction": "execute", "commands": [op.asCommand() for op in call.operations]}
+        reply = await session.get(url + "/$cmd", params={"query": jsoncodec.dumpsText(command)})
+        report.sent += 1
+        if reply.status_code != 200:
+            report.fallbacks += 1
+            for fallback in call.fallback:
+                await _send(session, url, fallback, output, printError, report)
+            return
+        result = jsoncodec.loads(reply.content)
+        results = _commandResults(result, len(call.operations))
+        for op, opResult in zip(call.operations, results):
+            output.extend(op.header)
+            n = None
+            if isinstance(op, Insert):
+                # Execute commits only when every command succeeds: without a count, all were inserted
+                n = opResult.get("n", len(op.documents)) if isinstance(opResult, dict) else len(op.documents)
+            op.report(output, n, result)
+        output.append("Transaction executed: " + str(result))
+        return
+
+    op = call.operations[0]
+    output.extend(op.header)
+    if isinstance(op, Command):
+        reply = await session.get(url + "/$cmd", params={"query": jsoncodec.dumpsText(op.command)})
+    elif isinstance(op, Sql):
+        reply = await session.get(url + "/system.sql", params={"query": jsoncodec.dumpsText({"$sql": op.statement})})
+    else:
+        reply = await session.get(url + "/" + op.name)
+    report.sent += 1
+    if reply.status_code != 200:
+        printError(output, op.error, reply)
+        return
+    result = jsoncodec.loads(reply.content)
+    n = result.get("n") if isinstance(result, dict) else None
+    op.report(output, n, result)
+
+
+def _commandResults(result, count):
+    """
+    The result of every command of a transaction execute, where the listener reports them
+
+    :returns: ([dict or None] of length count)
+    """
+    if isinstance(result, list) and len(result) == 1:
+        result = result[0]
+    results = result.get("results") if isinstance(result, dict) else None
+    if not isinstance(results, list) or len(results) != count:
+        return [None] * count
+    return results
+
+
+async def _sendInsert(session, url, operations, output, printError, report):
+    documents = []
+    for op in operations:
+        documents.extend(op.documents)
+    if all(isinstance(document, City) for document in documents):
+        documents = CityBatch(documents)
+    result = await bulkInsert(session, url + "/" + operations[0].name, documents)
+    report.sent += len(result.batches)
+
+    # Batches hold consecutive documents; an operation failed if any of its documents' batches did
+    start = 0
+    for op in operations:
+        end = start + len(op.documents)
+        failed = None
+        n = 0
+        first = 0
+        for batch in result.batches:
+            last = first + batch.count
+            if first < end and last > start:
+                if not batch.ok:
+                    failed = batch
+                    break
+                # The listener's n, or this operation's share of a batch it confirmed in full
+                n += batch.inserted if start <= first and last <= end else min(end, last) - max(start, first)
+            first = last
+        output.extend(op.header)
+        if failed is None:
+            op.report(output, n)
+        elif failed.reply is None:
+            output.append("Error: " + op.error + ": " + failed.error)
+        elif failed.reply.status_code in SUCCESS_CODES:
+            output.append("Error: %s: inserted %d of %d" % (op.error, failed.inserted, failed.count))
+        else:
+            printError(output, op.error, failed.reply)
+        start = end
@@ -0,0 +1,268 @@
+##
+# Relay listener replies to the HTTP client without decoding them
+#
+# Query, join and catalog replies are JSON arrays. relayArray() streams the
+# bytes of every page of a result as a single array, cutting only the
+# brackets where pages meet. toNdjson() reframes such an array as one element
+# per line by following nesting and strings, without decoding any value.
+##
+
+import re
+
+from querystream import CHUNK_SIZE, QueryError
+from restclient import CURSOR_COOKIES
+
+_STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+_SCALAR = rb'[^\s,\[\]{}"]+'
+
+
+def _containers(levels):
+    """
+    Pattern of an object or array nested at most levels deep
+
+    Every loop alternates a run of plain bytes with a string or a nested
+    container, so a failed match backtracks in linear time.
+    """
+    run = rb'[^\[\]{}"]*'
+    item = _STRING
+    for level in range(levels):
+        pattern = (rb"\{" + run + rb"(?:(?:" + item + rb")" + run + rb")*\}|"
+                   rb"\[" + run + rb"(?:(?:" + item + rb")" + run + rb")*\]")
+        item = _STRING + rb"|" + pattern
+    return pattern
+
+
+# A whole array element and the comma or bracket after it, matched in one call.
+# Compiled on first use by _elementPattern(), as it takes longer than the rest
+# of importing this module.
+_ELEMENT = None
+_OPEN = re.compile(rb"\s*\[")
+_START = re.compile(rb"\s*(\S)")
+_SEPARATOR = re.compile(rb"\s*([,\]])")
+_SCALAR_END = re.compile(rb'[^\s,\[\]{}"]*')
+_OUTSIDE_STRING = re.compile(rb'["{}\[\]]')
+_INSIDE_STRING = re.compile(rb'["\\]')
+
+
+def _elementPattern():
+    global _ELEMENT
+    if _ELEMENT is None:
+        _ELEMENT = re.compile(rb"\s*(" + _STRING + rb"|" + _containers(4) + rb"|" + _SCALAR + rb")\s*([,\]])")
+    return _ELEMENT
+
+
+def _arrayContents(chunks):
+    """
+    The bytes between the outer [ and ] of one JSON array reply
+
+    Chunks are passed on as they arrived; only the first and the last are
+    cut, and a chunk is held back only until the next one shows it is not
+    the last.
+
+    :returns: (generator of bytes)
+    """
+    chunks = iter(chunks)
+    head = b""
+    for chunk in chunks:
+        head = (head + chunk).lstrip()
+        if head:
+            break
+    if not head.startswith(b"["):
+        raise ValueError("Listener reply is not a JSON array")
+    pending = head[1:]
+    for chunk in chunks:
+        if chunk.isspace():
+            pending += chunk
+            continue
+        if pending:
+            yield pending
+        pending = chunk
+    pending = pending.rstrip()
+    if not pending.endswith(b"]"):
+        raise ValueError("Truncated JSON array")
+    if len(pending) > 1:
+        yield pending[:-1]
+
+
+def relayArray(session, url, params=None, reply=None):
+    """
+    Stream a query, join or catalog result as the bytes of one JSON array
+
+    Every page is read with iter_content and follows the listener's cursor
+    cookie, as iterQuery does, but no document is decoded: only the
+    whitespace around the brackets between pages is looked at.
+
+    :param session: (ListenerSession)
+    :param params: (listener query string parameters, passed on unchanged)
+    :param reply: (the first page, if already requested with stream=True)
+    :returns: (generator of bytes)
+    """
+    if reply is None:
+        reply = session.get(url, params=params, stream=True)
+    yield b"["
+    elements = False
+    while True:
+        if reply.status_code != 200:
+            reply.close()
+            raise QueryError(reply)
+        page = False
+        try:
+            contents = _arrayContents(reply.iter_content(CHUNK_SIZE))
+            for chunk in contents:
+                if not page:
+                    # An empty page is whitespace only; hold it back until that is known
+                    if not chunk or chunk.isspace():
+                        continue
+                    if elements:
+                        yield b","
+                    page = elements = True
+                yield chunk
+        finally:
+            reply.close()
+        cookies = dict((name, reply.cookies[name]) for name in CURSOR_COOKIES if name in reply.cookies)
+        if not page or not cookies:
+            break
+        reply = session.get(url, params=params, cookies=cookies, stream=True)
+    yield b"]"
+
+
+def _oneLine(piece):
+    # Raw line breaks cannot occur inside JSON strings, so any in an element are whitespace
+    if b"\n" in piece or b"\r" in piece:
+        return piece.replace(b"\r", b" ").replace(b"\n", b" ")
+    return piece
+
+
+def _joinLines(lines):
+    if not lines:
+        return b""
+    joined = b"\n".join(lines)
+    # Line breaks other than the separators are rare; only then look at each element
+    if joined.count(b"\n") != len(lines) - 1 or b"\r" in joined:
+        joined = b"\n".join(_oneLine(line) for line in lines)
+    return joined + b"\n"
+
+
+def _scan(buffer, state):
+    """
+    Follow one element byte by byte, for elements the single pattern cannot
+    match: nested too deeply, or cut by the end of the buffer so far
+
+    :param state: ([offset, depth, in string, after backslash], updated in place)
+    :returns: (index just past the element, or None if the buffer ends first)
+    """
+    offset, depth, inString, escape = state
+    end = len(buffer)
+    if depth == 0 and not inString and buffer[offset:offset + 1] not in (b"{", b"[", b'"'):
+        stop = _SCALAR_END.match(buffer, offset).end()
+        return stop if stop < end else None
+    while offset < end:
+        if escape:
+            escape = False
+            offset += 1
+            continue
+        if inString:
+            match = _INSIDE_STRING.search(buffer, offset)
+            if match is None:
+                offset = end
+                break
+            offset = match.end()
+            if match.group() == b"\\":
+                escape = True
+            else:
+                inString = False
+                if depth == 0:
+                    return offset
+            continue
+        match = _OUTSIDE_STRING.search(buffer, offset)
+        if match is None:
+            offset = end
+            break
+        offset = match.end()
+        char = match.group()
+        if char == b'"':
+            inString = True
+        elif char in (b"{", b"["):
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return offset
+    state[:] = [offset, depth, inString, escape]
+    return None
+
+
+def toNdjson(chunks):
+    """
+    Reframe the bytes of a JSON array as newline-delimited JSON
+
+    Elements are copied through byte for byte, minus the whitespace between
+    them and with line breaks turned into spaces. Each element is found by
+    one regular expression match; only an element cut by a chunk boundary or
+    nested more than four levels deep is followed bracket by bracket.
+
+    :returns: (generator of bytes)
+    """
+    element = _elementPattern()
+    buffer = b""
+    pos = 0
+    opened = False
+    # Progress through an element the pattern did not match, and where it ended
+    state = None
+    elementEnd = None
+    for chunk in chunks:
+        # Keep the unfinished element only; offsets move with it
+        if state is not None:
+            state[0] -= pos
+        if elementEnd is not None:
+            elementEnd -= pos
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        if not opened:
+            if not buffer or buffer.isspace():
+                continue
+            match = _OPEN.match(buffer)
+            if match is None:
+                raise ValueError("Listener reply is not a JSON array")
+            pos = match.end()
+            opened = True
+        # Lines found in this chunk go out together
+        lines = []
+        while True:
+            if state is None and elementEnd is None:
+                # Consecutive complete elements, matched without returning to Python in between
+                match = None
+                for match in iter(element.scanner(buffer, pos).match, None):
+                    lines.append(match.group(1))
+                if match is not None:
+                    pos = match.end()
+                    if match.group(2) == b"]":
+                        yield _joinLines(lines)
+                        return
+                match = _START.match(buffer, pos)
+                if match is None:
+                    break
+                if match.group(1) == b"]":
+                    yield _joinLines(lines)
+                    return
+                pos = match.start(1)
+                state = [pos, 0, False, False]
+            if elementEnd is None:
+                elementEnd = _scan(buffer, state)
+                if elementEnd is None:
+                    break
+                state = None
+            match = _SEPARATOR.match(buffer, elementEnd)
+            if match is None:
+                if buffer[elementEnd:].strip():
+                    raise ValueError("Unexpected data after element of JSON array")
+                break
+            lines.append(buffer[pos:elementEnd])
+            pos = match.end()
+            elementEnd = None
+            if match.group(1) == b"]":
+                yield _joinLines(lines)
+                return
+        if lines:
+            yield _joinLines(lines)
+    raise ValueError("Truncated JSON array")
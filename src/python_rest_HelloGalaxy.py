@@ -36,11 +36,35 @@
 # 10 List collections in a database
 # 11 Drop a collection
 
+import asyncio
+import io
 import logging
-import json
 import os
-import requests
-from flask import Flask, render_template
+import re
+import signal
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, render_template, request
+from bulkmutate import bulkMutate
+import city
+from city import City
+from batchtuner import BatchTuner
+import config
+from columnar import (CsvWriter, GroupAggregate, ParquetWriter, SchemaChanged, iterColumnBatches, parquetAvailable,
+                      schemaFromColumns)
+from hashjoin import aiterJoin
+from jobs import JobQueue, QueueFull
+import jsoncodec
+from metrics import ListenerMetrics
+from opplan import Command, Find, Group, Insert, Sql, Transaction, runPlan
+from passthrough import relayArray, toNdjson
+from querystream import DEFAULT_BATCH_SIZE, QueryError, aiterQuery, iterQuery
+from restclient import AsyncListenerSession, RestClient
+from resilience import CircuitBreaker, Hedger, Timeouts, parseTimeouts
+from resultcache import ResultCache
+from snapshot import SnapshotStore, parseSnapshots
+from steprunner import Step, runSteps
+from tenants import makeTenants, runTenants
 
 app = Flask(__name__)
 
@@ -51,46 +75,154 @@ URL = ""
 USE_SSL = False     # Set to True to use SSL url from VCAP_SERVICES
 SERVICE_NAME = os.getenv('SERVICE_NAME', 'timeseriesdatabase')
 port = int(os.getenv('VCAP_APP_PORT', 8080))
+# Seconds a listener endpoint that could not be connected to is passed over in
+# favour of the next one: the other url of the instance, then other instances
+FAILOVER_RETRY_AFTER = float(os.getenv('FAILOVER_RETRY_AFTER', 30))
+# Seconds /health waits for each endpoint to answer
+HEALTH_TIMEOUT = float(os.getenv('HEALTH_TIMEOUT', 5))
+
+# Connection pool settings for the REST listener client
+POOL_SIZE = int(os.getenv('REST_POOL_SIZE', 10))
+KEEP_ALIVE = os.getenv('REST_KEEP_ALIVE', 'true').lower() != 'false'
+RETRIES = int(os.getenv('REST_RETRIES', 3))
+RETRY_BACKOFF = float(os.getenv('REST_RETRY_BACKOFF', 0.2))
+# Seconds to connect to the listener and to wait for each part of a reply, per attempt.
+# REST_TIMEOUTS sets the read timeout of some operations, e.g. "sql=120,join=60".
+CONNECT_TIMEOUT = float(os.getenv('REST_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.getenv('REST_READ_TIMEOUT', 30))
+OPERATION_TIMEOUTS = parseTimeouts(os.getenv('REST_TIMEOUTS', ''))
+# Calls of one operation to one endpoint that fail in a row before the circuit opens (0 turns
+# circuits off), seconds it stays open, and trial calls let through when it is half open
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', 5))
+BREAKER_RESET = float(os.getenv('BREAKER_RESET', 30))
+BREAKER_HALF_OPEN_CALLS = int(os.getenv('BREAKER_HALF_OPEN_CALLS', 1))
+# Send a find, count, distinct or catalog read a second time when it is slower than the
+# HEDGE_PERCENTILE of recent reads like it, for at most HEDGE_MAX_RATIO of all reads
+HEDGE_READS = os.getenv('HEDGE_READS', 'false').lower() == 'true'
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 0.95))
+HEDGE_MAX_RATIO = float(os.getenv('HEDGE_MAX_RATIO', 0.1))
+# Number of listener replies kept by the read cache, 0 disables it
+CACHE_SIZE = int(os.getenv('CACHE_SIZE', 256))
+# Query batch sizes start at 100 documents and are tuned per collection and query shape
+# so that a batch takes about BATCH_TARGET_SECONDS and holds at most BATCH_MAX_BYTES
+BATCH_TUNING = os.getenv('BATCH_TUNING', 'true').lower() != 'false'
+BATCH_TARGET_SECONDS = float(os.getenv('BATCH_TARGET_SECONDS', 0.25))
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', 4 * 1024 * 1024))
+# Collections and tables answered from an in-process snapshot, e.g.
+# "*codeTable=countryCode;*pythonRESTGalaxy=countryCode,longitude": names (with * wildcards)
+# and the fields to index. Empty, the default, turns snapshots off. They are reloaded
+# every SNAPSHOT_REFRESH seconds and not kept above SNAPSHOT_MAX_DOCUMENTS documents.
+SNAPSHOTS = parseSnapshots(os.getenv('SNAPSHOTS', ''))
+SNAPSHOT_REFRESH = float(os.getenv('SNAPSHOT_REFRESH', 300))
+SNAPSHOT_MAX_DOCUMENTS = int(os.getenv('SNAPSHOT_MAX_DOCUMENTS', 50000))
+# Where joins run: "server" (system.join), "local" (hash join in this process) or "auto"
+JOIN_STRATEGY = os.getenv('JOIN_STRATEGY', 'auto')
+# In "auto", join locally when the smaller side has at most this many documents
+JOIN_BUILD_LIMIT = int(os.getenv('JOIN_BUILD_LIMIT', 10000))
+# Maximum number of independent steps of one run that call the listener at the same time
+MAX_CONCURRENCY = int(os.getenv('MAX_CONCURRENCY', 4))
+# How the setup operations of the steps (the table creation and the cityTable rows) are merged
+# into fewer listener calls: "none", "inserts" (multiple-document inserts) or "all" (also
+# transaction execute batches). The calls the sample demonstrates are always sent as written.
+PLAN_MERGE = os.getenv('PLAN_MERGE', 'inserts')
+# Background runs of /databasetest?background=1: worker threads, runs allowed to wait
+# for a worker, and seconds a finished run's output is kept
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 8))
+JOB_RETENTION = float(os.getenv('JOB_RETENTION', 600))
+# /tenanttest: comma separated database urls to spread copies over (default: the sample's url),
+# and how many copies run at the same time
+TENANT_URLS = [url for url in os.getenv('TENANT_URLS', '').split(',') if url]
+TENANT_WORKERS = int(os.getenv('TENANT_WORKERS', 4))
+MAX_TENANTS = int(os.getenv('MAX_TENANTS', 16))
+
+# Prefix for the names of the collections and tables of one run: a valid identifier start
+NAMESPACE_PATTERN = re.compile("^([A-Za-z_][A-Za-z0-9_]*)?$")
+
+# Shared by every request to /databasetest so listener connections are reused.
+# Created by initClient(), once per process: a forked server worker must not
+# share the parent's sockets or threads.
+cache = None
+# Batch sizes of queries, tuned per collection and query shape and kept across requests
+tuner = None
+# Snapshots of the collections and tables in SNAPSHOTS
+snapshots = None
+metrics = None
+client = None
+# Threads that carry out the listener calls of concurrent steps, shared like the client
+executor = None
+# Background runs of the sample
+jobs = None
+# Process that created the objects above: a process forked from it must create its own
+clientPid = None
+
+def initClient():
+    """
+    Create this process's listener client, read cache, metrics and executor
+    """
+    global cache, tuner, snapshots, metrics, client, executor, jobs, clientPid
+    clientPid = os.getpid()
+    cache = ResultCache(maxSize=CACHE_SIZE) if CACHE_SIZE else None
+    tuner = BatchTuner(default=DEFAULT_BATCH_SIZE, targetSeconds=BATCH_TARGET_SECONDS,
+                       maxBytes=BATCH_MAX_BYTES) if BATCH_TUNING else None
+    snapshots = SnapshotStore(SNAPSHOTS, maxDocuments=SNAPSHOT_MAX_DOCUMENTS,
+                              refreshSeconds=SNAPSHOT_REFRESH) if SNAPSHOTS else None
+    metrics = ListenerMetrics()
+    breaker = CircuitBreaker(failures=BREAKER_FAILURES, resetSeconds=BREAKER_RESET,
+                             halfOpenCalls=BREAKER_HALF_OPEN_CALLS) if BREAKER_FAILURES else None
+    hedger = Hedger(percentile=HEDGE_PERCENTILE, maxRatio=HEDGE_MAX_RATIO) if HEDGE_READS else None
+    client = RestClient(poolSize=POOL_SIZE, keepAlive=KEEP_ALIVE, retries=RETRIES, backoffFactor=RETRY_BACKOFF,
+                        cache=cache, metrics=metrics, health=config, snapshots=snapshots,
+                        timeouts=Timeouts(CONNECT_TIMEOUT, READ_TIMEOUT, OPERATION_TIMEOUTS), breaker=breaker,
+                        hedger=hedger)
+    if snapshots is not None:
+        snapshots.start(client)
+    executor = ThreadPoolExecutor(max_workers=POOL_SIZE)
+    jobs = JobQueue(workers=JOB_WORKERS, maxQueued=JOB_QUEUE_SIZE, retention=JOB_RETENTION)
+
+def ensureClient():
+    """
+    Create this process's listener client unless it already has one: a process
+    that imported the application has one, a process forked from one has not
+    """
+    if clientPid != os.getpid():
+        initClient()
+
+def closeClient():
+    """
+    Cancel background runs and wait for listener calls in flight to finish,
+    then close the connection pool
+    """
+    if jobs is not None:
+        jobs.shutdown()
+    if executor is not None:
+        executor.shutdown(wait=True)
+    if snapshots is not None:
+        snapshots.stop()
+    if client is not None:
+        client.close()
+
+initClient()
 
 def getDatabaseUrl():
     """
     Get database url
     
+    The environment is read on the first call only; after that, this is the
+    first endpoint that is not marked down.
+
     :returns: (url)
     """
-    
-    # Use defaults
-    if URL :
-        return URL
-    
-    # Parse database info from VCAP_SERVICES
-    if (os.getenv('VCAP_SERVICES') is None):
-        raise Exception("VCAP_SERVICES not set in the environment")
-    vcap_services = json.loads(os.environ['VCAP_SERVICES'])
-    try:
-        tsdb = vcap_services[SERVICE_NAME][0]
-        credentials = tsdb['credentials']
-        if USE_SSL:
-            url = credentials['rest_url_ssl']
-        else:
-            url = credentials['rest_url']
-        return url
-    except KeyError as e:
-        logging.error(e)
-        raise Exception("Error parsing VCAP_SERVICES. Key " + str(e) + " not found.")
+    return config.getResolver(URL, SERVICE_NAME, USE_SSL, FAILOVER_RETRY_AFTER).url()
+
+def reloadConfig(signum=None, frame=None):
+    """
+    Read URL or VCAP_SERVICES again on the next request, e.g. on SIGHUP
+    """
+    config.reload()
+    logging.info("Listener configuration will be read again")
 
          
-class City:
-    def __init__(self, name, population, longitude, latitude, countryCode):
-        self.name = name
-        self.population = population
-        self.longitude = longitude
-        self.latitude = latitude
-        self.countryCode = countryCode
-    def toJSON(self):
-        return json.loads("{\"name\" : \"%s\" , \"population\" : %d , \"longitude\" : %.4f , \"latitude\" : %.4f , \"countryCode\" : %d}"
-                      %(self.name, self.population, self.longitude, self.latitude, self.countryCode))
-        
 kansasCity = City("Kansas City", 467007, 39.0997, 94.5783, 1)
 seattle = City("Seattle", 652405, 47.6097, 122.3331, 1)
 newYork = City("New York", 8406000, 40.7127, 74.0059, 1)
@@ -107,432 +239,457 @@ def printError(output, message, reply):
     output.append("content: " + str(reply.content))
 
 
-def doEverything():
-    # Get database connectivity information
-    url = getDatabaseUrl()
+def doEverything(emit=None, cancelled=None, url=None, namespace=""):
+    """
+    Run the sample against the listener.
 
-    collectionName = "pythonRESTGalaxy"
-    joinCollectionName = "pyRESTJoin"
-    codeTableName = "codeTable"
-    cityTableName = "cityTable"
-    
-    output = []
-    output.append("# 1 Data Structures")
-    output.append( "# 1.1 Create Collection")
-    data = json.dumps({"name": collectionName})
-    reply = requests.post(url, data)
-    # Note: the cookie holds our session id. In order to reuse the same listener session 
-    # on subsequent REST requests, we must set this cookie as part of subsequent requests. 
-    cookies = reply.cookies  
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Created collection")
-    else:        
-        printError(output, "Unable to create collection", reply)
-         
-    data = json.dumps({"name": joinCollectionName})
-    reply = requests.post(url, data, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Created collection")
-    else:
-        printError(output, "Unable to create collection", reply)
-     
-    output.append("# 1.2 Create Table")
-    data = json.dumps({"create" : codeTableName, "columns":[{"name":"countryCode","type":"int"},
-                                                                        {"name": "countryName", "type": "varchar(50)"}]})
-     
-    reply = requests.get(url + "/$cmd", data, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Created Table: " + codeTableName)
-    else:
-        printError(output, "Unable to create table", reply)
-     
-    data= json.dumps({"create" : cityTableName, "columns":[{"name":"name","type":"varchar(50)"},
-                                                               {"name": "population", "type": "int"}, 
-                                                               {"name": "longitude", "type": "decimal(8,4)"},
-                                                               {"name": "latitude", "type": "decimal(8,4)"}, 
-                                                               {"name": "countryCode", "type": "int"}]})
-     
-    reply = requests.get(url + "/$cmd", data, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Created Table: " + cityTableName)
-    else:
-        printError(output, "Unable to create table", reply)
-         
-    output.append("# 2 Inserts")
-    output.append( "# 2.1 Insert a single document to a collection")
-    data = json.dumps(kansasCity.toJSON())
-    reply = requests.post(url + "/" + collectionName, data, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Inserted " + str(doc.get('n')) + " document")
-    else:
-        printError(output, "Unable to insert document", reply)
-         
-    reply = requests.post(url + "/" + cityTableName, data, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Inserted " + str(doc.get('n')) + " document")
-    else:
-        printError(output, "Unable to insert document", reply)
-     
-    output.append("# 2.2 Insert multiple documents to a collection")
-    data = json.dumps([seattle.toJSON(), newYork.toJSON(), london.toJSON(), tokyo.toJSON(), madrid.toJSON()])
-    reply = requests.post(url + "/" + collectionName, data, cookies=cookies)
-    if reply.status_code == 202:
-        doc = reply.json()
-        output.append("Inserted " + str(doc.get('n')) + " documents")
-    else:
-        printError(output, "Unable to insert multiple documents", reply)
-         
-    data = json.dumps([seattle.toJSON(), newYork.toJSON(), london.toJSON(), tokyo.toJSON(), madrid.toJSON()])
-    reply = requests.post(url + "/" + cityTableName, data, cookies=cookies)
-    if reply.status_code == 202:
-        doc = reply.json()
-        output.append("Inserted " + str(doc.get('n')) + " documents")
-    else:
-        printError(output, "Unable to insert multiple documents", reply)
- 
-    output.append("# 3 Queries")
-    output.append("# 3.1 Find a document in a collection that matches a query condition")
-    query = json.dumps({"longitude": {"$gt" : 40.0}})
-    reply = requests.get(url + "/" + collectionName + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Query result: " + str(docs[0]))
-    else:
-        printError(output, "Unable to query documents in collection", reply)
-            
-    output.append("# 3.2 Find all documents in a collection that match a query condition")
-    query = json.dumps({"longitude": {"$gt" : 40.0}})
-    reply = requests.get(url + "/" + collectionName + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Query result: ")
-        for doc in docs:
-            output.append(str(doc))
-    else:
-        printError(output, "Unable to query documents in collection", reply)
-        
-    output.append("# 3.3 Find all documents in a collection")
-    reply = requests.get(url+ "/" + collectionName, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("query result: ")
-        for doc in docs:
-            output.append(str(doc))
-    else:
-        printError(output, "Unable to query documents in collection", reply)
+    Each numbered section is a step. Independent steps run concurrently, at most
+    MAX_CONCURRENCY at a time; the output of every step is still reported in
+    section order.
 
-    output.append("# 3.4 Count documents in a collection")
-    cmd = "$cmd"
-    query = json.dumps({"count": collectionName, "query": {"longitude": {"$lt" : 40.0}}})
-    reply = requests.get(url + "/" + cmd + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Count query result: " + str(docs[0]))
-    else:
-        printError(output, "Unable to count documents in collection", reply)
-
-    output.append("# 3.5 Order documents in a collection")
-    sort = json.dumps({"population": 1})
-    reply = requests.get(url + "/" + collectionName + "?sort=" + sort, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Sorted result: ")
-        for doc in docs:
-            output.append(str(doc))
-    else:
-        printError(output, "Unable to sort documents in collection", reply)
-          
-    output.append("# 3.6 Find distinct values in a collection")
-    cmd = "$cmd"
-    query = json.dumps({"distinct": collectionName, "key": "countryCode", "query": {"longitude": {"$lt" : 40.0}}})
-    reply = requests.get(url + "/" + cmd + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Distinct values: ")
-        for doc in docs:
-            output.append(str(doc))
-    else:
-        output.append("error")
-        printError(output, "Unable to find distinct values in collection", reply)
-      
-    output.append("# 3.7 Join collection")
-    data = json.dumps([{"countryCode" : 1, "countryName" : "United States of America"}, 
-                       {"countryCode" : 44, "countryName" : "United Kingdom"},
-                       {"countryCode" : 81, "countryName" : "Japan"},
-                       {"countryCode" : 34, "countryName" : "Spain"},
-                       {"countryCode" : 61, "countryName" : "Australia"}])
-    reply = requests.post(url + "/" + codeTableName, data, cookies=cookies)
-    if reply.status_code == 202:
-        doc = reply.json()
-        output.append("Inserted " + str(doc.get('n')) + " document")
-    else:
-        printError(output, "Unable to insert documents", reply)
-            
-    reply = requests.post(url + "/" + joinCollectionName, data, cookies=cookies)
-    if reply.status_code == 202:
-        doc = reply.json()
-        output.append("Inserted " + str(doc.get('n')) + " document")
-    else:
-        printError(output, "Unable to insert documents", reply)
-      
-    output.append("# 3.7a Join collection-collection")
-    query = json.dumps({"$collections": {collectionName: {"$project": {"name" : 1, "population" : 1, "longitude": 1, "latitude" : 1}},
-                                         joinCollectionName: {"$project": {"countryCode" : 1, "countryName" : 1}}}, 
-                        "$condition" : {"pythonRESTGalaxy.countryCode" : "pyRESTJoin.countryCode"}})
-    reply = requests.get(url + "/" + "system.join" + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Join collection-collection: ")
-        for doc in docs:
-            output.append(str(doc))
-    else:
-        printError(output, "Unable to join collections", reply)
-                 
-    output.append("# 3.7b Join table-collection")
-    query = json.dumps({"$collections": {collectionName: {"$project": {"name" : 1, "population" : 1, "longitude": 1, "latitude" : 1}},
-                                         codeTableName: {"$project": {"countryCode" : 1, "countryName" : 1}}}, 
-                        "$condition" : {"pythonRESTGalaxy.countryCode" : "codeTable.countryCode"}})
-    reply = requests.get(url + "/" + "system.join" + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Join collection-collection: ")
-        for doc in docs:
-            output.append(str(doc))
-    else:
-        printError(output, "Unable to join collections", reply)
-                   
-    output.append("# 3.7c Join table-table")
-    query = json.dumps({"$collections": {cityTableName: {"$project": {"name" : 1, "population" : 1, "longitude": 1, "latitude" : 1}},
-                                         codeTableName: {"$project": {"countryCode" : 1, "countryName" : 1}}}, 
-                        "$condition" : {"cityTable.countryCode" : "codeTable.countryCode"}})
-    reply = requests.get(url + "/" + "system.join" + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Join table-table: ")
-        for doc in docs:
-            output.append(str(doc))
-    else:
-        printError(output, "Unable to join collections", reply)
-             
-    output.append("#3.8 Batch Size")
-    batchSize = 2
-    reply = requests.get(url + "/" + collectionName + "?batchsize=" + str(batchSize), cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("New batch size: " + str(batchSize))
-    else:
-        printError(output, "Unable to change batch size", reply)
-         
-    output.append("# 3.9 Find all documents in a collection with projection")
-    query = json.dumps({"longitude": {"$gt" : 40.0}})
-    projection = json.dumps({"name" : 1, "population": 1, "_id": 0})
-    reply = requests.get(url + "/" + collectionName + "?query=" + query + "&fields=" + projection)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Query result: ")
-        for doc in docs:
-            output.append(str(doc))
-    else:
-        printError(output, "Unable to query documents in collection", reply)   
-           
-    output.append("# 4 Update documents in a collection")
-    query = json.dumps({'name': seattle.name})
-    data = json.dumps({'$set' : {'countryCode' : 999} })
-    reply = requests.put(url + "/" + collectionName + "?query=" + query, data, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Updated " + str(doc.get('n')) + " documents")
-    else:
-        printError(output, "Unable to update documents in collection", reply)
-           
-    output.append("# 5 Delete documents in a collection")
-    query = json.dumps({'name': tokyo.name})
-    reply = requests.delete(url + "/" + collectionName + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Deleted " + str(doc.get('n')) + " documents")
-    else:
-        printError(output, "Unable to delete documents in collection", reply)      
-            
-    output.append("# 6 SQL Passthrough")
-    query = json.dumps({'$sql': "create table if not exists town (name varchar(255), countryCode int)"})
-    reply = requests.get(url + "/" + "system.sql"+ "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Created table")
-    else:
-        printError(output, "Unable to create table with sql passthrough", reply)
-            
-    query = json.dumps({"$sql": "insert into town values ('Lawrence', 1)"})
-    reply = requests.get(url + "/" + "system.sql"+ "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Inserted " + str(doc) + " document")
-    else:
-        printError(output, "Unable to insert with sql passthrough", reply)
-            
-    query = json.dumps({'$sql': "drop table town"})
-    reply = requests.get(url + "/" + "system.sql"+ "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Dropped table")
-    else:
-        printError(output, "Unable to drop table with sql passthrough", reply)
-            
-    output.append("# 7 Transactions")
+    Every collection and table the run creates is prefixed with namespace, so
+    runs with different namespaces can share a database at the same time.
+
+    :param url: (database url; default: getDatabaseUrl())
+    :param namespace: (prefix of letters, digits and underscores)
+    :param emit: (called with each output line, in order, as soon as it is known)
+    :param cancelled: (checked before each step; once True the run stops with StepsCancelled)
+    :returns: (output lines)
+    """
+    # Get database connectivity information
+    if url is None:
+        url = getDatabaseUrl()
+    if not NAMESPACE_PATTERN.match(namespace):
+        raise ValueError("Invalid namespace " + repr(namespace))
+
+    collectionName = namespace + "pythonRESTGalaxy"
+    joinCollectionName = namespace + "pyRESTJoin"
+    codeTableName = namespace + "codeTable"
+    cityTableName = namespace + "cityTable"
+    townTableName = namespace + "town"
     cmd = "$cmd"
-    query = json.dumps({"transaction": "enable"})
-    reply = requests.get(url + "/" + cmd + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Transactions enabled: " + str(docs))
-    else:
-        printError(output, "Unable to enable transactions", reply)  
-       
-    data = json.dumps(melbourne.toJSON())
-    reply = requests.post(url + "/" + collectionName, data, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Inserted " + str(doc.get('n')) + " document")
-    else:
-        printError(output, "Unable to insert document", reply)
-           
-    query = json.dumps({"transaction": "commit"})
-    reply = requests.get(url + "/" + cmd + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Transactions committed: " + str(docs))
-    else:
-        printError(output, "Unable to commit transactions", reply) 
-            
-    data = json.dumps(sydney.toJSON())
-    reply = requests.post(url + "/" + collectionName, data, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Inserted " + str(doc.get('n')) + " document")
-    else:
-        printError(output, "Unable to insert document", reply)
-        
-    query = json.dumps({"transaction": "rollback"})
-    reply = requests.get(url + "/" + cmd + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Transactions rolled back: " + str(docs))
-    else:
-        printError(output, "Unable to roll back transactions", reply)   
-        
-    reply = requests.get(url+ "/" + collectionName, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("query result: ")
-        for doc in docs:
-            output.append(str(doc))
-    else:
-        printError(output, "Unable to query documents in collection", reply)   
-            
-    query = json.dumps({"transaction": "disable"})
-    reply = requests.get(url + "/" + cmd + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Transactions disabled")
-    else:
-        printError(output, "Unable to disable transactions", reply)  
-       
-    output.append("# 8 Catalog")
-    output.append("# 8.1 Relational Tables")
-    option = "?options="
-    query = json.dumps({"includeRelational": True})
-    reply = requests.get(url + "/" + option + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Catalog " + str(docs))
-    else:
-        printError(output, "Unable to display relational tables", reply) 
-           
-    output.append("# 8.2 Relational Tables + System Tables")
-    option = "?options="
-    query = json.dumps({"includeRelational": True, "includeSystem" : True})
-    reply = requests.get(url + "/" + option + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Catalog " + str(docs))
-    else:
-        printError(output, "Unable to display relational and system tables", reply) 
-         
-    output.append("# 9 output")
-    output.append("# 9.1 collstats command")
-    query = json.dumps({"collstats": collectionName})
-    reply = requests.get(url + "/" + cmd + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Collection stats " + str(docs))
-    else:
-        printError(output, "Unable to display collection stats", reply)
-          
-    output.append("# 9.1 dbstats command")
-    query = json.dumps({"dbstats": 1})
-    reply = requests.get(url + "/" + cmd + "?query=" + query, cookies=cookies)
-    if reply.status_code == 200:
-        docs = reply.json()
-        output.append("Database stats " + str(docs))
-    else:
-        printError(output, "Unable to display database stats", reply)
-         
-    output.append("# 10 Get a listing of collections")
-    reply = requests.get(url, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        dbList = ""
-        for db in doc:
-            dbList += "\'" + db + "\' "
-        output.append("Collections: " + str(dbList))
-    else:
-        printError(output, "Unable to retrieve collection listing", reply)
-     
-    output.append("# 11 Drop a collection")
-    reply = requests.delete(url + "/" + collectionName, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Delete collection result: " + str(doc))
-    else:
-        printError(output, "Unable to drop collection", reply)
-        
-    reply = requests.delete(url + "/" + joinCollectionName, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Delete collection result: " + str(doc))
-    else:
-        printError(output, "Unable to drop collection", reply)
-        
-    reply = requests.delete(url + "/" + codeTableName, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Delete collection result: " + str(doc))
-    else:
-        printError(output, "Unable to drop collection", reply) 
-           
-    reply = requests.delete(url + "/" + cityTableName, cookies=cookies)
-    if reply.status_code == 200:
-        doc = reply.json()
-        output.append("Delete collection result: " + str(doc))
-        
-    else:
-        printError(output, "Unable to drop collection", reply)
-    
-    return output
+    # Round trips of the steps written as operation plans
+    planReports = []
+
+    async def runStepPlan(session, output, plan):
+        planReports.append(await runPlan(session, url, plan, output, printError, mode=PLAN_MERGE))
+
+    async def createCollection(session, output):
+        output.append("# 1 Data Structures")
+        output.append( "# 1.1 Create Collection")
+        data = jsoncodec.dumps({"name": collectionName})
+        reply = await session.post(url, data)
+        if reply.status_code == 200:
+            doc = jsoncodec.loads(reply.content)
+            output.append("Created collection")
+        else:
+            printError(output, "Unable to create collection", reply)
+
+    async def createJoinCollection(session, output):
+        data = jsoncodec.dumps({"name": joinCollectionName})
+        reply = await session.post(url, data)
+        if reply.status_code == 200:
+            doc = jsoncodec.loads(reply.content)
+            output.append("Created collection")
+        else:
+            printError(output, "Unable to create collection", reply)
+
+    async def createTables(session, output):
+        output.append("# 1.2 Create Table")
+        codeTable = {"create" : codeTableName, "columns":[{"name":"countryCode","type":"int"},
+                                                          {"name": "countryName", "type": "varchar(50)"}]}
+        cityTable = {"create" : cityTableName, "columns": city.COLUMNS}
+        await runStepPlan(session, output, [Group([
+            Command(codeTable, "Created Table: " + codeTableName, "Unable to create table"),
+            Command(cityTable, "Created Table: " + cityTableName, "Unable to create table"),
+        ], merge=True)])
+
+    async def insertDocuments(session, output):
+        output.append("# 2 Inserts")
+        output.append( "# 2.1 Insert a single document to a collection")
+        await runStepPlan(session, output, [
+            Insert(collectionName, [kansasCity], "Inserted {n} document", "Unable to insert document"),
+            Insert(collectionName, [seattle, newYork, london, tokyo, madrid], "Inserted {n} documents",
+                   "Unable to insert multiple documents",
+                   header=["# 2.2 Insert multiple documents to a collection"]),
+        ])
+
+    async def insertRows(session, output):
+        await runStepPlan(session, output, [
+            Insert(cityTableName, [kansasCity], "Inserted {n} document", "Unable to insert document", merge=True),
+            Insert(cityTableName, [seattle, newYork, london, tokyo, madrid], "Inserted {n} documents",
+                   "Unable to insert multiple documents", merge=True),
+        ])
+
+    async def findOne(session, output):
+        output.append("# 3 Queries")
+        output.append("# 3.1 Find a document in a collection that matches a query condition")
+        query = jsoncodec.dumpsText({"longitude": {"$gt" : 40.0}})
+        reply = await session.get(url + "/" + collectionName + "?query=" + query)
+        if reply.status_code == 200:
+            docs = jsoncodec.loads(reply.content)
+            output.append("Query result: " + str(docs[0]))
+        else:
+            printError(output, "Unable to query documents in collection", reply)
+
+    async def findMatching(session, output):
+        output.append("# 3.2 Find all documents in a collection that match a query condition")
+        lines = []
+        try:
+            async for doc in aiterQuery(session, url + "/" + collectionName, query={"longitude": {"$gt" : 40.0}},
+                                        tuner=tuner):
+                lines.append(str(doc))
+        except QueryError as e:
+            printError(output, "Unable to query documents in collection", e.reply)
+        else:
+            output.append("Query result: ")
+            output.extend(lines)
+
+    async def findAll(session, output):
+        output.append("# 3.3 Find all documents in a collection")
+        lines = []
+        try:
+            async for doc in aiterQuery(session, url + "/" + collectionName, tuner=tuner):
+                lines.append(str(doc))
+        except QueryError as e:
+            printError(output, "Unable to query documents in collection", e.reply)
+        else:
+            output.append("query result: ")
+            output.extend(lines)
+
+    async def countDocuments(session, output):
+        output.append("# 3.4 Count documents in a collection")
+        query = jsoncodec.dumpsText({"count": collectionName, "query": {"longitude": {"$lt" : 40.0}}})
+        reply = await session.get(url + "/" + cmd + "?query=" + query)
+        if reply.status_code == 200:
+            docs = jsoncodec.loads(reply.content)
+            output.append("Count query result: " + str(docs[0]))
+        else:
+            printError(output, "Unable to count documents in collection", reply)
+
+    async def sortDocuments(session, output):
+        output.append("# 3.5 Order documents in a collection")
+        lines = []
+        try:
+            async for doc in aiterQuery(session, url + "/" + collectionName, sort={"population": 1}, tuner=tuner):
+                lines.append(str(doc))
+        except QueryError as e:
+            printError(output, "Unable to sort documents in collection", e.reply)
+        else:
+            output.append("Sorted result: ")
+            output.extend(lines)
+
+    async def findDistinct(session, output):
+        output.append("# 3.6 Find distinct values in a collection")
+        query = jsoncodec.dumpsText({"distinct": collectionName, "key": "countryCode", "query": {"longitude": {"$lt" : 40.0}}})
+        reply = await session.get(url + "/" + cmd + "?query=" + query)
+        if reply.status_code == 200:
+            docs = jsoncodec.loads(reply.content)
+            output.append("Distinct values: ")
+            for doc in docs:
+                output.append(str(doc))
+        else:
+            output.append("error")
+            printError(output, "Unable to find distinct values in collection", reply)
+
+    async def insertCodes(session, output):
+        output.append("# 3.7 Join collection")
+        data = jsoncodec.dumps([{"countryCode" : 1, "countryName" : "United States of America"},
+                           {"countryCode" : 44, "countryName" : "United Kingdom"},
+                           {"countryCode" : 81, "countryName" : "Japan"},
+                           {"countryCode" : 34, "countryName" : "Spain"},
+                           {"countryCode" : 61, "countryName" : "Australia"}])
+        reply = await session.post(url + "/" + codeTableName, data)
+        if reply.status_code == 202:
+            doc = jsoncodec.loads(reply.content)
+            output.append("Inserted " + str(doc.get('n')) + " document")
+        else:
+            printError(output, "Unable to insert documents", reply)
+
+    async def insertJoinCodes(session, output):
+        data = jsoncodec.dumps([{"countryCode" : 1, "countryName" : "United States of America"}, 
+                           {"countryCode" : 44, "countryName" : "United Kingdom"},
+                           {"countryCode" : 81, "countryName" : "Japan"},
+                           {"countryCode" : 34, "countryName" : "Spain"},
+                           {"countryCode" : 61, "countryName" : "Australia"}])
+        reply = await session.post(url + "/" + joinCollectionName, data)
+        if reply.status_code == 202:
+            doc = jsoncodec.loads(reply.content)
+            output.append("Inserted " + str(doc.get('n')) + " document")
+        else:
+            printError(output, "Unable to insert documents", reply)
+
+    async def joinCollections(session, output):
+        output.append("# 3.7a Join collection-collection")
+        query = {"$collections": {collectionName: {"$project": {"name" : 1, "population" : 1, "longitude": 1, "latitude" : 1}},
+                                  joinCollectionName: {"$project": {"countryCode" : 1, "countryName" : 1}}},
+                 "$condition" : {collectionName + ".countryCode" : joinCollectionName + ".countryCode"}}
+        lines = []
+        try:
+            async for doc in aiterJoin(session, url, query, strategy=JOIN_STRATEGY, buildLimit=JOIN_BUILD_LIMIT,
+                                       tuner=tuner):
+                lines.append(str(doc))
+        except QueryError as e:
+            printError(output, "Unable to join collections", e.reply)
+        else:
+            output.append("Join collection-collection: ")
+            output.extend(lines)
+
+    async def joinTableCollection(session, output):
+        output.append("# 3.7b Join table-collection")
+        query = {"$collections": {collectionName: {"$project": {"name" : 1, "population" : 1, "longitude": 1, "latitude" : 1}},
+                                  codeTableName: {"$project": {"countryCode" : 1, "countryName" : 1}}},
+                 "$condition" : {collectionName + ".countryCode" : codeTableName + ".countryCode"}}
+        lines = []
+        try:
+            async for doc in aiterJoin(session, url, query, strategy=JOIN_STRATEGY, buildLimit=JOIN_BUILD_LIMIT,
+                                       tuner=tuner):
+                lines.append(str(doc))
+        except QueryError as e:
+            printError(output, "Unable to join collections", e.reply)
+        else:
+            output.append("Join collection-collection: ")
+            output.extend(lines)
+
+    async def joinTables(session, output):
+        output.append("# 3.7c Join table-table")
+        query = {"$collections": {cityTableName: {"$project": {"name" : 1, "population" : 1, "longitude": 1, "latitude" : 1}},
+                                  codeTableName: {"$project": {"countryCode" : 1, "countryName" : 1}}},
+                 "$condition" : {cityTableName + ".countryCode" : codeTableName + ".countryCode"}}
+        lines = []
+        try:
+            async for doc in aiterJoin(session, url, query, strategy=JOIN_STRATEGY, buildLimit=JOIN_BUILD_LIMIT,
+                                       tuner=tuner):
+                lines.append(str(doc))
+        except QueryError as e:
+            printError(output, "Unable to join collections", e.reply)
+        else:
+            output.append("Join table-table: ")
+            output.extend(lines)
+
+    async def changeBatchSize(session, output):
+        output.append("#3.8 Batch Size")
+        # The batch size learned for this collection from earlier runs, rather than one picked by hand
+        if tuner is not None:
+            batchSize = tuner.batchSize(tuner.key(url + "/" + collectionName))
+        else:
+            batchSize = DEFAULT_BATCH_SIZE
+        try:
+            async for doc in aiterQuery(session, url + "/" + collectionName, batchSize=batchSize, tuner=tuner):
+                pass
+        except QueryError as e:
+            printError(output, "Unable to change batch size", e.reply)
+        else:
+            output.append("New batch size: " + str(batchSize))
+
+    async def findWithProjection(session, output):
+        output.append("# 3.9 Find all documents in a collection with projection")
+        query = jsoncodec.dumpsText({"longitude": {"$gt" : 40.0}})
+        projection = jsoncodec.dumpsText({"name" : 1, "population": 1, "_id": 0})
+        reply = await session.get(url + "/" + collectionName + "?query=" + query + "&fields=" + projection)
+        if reply.status_code == 200:
+            docs = jsoncodec.loads(reply.content)
+            output.append("Query result: ")
+            for doc in docs:
+                output.append(str(doc))
+        else:
+            printError(output, "Unable to query documents in collection", reply)
+
+    async def updateDocuments(session, output):
+        output.append("# 4 Update documents in a collection")
+        report = await bulkMutate(session, url + "/" + collectionName,
+                                  [({'name': seattle.name}, {'$set' : {'countryCode' : 999}})])
+        result = report.partitions[0]
+        if result.ok:
+            output.append("Updated " + str(result.n) + " documents")
+        elif result.reply is None:
+            output.append("Error: Unable to update documents in collection: " + result.error)
+        else:
+            printError(output, "Unable to update documents in collection", result.reply)
+
+    async def deleteDocuments(session, output):
+        output.append("# 5 Delete documents in a collection")
+        report = await bulkMutate(session, url + "/" + collectionName, [({'name': tokyo.name}, None)])
+        result = report.partitions[0]
+        if result.ok:
+            output.append("Deleted " + str(result.n) + " documents")
+        elif result.reply is None:
+            output.append("Error: Unable to delete documents in collection: " + result.error)
+        else:
+            printError(output, "Unable to delete documents in collection", result.reply)
+
+    async def sqlPassthrough(session, output):
+        output.append("# 6 SQL Passthrough")
+        await runStepPlan(session, output, [
+            Sql("create table if not exists " + townTableName + " (name varchar(255), countryCode int)",
+                "Created table", "Unable to create table with sql passthrough"),
+            Sql("insert into " + townTableName + " values ('Lawrence', 1)",
+                "Inserted {reply} document", "Unable to insert with sql passthrough"),
+            Sql("drop table " + townTableName, "Dropped table", "Unable to drop table with sql passthrough"),
+        ])
+
+    async def transactions(session, output):
+        output.append("# 7 Transactions")
+        await runStepPlan(session, output, [
+            Transaction([Insert(collectionName, [melbourne], "Inserted {n} document", "Unable to insert document")]),
+            Transaction([Insert(collectionName, [sydney], "Inserted {n} document", "Unable to insert document")],
+                        commit=False, then=[Find(collectionName)]),
+        ])
+
+    async def roundTrips(session, output):
+        output.append("Listener calls of the planned steps: %d as written, %d after merging (%s), %d sent" % (
+            sum(report.planned for report in planReports), sum(report.merged for report in planReports),
+            PLAN_MERGE, sum(report.sent for report in planReports)))
+
+    async def catalog(session, output):
+        output.append("# 8 Catalog")
+        output.append("# 8.1 Relational Tables")
+        option = "?options="
+        query = jsoncodec.dumpsText({"includeRelational": True})
+        reply = await session.get(url + "/" + option + query)
+        if reply.status_code == 200:
+            docs = jsoncodec.loads(reply.content)
+            output.append("Catalog " + str(docs))
+        else:
+            printError(output, "Unable to display relational tables", reply)
+
+    async def catalogSystem(session, output):
+        output.append("# 8.2 Relational Tables + System Tables")
+        option = "?options="
+        query = jsoncodec.dumpsText({"includeRelational": True, "includeSystem" : True})
+        reply = await session.get(url + "/" + option + query)
+        if reply.status_code == 200:
+            docs = jsoncodec.loads(reply.content)
+            output.append("Catalog " + str(docs))
+        else:
+            printError(output, "Unable to display relational and system tables", reply)
+
+    async def collStats(session, output):
+        output.append("# 9 output")
+        output.append("# 9.1 collstats command")
+        query = jsoncodec.dumpsText({"collstats": collectionName})
+        reply = await session.get(url + "/" + cmd + "?query=" + query)
+        if reply.status_code == 200:
+            docs = jsoncodec.loads(reply.content)
+            output.append("Collection stats " + str(docs))
+        else:
+            printError(output, "Unable to display collection stats", reply)
+
+    async def dbStats(session, output):
+        output.append("# 9.1 dbstats command")
+        query = jsoncodec.dumpsText({"dbstats": 1})
+        reply = await session.get(url + "/" + cmd + "?query=" + query)
+        if reply.status_code == 200:
+            docs = jsoncodec.loads(reply.content)
+            output.append("Database stats " + str(docs))
+        else:
+            printError(output, "Unable to display database stats", reply)
+
+    async def listCollections(session, output):
+        output.append("# 10 Get a listing of collections")
+        reply = await session.get(url)
+        if reply.status_code == 200:
+            doc = jsoncodec.loads(reply.content)
+            dbList = ""
+            for db in doc:
+                dbList += "\'" + db + "\' "
+            output.append("Collections: " + str(dbList))
+        else:
+            printError(output, "Unable to retrieve collection listing", reply)
+
+    async def dropCollection(session, output):
+        output.append("# 11 Drop a collection")
+        reply = await session.delete(url + "/" + collectionName)
+        if reply.status_code == 200:
+            doc = jsoncodec.loads(reply.content)
+            output.append("Delete collection result: " + str(doc))
+        else:
+            printError(output, "Unable to drop collection", reply)
+
+    async def dropJoinCollection(session, output):
+        reply = await session.delete(url + "/" + joinCollectionName)
+        if reply.status_code == 200:
+            doc = jsoncodec.loads(reply.content)
+            output.append("Delete collection result: " + str(doc))
+        else:
+            printError(output, "Unable to drop collection", reply)
+
+    async def dropCodeTable(session, output):
+        reply = await session.delete(url + "/" + codeTableName)
+        if reply.status_code == 200:
+            doc = jsoncodec.loads(reply.content)
+            output.append("Delete collection result: " + str(doc))
+        else:
+            printError(output, "Unable to drop collection", reply)
+
+    async def dropCityTable(session, output):
+        reply = await session.delete(url + "/" + cityTableName)
+        if reply.status_code == 200:
+            doc = jsoncodec.loads(reply.content)
+            output.append("Delete collection result: " + str(doc))
+
+        else:
+            printError(output, "Unable to drop collection", reply)
+
+    inserted = ["insertDocuments"]
+    steps = [
+        Step("createCollection", createCollection),
+        Step("createJoinCollection", createJoinCollection),
+        Step("createTables", createTables),
+        Step("insertDocuments", insertDocuments, after=["createCollection"]),
+        Step("insertRows", insertRows, after=["createTables"]),
+        Step("findOne", findOne, after=inserted),
+        Step("findMatching", findMatching, after=inserted),
+        Step("findAll", findAll, after=inserted),
+        Step("countDocuments", countDocuments, after=inserted),
+        Step("sortDocuments", sortDocuments, after=inserted),
+        Step("findDistinct", findDistinct, after=inserted),
+        Step("insertCodes", insertCodes, after=["createTables"]),
+        Step("insertJoinCodes", insertJoinCodes, after=["createJoinCollection"]),
+        Step("joinCollections", joinCollections, after=inserted + ["insertJoinCodes"]),
+        Step("joinTableCollection", joinTableCollection, after=inserted + ["insertCodes"]),
+        Step("joinTables", joinTables, after=["insertRows", "insertCodes"]),
+        Step("changeBatchSize", changeBatchSize, after=inserted),
+        Step("findWithProjection", findWithProjection, after=inserted),
+    ]
+    # Updates and deletes must not change the documents the queries above display
+    reads = ["findOne", "findMatching", "findAll", "countDocuments", "sortDocuments", "findDistinct",
+             "joinCollections", "joinTableCollection", "changeBatchSize", "findWithProjection"]
+    steps.append(Step("updateDocuments", updateDocuments, after=reads))
+    steps.append(Step("deleteDocuments", deleteDocuments, after=reads))
+    steps.append(Step("sqlPassthrough", sqlPassthrough))
+    # A listener transaction covers every request made on the session while it is enabled,
+    # so the transaction step runs alone: after everything above and before everything below.
+    steps.append(Step("transactions", transactions, after=[step.name for step in steps]))
+    listings = ["catalog", "catalogSystem", "collStats", "dbStats", "listCollections"]
+    steps.append(Step("catalog", catalog, after=["transactions"]))
+    steps.append(Step("catalogSystem", catalogSystem, after=["transactions"]))
+    steps.append(Step("collStats", collStats, after=["transactions"]))
+    steps.append(Step("dbStats", dbStats, after=["transactions"]))
+    steps.append(Step("listCollections", listCollections, after=["transactions"]))
+    steps.append(Step("dropCollection", dropCollection, after=listings))
+    steps.append(Step("dropJoinCollection", dropJoinCollection, after=listings))
+    steps.append(Step("dropCodeTable", dropCodeTable, after=listings))
+    steps.append(Step("dropCityTable", dropCityTable, after=listings))
+    steps.append(Step("roundTrips", roundTrips, after=[step.name for step in steps]))
+
+    # Note: the listener session id is held in a cookie. The session object keeps that
+    # cookie and sends it with subsequent requests so they reuse the same listener session,
+    # while the underlying connections come from the pool shared by all Flask requests.
+    session = AsyncListenerSession(client.newSession(), executor)
+    return asyncio.run(runSteps(steps, session, limit=MAX_CONCURRENCY, emit=emit, cancelled=cancelled))
       
+def jsonResponse(value, status=200, headers=None):
+    return Response(jsoncodec.dumps(value), status=status, headers=headers, mimetype="application/json")
+
 @app.route("/")
 def displayPage():
     return render_template('index.html')
 
 @app.route("/databasetest")
 def runSample():
+    if request.args.get("background", "").lower() in ("1", "true", "yes"):
+        return submitSample()
     output = []
     try:
         output = doEverything()
@@ -540,6 +697,362 @@ def runSample():
         logging.exception(e) 
         output.append("EXCEPTION (see log for details): " + str(e))
     return render_template('tests.html', output=output)
+
+@app.route("/tenanttest")
+def runTenantSample():
+    """
+    Run ?copies=N isolated copies of the sample in parallel, spread over
+    TENANT_URLS, and show a summary line followed by the output of each copy
+    """
+    try:
+        copies = min(numberArg("copies", 2, minimum=1), MAX_TENANTS)
+    except ValueError as e:
+        return jsonResponse({"error": str(e)}, status=400)
+    output = []
+    try:
+        tenants = makeTenants(TENANT_URLS or [getDatabaseUrl()], copies)
+        results = runTenants(doEverything, tenants, workers=TENANT_WORKERS)
+    except Exception as e:
+        logging.exception(e)
+        output.append("EXCEPTION (see log for details): " + str(e))
+        return render_template('tests.html', output=output)
+    for result in results:
+        output.append("# Tenant %s on %s: %s, %d errors, %.2fs" % (
+            result.tenant.namespace, result.tenant.url, "ok" if result.ok else "FAILED", result.errors,
+            result.seconds))
+        if result.error is not None:
+            output.append("EXCEPTION (see log for details): " + result.error)
+        output.extend(result.output)
+    return render_template('tests.html', output=output)
+
+@app.route("/cachestats")
+def cacheStats():
+    """
+    Hit, miss and eviction counters of the read cache, as JSON
+    """
+    stats = cache.stats() if cache is not None else {"size": 0, "maxSize": 0}
+    return jsonResponse(stats)
+
+def submitSample():
+    """
+    Queue a run of the sample and reply at once with its job id
+    """
+    try:
+        job = jobs.submit(doEverything)
+    except QueueFull as e:
+        return jsonResponse({"error": str(e)}, status=503, headers={"Retry-After": "10"})
+    return jsonResponse(job.toDict(), status=202, headers={"Location": "/jobs/" + job.id})
+
+@app.route("/batchsizes")
+def batchSizes():
+    """
+    Batch sizes tuned per collection and query shape, as JSON
+    """
+    stats = tuner.stats() if tuner is not None else {"shapes": []}
+    return jsonResponse(stats)
+
+@app.route("/snapshots")
+def snapshotStats():
+    """
+    Reads answered from snapshots, and the state of every snapshot, as JSON
+    """
+    stats = snapshots.stats() if snapshots is not None else {"snapshots": []}
+    return jsonResponse(stats)
+
+@app.route("/circuits")
+def circuitStats():
+    """
+    Timeouts, the state of every circuit, and how many reads were hedged, as JSON
+    """
+    stats = {"timeouts": client.timeouts.toDict(),
+             "breaker": client.breaker.stats() if client.breaker is not None else {"circuits": []},
+             "hedging": client.hedger.stats() if client.hedger is not None else None}
+    return jsonResponse(stats)
+
+@app.route("/jobs")
+def jobStats():
+    """
+    Number of background runs in each state, as JSON
+    """
+    return jsonResponse(jobs.stats())
+
+def numberArg(name, default, kind=int, minimum=0):
+    """
+    A numeric query string parameter, or default when it is absent
+
+    :raises ValueError: (the parameter is not a number, or is below minimum)
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        number = kind(value)
+    except ValueError:
+        number = None
+    # NaN compares false with everything, so it fails number == number
+    if number is None or number != number or number < minimum:
+        raise ValueError("The %s parameter must be a number of at least %s" % (name, minimum))
+    return number
+
+def findJob(jobId):
+    job = jobs.get(jobId)
+    if job is None:
+        return None, jsonResponse({"error": "Unknown job " + jobId}, status=404)
+    return job, None
+
+@app.route("/jobs/<jobId>")
+def pollJob(jobId):
+    """
+    State and output lines of a background run, from line ?since=N on.
+
+    With ?wait=S, waits up to S seconds (at most 30) for new lines first.
+    """
+    job, error = findJob(jobId)
+    if error is not None:
+        return error
+    try:
+        since = numberArg("since", 0)
+        wait = min(numberArg("wait", 0.0, float), 30.0)
+    except ValueError as e:
+        return jsonResponse({"error": str(e)}, status=400)
+    if wait > 0:
+        job.wait(since, wait)
+    return jsonResponse(job.toDict(since))
+
+@app.route("/jobs/<jobId>/stream")
+def streamJob(jobId):
+    """
+    Stream the output lines of a background run as newline-delimited JSON,
+    {"line": ...} as each is produced, then {"state": ...} once it finishes
+    """
+    job, error = findJob(jobId)
+    if error is not None:
+        return error
+
+    def generate():
+        offset = 0
+        while True:
+            lines, finished = job.wait(offset, 30.0)
+            offset += len(lines)
+            for line in lines:
+                yield jsoncodec.dumps({"line": line}) + b"\n"
+            if finished and not lines:
+                yield jsoncodec.dumps({"state": job.state, "error": job.error}) + b"\n"
+                return
+    return Response(generate(), mimetype="application/x-ndjson")
+
+@app.route("/jobs/<jobId>/cancel", methods=["POST"])
+def cancelJob(jobId):
+    """
+    Cancel a background run: a queued run never starts, a running one stops
+    before its next step
+    """
+    job, error = findJob(jobId)
+    if error is not None:
+        return error
+    job.cancel()
+    return jsonResponse(job.toDict())
+
+@app.route("/metrics")
+def listenerMetrics():
+    """
+    Latency, payload, error, connection pool, circuit, hedging and cache metrics of listener calls
+    """
+    return Response(metrics.render(client, cache), mimetype="text/plain; version=0.0.4")
+
+def probeListener(url):
+    """
+    Whether the listener at a database url answers a dbstats command. Sent on
+    the client's session directly so the read cache cannot answer for it.
+    """
+    reply = client.session.get(url + "/$cmd", params={"query": jsoncodec.dumpsText({"dbstats": 1})},
+                               timeout=HEALTH_TIMEOUT)
+    reply.close()
+    return reply.status_code == 200
+
+@app.route("/health")
+def checkHealth():
+    """
+    Probe every listener endpoint and mark it up or down, as JSON. Replies
+    503 when none is up.
+    """
+    resolver = config.getResolver(URL, SERVICE_NAME, USE_SSL, FAILOVER_RETRY_AFTER)
+    endpoints = resolver.check(probeListener)
+    healthy = any(endpoint["up"] for endpoint in endpoints)
+    return jsonResponse({"healthy": healthy, "endpoints": endpoints}, status=200 if healthy else 503)
+
+def queryOptions():
+    """
+    The request's query, sort and fields parameters, decoded, and its batchsize
+
+    :returns: (dict of keyword arguments for iterQuery, batch size or None)
+    :raises ValueError: (a parameter is malformed)
+    """
+    options = {}
+    for option in ("query", "sort", "fields"):
+        if option in request.args:
+            try:
+                options[option] = jsoncodec.loads(request.args[option])
+            except ValueError:
+                raise ValueError("The %s parameter is not valid JSON" % option)
+    batchSize = None
+    if "batchsize" in request.args:
+        try:
+            batchSize = int(request.args["batchsize"])
+        except ValueError:
+            batchSize = 0
+        if batchSize <= 0:
+            raise ValueError("The batchsize parameter must be a positive integer")
+    return options, batchSize
+
+def relayReply(url, params):
+    """
+    Pass a query, join or catalog result through to the client without decoding it,
+    as one JSON array or, with ?passthrough=ndjson, one element per line
+    """
+    session = client.newSession()
+    reply = session.get(url, params=params, stream=True)
+    # A listener error becomes this response's status
+    if reply.status_code != 200:
+        content = reply.content
+        reply.close()
+        return Response(content, status=reply.status_code, mimetype="application/json")
+    chunks = relayArray(session, url, params, reply)
+    if request.args.get("passthrough") == "ndjson":
+        return Response(toNdjson(chunks), mimetype="application/x-ndjson")
+    return Response(chunks, mimetype="application/json")
+
+@app.route("/catalog")
+def streamCatalog():
+    """
+    Relay the database catalog; accepts the listener's options parameter
+    """
+    params = dict((arg, request.args[arg]) for arg in ("options",) if arg in request.args)
+    return relayReply(getDatabaseUrl(), params)
+
+def columnBatches(name):
+    """
+    ColumnBatches of a collection, table or system.join query, from the request's
+    query, sort, fields and batchsize parameters (default: tuned). ?schema=city reads the cityTable
+    columns; otherwise the schema is inferred from the first batch.
+
+    :raises ValueError: (a parameter is malformed)
+    """
+    options, batchSize = queryOptions()
+    schema = schemaFromColumns(city.COLUMNS) if request.args.get("schema") == "city" else None
+    docs = iterQuery(client.newSession(), getDatabaseUrl() + "/" + name, batchSize=batchSize, tuner=tuner,
+                     **options)
+    return iterColumnBatches(docs, schema, batchSize or DEFAULT_BATCH_SIZE)
+
+@app.route("/export/<name>")
+def exportColumns(name):
+    """
+    Export a query result as CSV (?format=csv, the default), written batch by
+    batch as it streams from the listener, or as Parquet (?format=parquet, needs
+    pyarrow). Parquet keeps its footer at the end, so it is written to a
+    temporary file and sent once complete.
+    """
+    try:
+        batches = columnBatches(name)
+    except ValueError as e:
+        return jsonResponse({"error": str(e)}, status=400)
+    if request.args.get("format") == "parquet" and not parquetAvailable():
+        return jsonResponse({"error": "Parquet export needs pyarrow, which is not installed"}, status=501)
+    try:
+        first = next(batches, None)
+    except QueryError as e:
+        return Response(e.reply.content, status=e.reply.status_code, mimetype="application/json")
+    if first is None:
+        return Response(b"", mimetype="text/csv")
+
+    if request.args.get("format") == "parquet":
+        output = tempfile.TemporaryFile()
+        writer = ParquetWriter(output, first.schema)
+        try:
+            writer.write(first)
+            for batch in batches:
+                writer.write(batch)
+        except SchemaChanged as e:
+            return jsonResponse({"error": str(e)}, status=422)
+        finally:
+            writer.close()
+        output.seek(0)
+        return Response(iter(lambda: output.read(1024 * 1024), b""), mimetype="application/vnd.apache.parquet")
+
+    def generate():
+        text = io.StringIO()
+        writer = CsvWriter(text, first.schema)
+        writer.write(first)
+        for batch in batches:
+            yield text.getvalue().encode("utf-8")
+            text.seek(0)
+            text.truncate()
+            writer.write(batch)
+        yield text.getvalue().encode("utf-8")
+    return Response(generate(), mimetype="text/csv")
+
+@app.route("/aggregate/<name>")
+def aggregateColumns(name):
+    """
+    Count, sum and mean of ?field= per value of ?by= over a query result, as JSON,
+    e.g. /aggregate/cityTable?by=countryCode&field=population
+    """
+    for arg in ("by", "field"):
+        if not request.args.get(arg):
+            return jsonResponse({"error": "The %s parameter is required" % arg}, status=400)
+    aggregate = GroupAggregate(request.args["by"], request.args["field"])
+    try:
+        batches = columnBatches(name)
+        first = next(batches, None)
+        if first is not None:
+            aggregate.check(first.schema)
+            aggregate.update(first)
+        for batch in batches:
+            aggregate.update(batch)
+    except QueryError as e:
+        return Response(e.reply.content, status=e.reply.status_code, mimetype="application/json")
+    except ValueError as e:
+        return jsonResponse({"error": str(e)}, status=400)
+    result = aggregate.result()
+    return jsonResponse([dict(result[key], key=key) for key in sorted(result, key=str)])
+
+@app.route("/query/<name>")
+def streamQuery(name):
+    """
+    Stream the documents of a collection, table or system.join query as
+    newline-delimited JSON, one listener batch at a time.
+
+    Accepts the listener's query, sort, fields and batchsize parameters;
+    without batchsize, the size tuned for the collection and query is used. With
+    ?passthrough=json or ?passthrough=ndjson, the listener's replies are
+    relayed without being decoded.
+    """
+    if request.args.get("passthrough") in ("json", "ndjson"):
+        params = dict((arg, request.args[arg]) for arg in ("query", "sort", "fields", "batchsize")
+                      if arg in request.args)
+        return relayReply(getDatabaseUrl() + "/" + name, params)
+    try:
+        options, batchSize = queryOptions()
+    except ValueError as e:
+        return jsonResponse({"error": str(e)}, status=400)
+    docs = iterQuery(client.newSession(), getDatabaseUrl() + "/" + name, batchSize=batchSize, tuner=tuner,
+                     **options)
+    # Fetch the first batch up front so a listener error becomes this response's status
+    try:
+        first = next(docs, None)
+    except QueryError as e:
+        return Response(e.reply.content, status=e.reply.status_code, mimetype="application/json")
+
+    def generate():
+        if first is None:
+            return
+        yield jsoncodec.dumps(first) + b"\n"
+        for doc in docs:
+            yield jsoncodec.dumps(doc) + b"\n"
+    return Response(generate(), mimetype="application/x-ndjson")
  
 if (__name__ == "__main__"):
+    # Under gunicorn, SIGHUP restarts the workers, which read the configuration afresh
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, reloadConfig)
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,233 @@
+##
+# Streaming queries over collections, tables and system.join
+##
+
+import codecs
+import itertools
+import json
+import time
+
+import jsoncodec
+from restclient import CURSOR_COOKIES, answeredLocally
+
+DEFAULT_BATCH_SIZE = 100    # documents per listener reply
+CHUNK_SIZE = 64 * 1024      # bytes read from the socket at a time
+
+_WHITESPACE = " \t\n\r"
+# Characters that may follow an element of an array
+_DELIMITERS = _WHITESPACE + ",]"
+
+
+class QueryError(Exception):
+    """
+    The listener refused a query or one of its follow-up batches
+    """
+    def __init__(self, reply):
+        Exception.__init__(self, "Query failed with status code " + str(reply.status_code))
+        self.reply = reply
+
+
+def queryParams(query=None, sort=None, fields=None, batchSize=None):
+    """
+    Build the query string parameters understood by the listener
+
+    :returns: (dict)
+    """
+    params = {}
+    if query is not None:
+        params["query"] = jsoncodec.dumpsText(query)
+    if sort is not None:
+        params["sort"] = jsoncodec.dumpsText(sort)
+    if fields is not None:
+        params["fields"] = jsoncodec.dumpsText(fields)
+    if batchSize is not None:
+        params["batchsize"] = str(batchSize)
+    return params
+
+
+def iterArray(chunks):
+    """
+    Parse a JSON array from an iterable of byte chunks, one element at a time
+
+    Only the element being parsed and the rest of the current chunk are held
+    in memory. A reply that is not an array is parsed whole; if it is a
+    single document, that document is the only element.
+
+    :returns: (generator of elements)
+    """
+    chunks = iter(chunks)
+    decode = codecs.getincrementaldecoder("utf-8")().decode
+    parse = json.JSONDecoder().raw_decode
+    OPEN, FIRST, VALUE, NEXT, DONE, SINGLE = range(6)
+    state = OPEN
+    buffer = ""
+    pos = 0
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        buffer = buffer[pos:] + decode(chunk or b"", final)
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                pos += 1
+            if pos == len(buffer):
+                break
+            char = buffer[pos]
+            if state == OPEN:
+                if char != "[":
+                    state = SINGLE
+                    break
+                state = FIRST
+                pos += 1
+            elif state == FIRST and char == "]":
+                state = DONE
+                pos += 1
+            elif state in (FIRST, VALUE):
+                try:
+                    value, end = parse(buffer, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    break
+                # A number is only whole once something other than a digit follows it:
+                # "22." or "1e" at the end of a chunk continue in the next one
+                if (not final and isinstance(value, (int, float)) and not isinstance(value, bool)
+                        and (end == len(buffer) or buffer[end] not in _DELIMITERS)):
+                    break
+                yield value
+                pos = end
+                state = NEXT
+            elif state == NEXT:
+                if char == ",":
+                    state = VALUE
+                elif char == "]":
+                    state = DONE
+                else:
+                    raise ValueError("Unexpected %r in JSON array" % char)
+                pos += 1
+            else:
+                raise ValueError("Extra data after JSON array")
+        if state == SINGLE:
+            break
+
+    if state == SINGLE:
+        rest = buffer[pos:] + "".join(decode(chunk) for chunk in chunks) + decode(b"", True)
+        value = jsoncodec.loads(rest)
+        if isinstance(value, list):
+            for element in value:
+                yield element
+        else:
+            yield value
+    elif state != DONE:
+        raise ValueError("Truncated JSON array")
+
+
+def _nextCursor(reply, count, batchSize):
+    """
+    The listener hands back a cursor cookie while more batches remain
+
+    :returns: (cookies for the next batch, or None)
+    """
+    if count < batchSize:
+        return None
+    cookies = dict((name, reply.cookies[name]) for name in CURSOR_COOKIES if name in reply.cookies)
+    return cookies or None
+
+
+def _tunedBatchSize(url, query, sort, fields, batchSize, tuner):
+    """
+    :returns: (batch size to send, key to report batches to the tuner under or None)
+    """
+    if tuner is None:
+        return (DEFAULT_BATCH_SIZE if batchSize is None else batchSize), None
+    key = tuner.key(url, query, sort, fields)
+    return (tuner.batchSize(key) if batchSize is None else batchSize), key
+
+
+def _timedChunks(reply, meter):
+    """
+    The reply's chunks, adding the time spent waiting for each and its size
+    to meter, [seconds, bytes]. Time the caller spends between chunks is left out.
+    """
+    chunks = reply.iter_content(CHUNK_SIZE)
+    while True:
+        start = time.perf_counter()
+        chunk = next(chunks, None)
+        meter[0] += time.perf_counter() - start
+        if chunk is None:
+            return
+        meter[1] += len(chunk)
+        yield chunk
+
+
+def iterQuery(session, url, query=None, sort=None, fields=None, batchSize=None, tuner=None):
+    """
+    Lazily iterate over the documents of a collection, table or system.join query
+
+    Results are fetched batchSize documents at a time, following the
+    listener's cursor, and every reply is read and parsed as it arrives. Peak
+    memory depends on the batch size, not on the size of the result.
+
+    With a BatchTuner, the batch size defaults to the one tuned for the
+    collection and query shape, and every batch the listener sent is
+    reported back to it. Replies from a cache or snapshot are not, since
+    their timings say nothing about the listener.
+
+    :param session: (ListenerSession)
+    :param url: (url of the collection, table or system.join)
+    :returns: (generator of documents)
+    """
+    batchSize, key = _tunedBatchSize(url, query, sort, fields, batchSize, tuner)
+    params = queryParams(query, sort, fields, batchSize)
+    start = time.perf_counter()
+    reply = session.get(url, params=params, stream=True)
+    while True:
+        if reply.status_code != 200:
+            reply.close()
+            raise QueryError(reply)
+        meter = [time.perf_counter() - start, 0]
+        count = 0
+        try:
+            for doc in iterArray(_timedChunks(reply, meter)):
+                count += 1
+                yield doc
+        finally:
+            reply.close()
+        if key is not None and not answeredLocally(reply):
+            tuner.observe(key, batchSize, count, meter[0], meter[1])
+        cursor = _nextCursor(reply, count, batchSize)
+        if cursor is None:
+            return
+        start = time.perf_counter()
+        reply = session.get(url, params=params, cookies=cursor, stream=True)
+
+
+async def aiterQuery(session, url, query=None, sort=None, fields=None, batchSize=None, tuner=None):
+    """
+    Async counterpart of iterQuery for an AsyncListenerSession
+
+    Each batch is received whole and decoded in one call to the fast codec,
+    so memory is bounded by one batch.
+
+    :returns: (async generator of documents)
+    """
+    batchSize, key = _tunedBatchSize(url, query, sort, fields, batchSize, tuner)
+    params = queryParams(query, sort, fields, batchSize)
+    start = time.perf_counter()
+    reply = await session.get(url, params=params)
+    while True:
+        if reply.status_code != 200:
+            raise QueryError(reply)
+        seconds = time.perf_counter() - start
+        docs = jsoncodec.loads(reply.content)
+        if not isinstance(docs, list):
+            docs = [docs]
+        count = len(docs)
+        if key is not None and not answeredLocally(reply):
+            tuner.observe(key, batchSize, count, seconds, len(reply.content))
+        for doc in docs:
+            yield doc
+        cursor = _nextCursor(reply, count, batchSize)
+        if cursor is None:
+            return
+        start = time.perf_counter()
+        reply = await session.get(url, params=params, cookies=cursor)
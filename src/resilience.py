@@ -0,0 +1,322 @@
+##
+# Timeouts, circuit breakers and hedged reads for listener calls
+#
+# Every call has a connect and a read timeout, chosen by the kind of call it
+# is, so a listener that stops answering fails a call instead of hanging it.
+#
+# A circuit breaker per listener endpoint and kind of call counts the calls
+# that fail in a row, by a connection error, a timeout or a 5xx reply. Once
+# there are enough of them, the circuit opens and calls fail at once with
+# CircuitOpenError for resetSeconds. Then it is half open: a few trial calls
+# go through, and the first outcome closes the circuit or opens it again.
+#
+# Idempotent reads (finds, counts, distincts and the catalog) may be hedged:
+# when a read has not been answered after the 95th percentile of the recent
+# latency of its kind, the same read is sent a second time, and whichever
+# reply comes first is used. The duplicates sent are capped at a fraction of
+# all reads, so a slow listener is not sent twice the load.
+##
+
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+from restclient import CURSOR_COOKIES, splitUrl
+
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 30.0
+DEFAULT_FAILURES = 5
+DEFAULT_RESET_SECONDS = 30.0
+DEFAULT_HALF_OPEN_CALLS = 1
+DEFAULT_HEDGE_PERCENTILE = 0.95
+DEFAULT_HEDGE_RATIO = 0.1
+
+# Reads that may be sent twice: repeating them changes nothing on the listener
+HEDGE_OPERATIONS = ("find", "count", "distinct", "catalog")
+# Latencies kept per endpoint and kind of read, and how many of them are needed before hedging
+LATENCY_WINDOW = 200
+MIN_SAMPLES = 20
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+def parseTimeouts(value):
+    """
+    Read timeouts by operation, e.g. "sql=120,join=60"
+
+    :returns: (dict of operation to seconds)
+    """
+    timeouts = {}
+    for item in value.split(","):
+        if item.strip():
+            operation, seconds = item.split("=", 1)
+            timeouts[operation.strip()] = float(seconds)
+    return timeouts
+
+
+def endpointOf(url):
+    """
+    The listener and database a url is about, without any credentials in it
+
+    :returns: (str, host[:port]/database)
+    """
+    return splitUrl(url)[0].rsplit("@", 1)[-1]
+
+
+def hedgeOperation(method, url, operation, cookies):
+    """
+    :returns: (the kind of read, if the call is one that may be hedged, else None)
+    """
+    if method != "GET":
+        return None
+    # The next batch of a cursor is handed out once; asking twice would skip one
+    if cookies and any(name in cookies for name in CURSOR_COOKIES):
+        return None
+    if operation == "command" and splitUrl(url)[1] is None:
+        return "catalog"
+    return operation if operation in HEDGE_OPERATIONS else None
+
+
+class Timeouts:
+    """
+    (connect, read) timeout of a listener call, by operation
+    """
+    def __init__(self, connect=DEFAULT_CONNECT_TIMEOUT, read=DEFAULT_READ_TIMEOUT, byOperation=None):
+        self.default = (connect, read)
+        self.byOperation = dict((operation, (connect, seconds))
+                                for operation, seconds in (byOperation or {}).items())
+
+    def get(self, operation):
+        return self.byOperation.get(operation, self.default)
+
+    def toDict(self):
+        return {"connect": self.default[0], "read": self.default[1],
+                "byOperation": dict((operation, read) for operation, (connect, read) in self.byOperation.items())}
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+    A call was not sent: its circuit is open after calls like it failed
+    """
+    def __init__(self, circuit, retryIn):
+        requests.ConnectionError.__init__(
+            self, "Circuit open for %s calls to %s after %d failures, retry in %.1f seconds" % (
+                circuit.operation, circuit.endpoint, circuit.failures, retryIn))
+        self.circuit = circuit
+
+
+class _Circuit:
+    def __init__(self, endpoint, operation):
+        self.endpoint = endpoint
+        self.operation = operation
+        self.state = CLOSED
+        # Calls that failed in a row
+        self.failures = 0
+        self.retryAt = None
+        # Trial calls in flight while half open
+        self.trials = 0
+        self.opened = 0
+        self.rejected = 0
+        self.lastError = None
+
+    def toDict(self):
+        return {"endpoint": self.endpoint, "operation": self.operation, "state": self.state,
+                "failures": self.failures, "opened": self.opened, "rejected": self.rejected,
+                "lastError": self.lastError}
+
+
+class CircuitBreaker:
+    """
+    Circuits per listener endpoint and operation, shared by every call of a process
+    """
+    def __init__(self, failures=DEFAULT_FAILURES, resetSeconds=DEFAULT_RESET_SECONDS,
+                 halfOpenCalls=DEFAULT_HALF_OPEN_CALLS):
+        self.failures = failures
+        self.resetSeconds = resetSeconds
+        self.halfOpenCalls = halfOpenCalls
+        self.circuits = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, url, operation):
+        """
+        Let a call through, or refuse it while its circuit is open. Every call
+        let through must be followed by success, failure or release.
+
+        :returns: (the call's circuit)
+        :raises CircuitOpenError:
+        """
+        key = (endpointOf(url), operation)
+        with self.lock:
+            circuit = self.circuits.get(key)
+            if circuit is None:
+                circuit = self.circuits[key] = _Circuit(*key)
+            if circuit.state == CLOSED:
+                return circuit
+            now = time.monotonic()
+            if circuit.state == OPEN and now >= circuit.retryAt:
+                circuit.state = HALF_OPEN
+                circuit.trials = 0
+            if circuit.state == HALF_OPEN and circuit.trials < self.halfOpenCalls:
+                circuit.trials += 1
+                return circuit
+            circuit.rejected += 1
+            retryIn = max(0.0, circuit.retryAt - now)
+        raise CircuitOpenError(circuit, retryIn)
+
+    def success(self, circuit):
+        with self.lock:
+            if circuit.state != CLOSED:
+                logging.info("Circuit for %s calls to %s closed", circuit.operation, circuit.endpoint)
+            circuit.state = CLOSED
+            circuit.failures = 0
+            circuit.trials = 0
+
+    def failure(self, circuit, error):
+        with self.lock:
+            circuit.failures += 1
+            circuit.lastError = str(error)
+            if circuit.state == OPEN:
+                return
+            if circuit.state == HALF_OPEN or circuit.failures >= self.failures:
+                if circuit.state == CLOSED:
+                    logging.warning("Circuit for %s calls to %s opened after %d failures: %s",
+                                    circuit.operation, circuit.endpoint, circuit.failures, error)
+                circuit.state = OPEN
+                circuit.retryAt = time.monotonic() + self.resetSeconds
+                circuit.opened += 1
+
+    def release(self, circuit):
+        """
+        The call ended without saying anything about the listener
+        """
+        with self.lock:
+            if circuit.state == HALF_OPEN and circuit.trials:
+                circuit.trials -= 1
+
+    def stats(self):
+        with self.lock:
+            circuits = [circuit.toDict() for key, circuit in sorted(self.circuits.items())]
+        return {"failures": self.failures, "resetSeconds": self.resetSeconds, "halfOpenCalls": self.halfOpenCalls,
+                "circuits": circuits}
+
+
+class _Latencies:
+    def __init__(self):
+        self.samples = collections.deque(maxlen=LATENCY_WINDOW)
+        self.delay = None
+        # Samples added since the delay was computed
+        self.fresh = 0
+
+
+def _discard(future):
+    # The reply that lost the race: give its connection back to the pool
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class Hedger:
+    """
+    Sends a second copy of a slow read and keeps the first reply
+    """
+    def __init__(self, percentile=DEFAULT_HEDGE_PERCENTILE, maxRatio=DEFAULT_HEDGE_RATIO, minDelay=0.001,
+                 workers=32):
+        self.percentile = percentile
+        self.maxRatio = maxRatio
+        self.minDelay = minDelay
+        self.latencies = {}
+        self.calls = 0
+        self.hedged = 0
+        self.won = 0
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hedge")
+
+    def key(self, method, url, operation, cookies=None):
+        """
+        :returns: (endpoint and kind of read to hedge the call under, or None if it must be sent once)
+        """
+        read = hedgeOperation(method, url, operation, cookies)
+        return None if read is None else (endpointOf(url), read)
+
+    def _delay(self, key):
+        latencies = self.latencies.get(key)
+        if latencies is None or len(latencies.samples) < MIN_SAMPLES:
+            return None
+        if latencies.delay is None or latencies.fresh >= LATENCY_WINDOW // 10:
+            ordered = sorted(latencies.samples)
+            latencies.delay = max(self.minDelay, ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))])
+            latencies.fresh = 0
+        return latencies.delay
+
+    def _timed(self, key, call):
+        start = time.perf_counter()
+        reply = call()
+        seconds = time.perf_counter() - start
+        with self.lock:
+            latencies = self.latencies.get(key)
+            if latencies is None:
+                latencies = self.latencies[key] = _Latencies()
+            latencies.samples.append(seconds)
+            latencies.fresh += 1
+        return reply
+
+    def _mayHedge(self):
+        return self.hedged < self.maxRatio * self.calls
+
+    def send(self, key, call):
+        """
+        Carry out call(), and carry it out a second time if the first has not
+        returned within the hedging delay of key
+
+        :param key: (hashable endpoint and kind of read)
+        :param call: (function sending the read, returning a requests.Response)
+        :returns: (the first reply; if both calls fail, the first call's error is raised)
+        """
+        with self.lock:
+            self.calls += 1
+            delay = self._delay(key) if self._mayHedge() else None
+        if delay is None:
+            return self._timed(key, call)
+
+        first = self.pool.submit(self._timed, key, call)
+        if wait([first], timeout=delay).done:
+            return first.result()
+        with self.lock:
+            if not self._mayHedge():
+                delay = None
+            else:
+                self.hedged += 1
+        if delay is None:
+            return first.result()
+        second = self.pool.submit(self._timed, key, call)
+
+        futures = (first, second)
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in futures:
+                if future in done and future.exception() is None:
+                    for other in futures:
+                        if other is not future:
+                            other.add_done_callback(_discard)
+                    if future is second:
+                        with self.lock:
+                            self.won += 1
+                    return future.result()
+        return first.result()
+
+    def stats(self):
+        with self.lock:
+            delays = [{"endpoint": endpoint, "operation": operation, "samples": len(latencies.samples),
+                       "delay": latencies.delay}
+                      for (endpoint, operation), latencies in sorted(self.latencies.items())]
+            return {"percentile": self.percentile, "maxRatio": self.maxRatio, "calls": self.calls,
+                    "hedged": self.hedged, "won": self.won, "delays": delays}
+
+    def close(self):
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,396 @@
+##
+# Pooled REST client for the Informix REST listener
+##
+
+import asyncio
+import functools
+import time
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.cookies import RequestsCookieJar
+from requests.packages.urllib3.exceptions import MaxRetryError
+from requests.packages.urllib3.util.retry import Retry
+
+import jsoncodec
+
+# Listener replies that are worth retrying: the listener or a proxy in front
+# of it is restarting or overloaded.
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+# Cookies that belong to one query rather than to the listener session. They are
+# left on the reply for the caller paging through that query to send back.
+CURSOR_COOKIES = ("cursorId",)
+
+# Operations that only read, and so may be sent again when their reply is lost. Many
+# listener writes are GETs ($cmd insert, create and drop, system.sql commit and execute).
+READ_OPERATIONS = ("find", "count", "distinct")
+
+# $cmd commands reported as an operation of their own
+COMMAND_OPERATIONS = ("count", "distinct")
+# $cmd commands whose argument names the target collection or table
+TARGET_COMMANDS = ("count", "distinct", "collstats", "create", "drop")
+
+
+def answeredLocally(reply):
+    """
+    :returns: (whether a reply was made in this process, by a ResultCache or a
+               SnapshotStore, instead of coming from the listener)
+    """
+    return getattr(reply, "local", False)
+
+
+def splitUrl(url, params=None):
+    """
+    Split a listener url of the form <scheme>://<host>/<database>[/<name>]
+
+    :returns: (database, name or None, dict of query parameters)
+    """
+    parts = urlsplit(url)
+    segments = [unquote(segment) for segment in parts.path.strip("/").split("/")]
+    database = parts.netloc + "/" + segments[0]
+    name = "/".join(segments[1:]) or None
+    args = parse_qsl(parts.query)
+    if isinstance(params, dict):
+        args.extend(params.items())
+    elif params:
+        args.extend(parse_qsl(params))
+    return database, name, dict(args)
+
+
+def classifyCall(method, url, params=None):
+    """
+    The kind of listener call a request is, and the collection or table it is about
+
+    :returns: (operation, target): operation is one of find, insert, update,
+        delete, count, distinct, sql, join or command
+    """
+    database, name, args = splitUrl(url, params)
+    if name is None:
+        return "command", ""
+    if name == "$cmd":
+        try:
+            command = jsoncodec.loads(args["query"])
+            kind = next(iter(command))
+        except (KeyError, ValueError, TypeError, StopIteration):
+            return "command", ""
+        target = command[kind] if kind in TARGET_COMMANDS and isinstance(command[kind], str) else ""
+        return (kind if kind in COMMAND_OPERATIONS else "command"), target
+    if name == "system.sql":
+        return "sql", ""
+    if name == "system.join":
+        return "join", ""
+    if method == "POST":
+        return "insert", name
+    if method == "PUT":
+        return "update", name
+    if method == "DELETE":
+        return "delete", name
+    return "find", name
+
+
+class _RejectAllCookies(DefaultCookiePolicy):
+    """
+    Cookie policy for the shared requests.Session.
+
+    The listener session id lives in a cookie. The pooled session is shared
+    by every Flask request, so it must never store that cookie itself; each
+    ListenerSession keeps its own jar instead.
+    """
+    def set_ok(self, cookie, request):
+        return False
+
+
+class RestClient:
+    """
+    Reusable REST client built around a pooled requests.Session.
+
+    Connections to the listener are kept alive and reused across calls and
+    across Flask requests. Reads (finds, counts and distincts) are retried
+    with exponential backoff on 5xx replies, timeouts and connection resets;
+    a write is never sent twice, since it may have been carried out even when
+    its reply was lost. Connection failures are retried for every call since
+    nothing has reached the listener yet.
+    With a ResultCache, slowly changing reads are served from the cache; with
+    ListenerMetrics, every call that reaches the listener is measured. With
+    health, such as the config module, an endpoint that cannot be connected
+    to is marked down so the next database url is another one. With a
+    SnapshotStore, reads it can answer never reach the listener, and writes
+    are passed on to it. The resilience module supplies timeouts by kind of
+    call, a CircuitBreaker that fails calls at once while their circuit is
+    open, and a Hedger that sends a slow read a second time.
+    """
+    def __init__(self, poolSize=10, keepAlive=True, retries=3, backoffFactor=0.2, timeout=None, cache=None,
+                 metrics=None, health=None, snapshots=None, timeouts=None, breaker=None, hedger=None):
+        self.poolSize = poolSize
+        self.keepAlive = keepAlive
+        self.timeout = timeout
+        self.cache = cache
+        self.metrics = metrics
+        self.health = health
+        self.snapshots = snapshots
+        self.timeouts = timeouts
+        self.breaker = breaker
+        self.hedger = hedger
+        self.retries = retries
+        self.backoffFactor = backoffFactor
+
+        # Only failures to connect are retried here; reads are retried by _retried
+        retry = Retry(total=retries, connect=retries, read=False, status=0, backoff_factor=backoffFactor,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize,
+                              max_retries=retry, pool_block=False)
+
+        self.session = requests.Session()
+        self.session.cookies.set_policy(_RejectAllCookies())
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if not keepAlive:
+            self.session.headers["Connection"] = "close"
+
+    def request(self, method, url, data=None, cookies=None, **kwargs):
+        """
+        Send a request through the shared connection pool
+
+        :returns: (requests.Response)
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        if self.snapshots is None:
+            return self._cached(method, url, data, cookies, kwargs)
+        reply = self.snapshots.answer(method, url, kwargs.get("params"), cookies)
+        if reply is not None:
+            return reply
+        reply = self._cached(method, url, data, cookies, kwargs)
+        self.snapshots.written(method, url, kwargs.get("params"), data, reply, cookies)
+        return reply
+
+    def _cached(self, method, url, data, cookies, kwargs):
+        if self.cache is None or kwargs.get("stream"):
+            return self._send(method, url, data, cookies, kwargs)
+
+        plan = self.cache.plan(method, url, kwargs.get("params"))
+        if plan.key is not None:
+            reply = self.cache.get(plan)
+            if reply is not None:
+                return reply
+            version = self.cache.version
+        reply = self._send(method, url, data, cookies, kwargs)
+        if plan.key is not None:
+            self.cache.put(plan, reply, version)
+        elif plan.invalidates is not None:
+            self.cache.invalidate(plan)
+        return reply
+
+    def _send(self, method, url, data, cookies, kwargs):
+        if self.timeouts is None and self.breaker is None and self.hedger is None:
+            return self._checked(method, url, data, cookies, kwargs, None)
+
+        call = classifyCall(method, url, kwargs.get("params"))
+        if self.timeouts is not None and kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeouts.get(call[0])
+        circuit = self.breaker.acquire(url, call[0]) if self.breaker is not None else None
+        try:
+            key = self.hedger.key(method, url, call[0], cookies) if self.hedger is not None else None
+            if key is None:
+                reply = self._checked(method, url, data, cookies, kwargs, call)
+            else:
+                send = functools.partial(self._checked, method, url, data, cookies, kwargs, call)
+                reply = self.hedger.send(key, send)
+        except requests.RequestException as e:
+            if circuit is not None:
+                self.breaker.failure(circuit, e)
+            raise
+        except BaseException:
+            if circuit is not None:
+                self.breaker.release(circuit)
+            raise
+        if circuit is not None:
+            if reply.status_code in RETRY_STATUS_CODES:
+                self.breaker.failure(circuit, "status code %d" % reply.status_code)
+            else:
+                self.breaker.success(circuit)
+        return reply
+
+    def _checked(self, method, url, data, cookies, kwargs, call):
+        if self.health is None:
+            return self._measure(method, url, data, cookies, kwargs, call)
+        try:
+            reply = self._measure(method, url, data, cookies, kwargs, call)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            self.health.markDown(url, e)
+            raise
+        self.health.markUp(url)
+        return reply
+
+    def _measure(self, method, url, data, cookies, kwargs, call):
+        if self.metrics is None:
+            return self._retried(method, url, data, cookies, kwargs, call)
+        call = call or self.metrics.classify(method, url, kwargs.get("params"))
+        operation, target = call
+        start = time.perf_counter()
+        try:
+            reply = self._retried(method, url, data, cookies, kwargs, call)
+        except requests.RequestException:
+            self.metrics.record(operation, target, time.perf_counter() - start, None, "exception")
+            raise
+        if kwargs.get("stream"):
+            size = reply.headers.get("Content-Length")
+            size = int(size) if size is not None else None
+        else:
+            size = len(reply.content)
+        self.metrics.record(operation, target, time.perf_counter() - start, size, reply.status_code)
+        return reply
+
+    def _isRead(self, method, url, cookies, kwargs, call):
+        if method != "GET":
+            return False
+        # The next batch of a cursor is handed out once; asking again would skip one
+        if cookies and any(name in cookies for name in CURSOR_COOKIES):
+            return False
+        return (call or classifyCall(method, url, kwargs.get("params")))[0] in READ_OPERATIONS
+
+    def _retried(self, method, url, data, cookies, kwargs, call):
+        """
+        Send a call, and send a read again after a 5xx reply, a timeout or a
+        reset connection
+        """
+        if self.retries <= 0 or not self._isRead(method, url, cookies, kwargs, call):
+            return self.session.request(method, url, data=data, cookies=cookies, **kwargs)
+        attempt = 0
+        while True:
+            try:
+                reply = self.session.request(method, url, data=data, cookies=cookies, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # A MaxRetryError means urllib3 already gave up connecting
+                if attempt >= self.retries or (e.args and isinstance(e.args[0], MaxRetryError)):
+                    raise
+            else:
+                if reply.status_code not in RETRY_STATUS_CODES or attempt >= self.retries:
+                    return reply
+                reply.close()
+            time.sleep(self.backoffFactor * (2 ** attempt))
+            attempt += 1
+
+    def poolStats(self):
+        """
+        Connections opened, idle and in use across this client's pools
+
+        :returns: (dict)
+        """
+        stats = {"pools": 0, "connections": 0, "idle": 0, "inUse": 0, "requests": 0}
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                stats["pools"] += 1
+                stats["connections"] += pool.num_connections
+                stats["requests"] += pool.num_requests
+                if pool.pool is None:
+                    continue
+                # The queue holds an open connection or a None placeholder per free slot
+                free = list(pool.pool.queue)
+                stats["idle"] += sum(1 for conn in free if conn is not None)
+                stats["inUse"] += pool.pool.maxsize - len(free)
+        return stats
+
+    def newSession(self):
+        """
+        Start a new listener session that shares this client's connection pool
+
+        :returns: (ListenerSession)
+        """
+        return ListenerSession(self)
+
+    def close(self):
+        if self.hedger is not None:
+            self.hedger.close()
+        self.session.close()
+
+
+class ListenerSession:
+    """
+    One listener session: a cookie jar layered over a shared RestClient.
+
+    The first reply from the listener carries the session id cookie. In order
+    to reuse the same listener session on subsequent REST requests, that
+    cookie is sent along with every later request made through this object.
+    Extra cookies passed to a single request are sent with that request only.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.cookies = RequestsCookieJar()
+
+    def request(self, method, url, data=None, cookies=None, **kwargs):
+        jar = self.cookies
+        if cookies:
+            jar = self.cookies.copy()
+            jar.update(cookies)
+        reply = self.client.request(method, url, data=data, cookies=jar, **kwargs)
+        for cookie in reply.cookies:
+            if cookie.name not in CURSOR_COOKIES:
+                self.cookies.set_cookie(cookie)
+        return reply
+
+    def get(self, url, params=None, **kwargs):
+        return self.request("GET", url, params=params, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request("PUT", url, data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+class AsyncListenerSession:
+    """
+    asyncio interface to a ListenerSession.
+
+    Each call is carried out by the blocking, pooled client on an executor
+    thread, so coroutines can have several listener calls in flight at once
+    while still sharing the connection pool and the session cookie. Until a
+    first call has come back, calls are sent one at a time: the first reply
+    carries the session cookie, and calls sent before it would each open a
+    listener session of their own.
+    """
+    def __init__(self, session, executor=None):
+        self.session = session
+        self.executor = executor
+        self.opened = False
+        # Created on first use, inside the event loop that runs the calls
+        self.opening = None
+
+    async def request(self, method, url, data=None, **kwargs):
+        if not self.opened:
+            if self.opening is None:
+                self.opening = asyncio.Lock()
+            async with self.opening:
+                if not self.opened:
+                    try:
+                        return await self._run(method, url, data, kwargs)
+                    finally:
+                        self.opened = True
+        return await self._run(method, url, data, kwargs)
+
+    async def _run(self, method, url, data, kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(self.session.request, method, url, data, **kwargs))
+
+    async def get(self, url, params=None, **kwargs):
+        return await self.request("GET", url, params=params, **kwargs)
+
+    async def post(self, url, data=None, **kwargs):
+        return await self.request("POST", url, data, **kwargs)
+
+    async def put(self, url, data=None, **kwargs):
+        return await self.request("PUT", url, data, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request("DELETE", url, **kwargs)
@@ -0,0 +1,167 @@
+##
+# Read-through cache for slowly changing listener reads
+#
+# Catalog listings and the count, distinct, collstats and dbstats commands are
+# cached per endpoint and normalized query. Writes issued through the same
+# client invalidate what they may have changed.
+##
+
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+import jsoncodec
+from restclient import splitUrl
+
+# Seconds a cached reply stays fresh, per kind of read
+DEFAULT_TTLS = {"catalog": 30.0, "count": 5.0, "distinct": 5.0, "collstats": 30.0, "dbstats": 30.0}
+
+# $cmd commands that only read
+READ_COMMANDS = ("count", "distinct", "collstats", "dbstats")
+
+# Parameters that make up the cache key, JSON-valued ones are normalized
+KEY_PARAMS = ("query", "sort", "fields", "options")
+
+
+def _normalize(value):
+    try:
+        return jsoncodec.dumpsText(_sortKeys(jsoncodec.loads(value)))
+    except ValueError:
+        return value
+
+
+def _sortKeys(value):
+    if isinstance(value, dict):
+        return dict((key, _sortKeys(value[key])) for key in sorted(value))
+    if isinstance(value, list):
+        return [_sortKeys(item) for item in value]
+    return value
+
+
+# Invalidate every cached read of a database
+ALL = object()
+
+
+class _Plan:
+    """
+    What to do with one request: serve it from the cache under key, or
+    invalidate entries once it has been sent.
+    """
+    def __init__(self, key=None, kind=None, target=None, invalidates=None):
+        self.key = key
+        self.kind = kind
+        self.target = target
+        # (database, name) drops cached reads of name, (database, ALL) of the whole database
+        self.invalidates = invalidates
+
+
+class ResultCache:
+    """
+    Size-bounded LRU cache of listener replies with per-kind TTLs.
+
+    Urls are expected in the listener's form <scheme>://<host>/<database>[/<name>].
+    """
+    def __init__(self, maxSize=256, ttls=None):
+        self.maxSize = maxSize
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def plan(self, method, url, params=None):
+        database, name, args = splitUrl(url, params)
+
+        if method != "GET":
+            return _Plan(invalidates=(database, name) if name else (database, ALL))
+        if name is None:
+            return self._readPlan("catalog", database, None, url, args)
+        if name == "$cmd":
+            try:
+                command = jsoncodec.loads(args["query"])
+            except (KeyError, ValueError):
+                command = None
+            if not isinstance(command, dict) or not command:
+                return _Plan(invalidates=(database, ALL))
+            kind = next(iter(command))
+            if kind not in READ_COMMANDS:
+                # create, drop, transaction and other commands change state
+                return _Plan(invalidates=(database, ALL))
+            target = command[kind] if kind != "dbstats" else None
+            return self._readPlan(kind, database, target, url, args)
+        if name == "system.sql":
+            return _Plan(invalidates=(database, ALL))
+        return _Plan()
+
+    def _readPlan(self, kind, database, target, url, args):
+        if not self.ttls.get(kind):
+            return _Plan()
+        base = url.split("?", 1)[0].rstrip("/")
+        key = (base, tuple((param, _normalize(args[param])) for param in KEY_PARAMS if param in args))
+        return _Plan(key=key, kind=kind, target=(database, target))
+
+    def get(self, plan):
+        """
+        :returns: (cached reply, or None)
+        """
+        with self.lock:
+            entry = self.entries.get(plan.key)
+            if entry is not None and entry[0] > time.time():
+                self.entries.move_to_end(plan.key)
+                self.hits += 1
+                return entry[2]
+            if entry is not None:
+                del self.entries[plan.key]
+            self.misses += 1
+            return None
+
+    def put(self, plan, reply, version):
+        """
+        Store a successful read, unless a write was seen since it was sent
+        """
+        if reply.status_code != 200:
+            return
+        cached = requests.Response()
+        cached.status_code = reply.status_code
+        cached._content = reply.content
+        # The body is complete, so iter_content slices it rather than reading a socket
+        cached._content_consumed = True
+        cached.headers = reply.headers
+        cached.encoding = reply.encoding
+        cached.url = reply.url
+        # The session cookie belongs to the listener session that made the request
+        cached.cookies = requests.cookies.RequestsCookieJar()
+        # Not from the listener: see restclient.answeredLocally
+        cached.local = True
+        with self.lock:
+            if version != self.version:
+                return
+            self.entries[plan.key] = (time.time() + self.ttls[plan.kind], plan.target, cached)
+            self.entries.move_to_end(plan.key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, plan):
+        database, name = plan.invalidates
+        with self.lock:
+            self.version += 1
+            for key, (expires, target, reply) in list(self.entries.items()):
+                if target[0] != database:
+                    continue
+                # Database-wide reads (catalog, dbstats) change with any write
+                if name is ALL or target[1] is None or target[1] == name:
+                    del self.entries[key]
+                    self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "maxSize": self.maxSize, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions, "invalidations": self.invalidations}
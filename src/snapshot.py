@@ -0,0 +1,654 @@
+##
+# In-process snapshots of small, rarely changing collections and tables
+#
+# Selected collections and tables are loaded in bulk into column arrays, with
+# hash and sorted indexes on chosen fields. Finds, counts and distincts whose
+# queries use only equality, $eq, $gt, $gte, $lt, $lte and $in on plain
+# values are then answered from the snapshot instead of the listener; anything
+# else is sent to the listener as before.
+#
+# A snapshot is reloaded on a schedule. Updates with $set and deletes made
+# through this process are applied to it directly; any other write from this
+# process marks it stale, and it is not used until it has been reloaded.
+# Writes from other processes show once the snapshot is next reloaded.
+##
+
+import bisect
+import fnmatch
+import logging
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+import requests
+
+import jsoncodec
+from querystream import QueryError, iterQuery
+from restclient import CURSOR_COOKIES, splitUrl
+
+DEFAULT_MAX_DOCUMENTS = 50000
+DEFAULT_REFRESH_SECONDS = 300.0
+DEFAULT_MAX_SNAPSHOTS = 64
+# A transaction never disabled stops holding back its database's snapshots after this long
+DEFAULT_TRANSACTION_SECONDS = 600.0
+LOAD_BATCH_SIZE = 10000
+
+OPERATORS = ("$eq", "$gt", "$gte", "$lt", "$lte", "$in")
+_RANGES = ("$gt", "$gte", "$lt", "$lte")
+_SCALARS = (str, int, float, bool)
+# Parameters of a find the snapshot understands; batchsize does not change the result
+_FIND_PARAMS = ("query", "sort", "fields", "batchsize")
+# A field that a document does not have
+_MISSING = object()
+
+
+class Unsupported(Exception):
+    """
+    A request the snapshot cannot answer exactly as the listener would
+    """
+
+
+def parseSnapshots(text):
+    """
+    Parse a SNAPSHOTS setting: entries separated by ";", each a collection or
+    table name, which may use * wildcards, and optionally "=" and the fields
+    to index separated by ",", e.g. "*codeTable=countryCode;*pythonRESTGalaxy=countryCode,longitude"
+
+    :returns: (dict of name pattern to [field])
+    """
+    specs = OrderedDict()
+    for entry in text.split(";"):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, fields = entry.partition("=")
+        specs[name.strip()] = [field.strip() for field in fields.split(",") if field.strip()]
+    return specs
+
+
+def _plain(value):
+    return value is _MISSING or value is None or isinstance(value, _SCALARS)
+
+
+def _column(values):
+    """
+    A typed array when every value is an integer, or every value a float;
+    a list otherwise
+    """
+    if values and all(type(value) is int for value in values):
+        try:
+            return array("q", values)
+        except OverflowError:
+            return values
+    if values and all(type(value) is float for value in values):
+        return array("d", values)
+    return values
+
+
+def _test(op, value, arg):
+    # Missing fields compare as null, as in the listener's queries
+    if value is _MISSING:
+        value = None
+    if op == "$eq":
+        return value == arg
+    if op == "$in":
+        return value in arg
+    if value is None or arg is None:
+        return False
+    try:
+        if op == "$gt":
+            return value > arg
+        if op == "$gte":
+            return value >= arg
+        if op == "$lt":
+            return value < arg
+        return value <= arg
+    except TypeError:
+        # Values of different types never match a range
+        return False
+
+
+def _conditions(query, data):
+    """
+    Conditions on fields whose values are all scalars or missing
+
+    :returns: ([(field, [(operator, argument)])])
+    """
+    if query is None:
+        return []
+    if not isinstance(query, dict):
+        raise Unsupported()
+    conditions = []
+    for field, condition in query.items():
+        if field.startswith("$") or "." in field or (field in data.columns and field not in data.plain):
+            raise Unsupported()
+        if isinstance(condition, dict):
+            if not condition or any(op not in OPERATORS for op in condition):
+                raise Unsupported()
+            tests = list(condition.items())
+        else:
+            tests = [("$eq", condition)]
+        for op, arg in tests:
+            if op == "$in":
+                if not isinstance(arg, list) or not all(_plain(item) for item in arg):
+                    raise Unsupported()
+            elif not _plain(arg):
+                raise Unsupported()
+        conditions.append((field, tests))
+    return conditions
+
+
+class _Data:
+    """
+    The documents of one load, held as columns with their indexes. Never
+    changed once built, so it is read without a lock.
+    """
+    def __init__(self, docs, indexed):
+        fields = OrderedDict()
+        for doc in docs:
+            for field in doc:
+                fields[field] = None
+        self.fields = list(fields)
+        self.size = len(docs)
+        self.columns = {}
+        self.plain = set()
+        for field in self.fields:
+            values = [doc.get(field, _MISSING) for doc in docs]
+            if all(_plain(value) for value in values):
+                self.plain.add(field)
+            self.columns[field] = _column(values) if _MISSING not in values else values
+        self.hashes = {}
+        self.sorted = {}
+        for field in indexed:
+            if field in self.plain:
+                self._index(field)
+
+    def _index(self, field):
+        column = self.columns[field]
+        hashed = {}
+        for position, value in enumerate(column):
+            hashed.setdefault(None if value is _MISSING else value, array("l")).append(position)
+        self.hashes[field] = hashed
+        present = [(value, position) for position, value in enumerate(column)
+                   if value is not _MISSING and value is not None]
+        try:
+            present.sort()
+        except TypeError:
+            # Values of several types have no single order; ranges scan instead
+            return
+        self.sorted[field] = ([value for value, position in present],
+                              array("l", [position for value, position in present]))
+
+    def value(self, field, position):
+        column = self.columns.get(field)
+        return _MISSING if column is None else column[position]
+
+    def document(self, position):
+        doc = {}
+        for field in self.fields:
+            value = self.columns[field][position]
+            if value is not _MISSING:
+                doc[field] = value
+        return doc
+
+    def _lookup(self, field, tests):
+        """
+        :returns: (set of positions that may match or None when no index helps,
+                   and whether the indexes decided every test so the set is exact)
+        """
+        found = None
+        exact = True
+        for op, arg in tests:
+            positions = None
+            if op in ("$eq", "$in") and field in self.hashes:
+                hashed = self.hashes[field]
+                positions = set()
+                for item in (arg if op == "$in" else [arg]):
+                    try:
+                        positions.update(hashed.get(item, ()))
+                    except TypeError:
+                        pass
+            elif op in _RANGES and field in self.sorted and arg is not None:
+                keys, order = self.sorted[field]
+                try:
+                    if op in ("$gt", "$gte"):
+                        start = bisect.bisect_right(keys, arg) if op == "$gt" else bisect.bisect_left(keys, arg)
+                        positions = set(order[start:])
+                    else:
+                        end = bisect.bisect_left(keys, arg) if op == "$lt" else bisect.bisect_right(keys, arg)
+                        positions = set(order[:end])
+                except TypeError:
+                    positions = set()
+            if positions is None:
+                exact = False
+            else:
+                found = positions if found is None else found & positions
+        return found, exact and found is not None
+
+    def select(self, query):
+        """
+        :returns: ([position] of the matching documents, in load order)
+        """
+        conditions = _conditions(query, self)
+        candidates = None
+        remaining = []
+        for field, tests in conditions:
+            found, exact = self._lookup(field, tests)
+            if found is not None:
+                candidates = found if candidates is None else candidates & found
+            if not exact:
+                remaining.append((field, tests))
+        positions = range(self.size) if candidates is None else sorted(candidates)
+        if not remaining:
+            return list(positions)
+        return [position for position in positions
+                if all(_test(op, self.value(field, position), arg) for field, tests in remaining for op, arg in tests)]
+
+
+def _project(doc, fields):
+    if not fields:
+        return doc
+    flags = set(bool(flag) for field, flag in fields.items() if field != "_id")
+    if len(flags) > 1:
+        raise Unsupported()
+    if True in flags:
+        return dict((field, value) for field, value in doc.items()
+                    if fields.get(field, 1 if field == "_id" else 0))
+    return dict((field, value) for field, value in doc.items() if fields.get(field, 1))
+
+
+def _sort(data, positions, sort):
+    """
+    Sort like the listener, for fields that hold one type and are never null;
+    other orders are left to the listener
+    """
+    if not isinstance(sort, dict):
+        raise Unsupported()
+    for field, direction in reversed(list(sort.items())):
+        if field not in data.plain or direction not in (1, -1):
+            raise Unsupported()
+        column = data.columns[field]
+        if any(column[position] is _MISSING or column[position] is None for position in positions):
+            raise Unsupported()
+        try:
+            positions.sort(key=column.__getitem__, reverse=direction < 0)
+        except TypeError:
+            raise Unsupported()
+    return positions
+
+
+def _sessionOf(cookies, reply):
+    """
+    The listener session a call was made in: its cookies other than cursors,
+    or for the first call of a session, the cookies its reply set
+    """
+    pairs = [(name, value) for name, value in (cookies.items() if cookies else []) if name not in CURSOR_COOKIES]
+    if not pairs:
+        pairs = [(name, value) for name, value in reply.cookies.items() if name not in CURSOR_COOKIES]
+    return tuple(sorted(pairs))
+
+
+def _reply(value):
+    reply = requests.Response()
+    reply.status_code = 200
+    reply._content = jsoncodec.dumps(value)
+    # The body is complete, so iter_content slices it rather than reading a socket
+    reply._content_consumed = True
+    reply.headers["Content-Type"] = "application/json"
+    reply.encoding = "utf-8"
+    # Not from the listener: see restclient.answeredLocally
+    reply.local = True
+    return reply
+
+
+class Snapshot:
+    """
+    One collection or table, reloaded whole and swapped in when it is stale
+    """
+    def __init__(self, url, name, indexes):
+        self.url = url
+        self.name = name
+        self.indexes = list(indexes)
+        self.data = None
+        self.stale = True
+        self.tooLarge = False
+        # Changes whenever the snapshot goes stale or a write is applied, so
+        # a load that overlapped a write is not swapped in
+        self.version = 0
+        self.loadedAt = None
+        self.loadSeconds = None
+        self.lock = threading.Lock()
+
+    def usable(self):
+        return self.data is not None and not self.stale
+
+    def load(self, session, maxDocuments):
+        with self.lock:
+            version = self.version
+        start = time.perf_counter()
+        docs = []
+        for doc in iterQuery(session, self.url, batchSize=LOAD_BATCH_SIZE):
+            docs.append(doc)
+            if len(docs) > maxDocuments:
+                with self.lock:
+                    self.tooLarge = True
+                    self.data = None
+                logging.warning("Snapshot of %s not kept: more than %d documents", self.name, maxDocuments)
+                return
+        data = _Data(docs, self.indexes)
+        with self.lock:
+            if self.version != version:
+                return
+            self.data = data
+            self.stale = False
+            self.tooLarge = False
+            self.loadedAt = time.time()
+            self.loadSeconds = time.perf_counter() - start
+
+    def markStale(self):
+        with self.lock:
+            self.stale = True
+            self.version += 1
+
+    def apply(self, query, update, n):
+        """
+        Apply a write the listener carried out: a delete when update is None,
+        otherwise an update with $set. Marks the snapshot stale instead if the
+        write cannot be repeated exactly or matched a different number of
+        documents here.
+        """
+        with self.lock:
+            if self.data is None or self.stale:
+                return
+            data = self.data
+            try:
+                if update is not None and (not isinstance(update, dict) or list(update) != ["$set"] or
+                                           any(field.startswith("$") or "." in field for field in update["$set"])):
+                    raise Unsupported()
+                matched = set(data.select(query))
+            except Unsupported:
+                matched = None
+            if matched is None or len(matched) != n:
+                self.stale = True
+                self.version += 1
+                return
+            docs = []
+            for position in range(data.size):
+                doc = data.document(position)
+                if position in matched:
+                    if update is None:
+                        continue
+                    doc.update(update["$set"])
+                docs.append(doc)
+            self.data = _Data(docs, self.indexes)
+            self.version += 1
+
+    def find(self, query, sort, fields):
+        data = self.data
+        positions = data.select(query)
+        if sort:
+            positions = _sort(data, positions, sort)
+        return [_project(data.document(position), fields) for position in positions]
+
+    def count(self, query):
+        return len(self.data.select(query))
+
+    def distinct(self, key, query):
+        data = self.data
+        if key not in data.plain:
+            raise Unsupported()
+        values = []
+        seen = set()
+        for position in data.select(query):
+            value = data.value(key, position)
+            if value is _MISSING or value in seen:
+                continue
+            seen.add(value)
+            values.append(value)
+        return values
+
+    def toDict(self):
+        data = self.data
+        return {"name": self.name, "indexes": self.indexes, "documents": data.size if data is not None else None,
+                "stale": self.stale, "tooLarge": self.tooLarge, "loadedAt": self.loadedAt,
+                "loadSeconds": self.loadSeconds}
+
+
+class SnapshotStore:
+    """
+    The snapshots of one process, answering reads a RestClient would otherwise
+    send to the listener
+
+    A snapshot is made the first time a collection or table matching specs is
+    read, and loaded in the background; until it is loaded, reads go to the
+    listener. While a listener session has a transaction open on a database,
+    none of its snapshots are used, since the listener would show that
+    transaction's uncommitted writes. A session that never disables its
+    transaction stops counting after transactionSeconds.
+    """
+    def __init__(self, specs, maxDocuments=DEFAULT_MAX_DOCUMENTS, refreshSeconds=DEFAULT_REFRESH_SECONDS,
+                 maxSnapshots=DEFAULT_MAX_SNAPSHOTS, transactionSeconds=DEFAULT_TRANSACTION_SECONDS):
+        self.specs = specs
+        self.maxDocuments = maxDocuments
+        self.refreshSeconds = refreshSeconds
+        self.maxSnapshots = maxSnapshots
+        self.transactionSeconds = transactionSeconds
+        self.snapshots = OrderedDict()
+        # Database to {listener session: when it enabled transactions}
+        self.transactions = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.wake = threading.Event()
+        self.client = None
+        self.thread = None
+        # Process the refresh thread runs in
+        self.pid = None
+        self.stopping = False
+        self.hits = 0
+        self.fallbacks = 0
+        self.loads = 0
+
+    def start(self, client):
+        """
+        Load and refresh snapshots through client, in a background thread
+        started when this process makes its first snapshot. A server that
+        imports the application before forking its workers so runs no
+        refresher in the parent, and one in every worker.
+        """
+        self.client = client
+
+    def _startRefresh(self):
+        with self.lock:
+            if self.client is None or self.stopping or (self.thread is not None and self.pid == os.getpid()):
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._refresh, name="snapshots")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join()
+
+    def _indexes(self, name):
+        for pattern, fields in self.specs.items():
+            if fnmatch.fnmatchcase(name, pattern):
+                return fields
+        return None
+
+    def _snapshot(self, databaseUrl, name, create=True):
+        key = (databaseUrl, name)
+        with self.lock:
+            snapshot = self.snapshots.get(key)
+            if snapshot is not None:
+                self.snapshots.move_to_end(key)
+                return snapshot
+            if not create:
+                return None
+            indexes = self._indexes(name)
+            if indexes is None:
+                return None
+            snapshot = self.snapshots[key] = Snapshot(databaseUrl + "/" + name, name, indexes)
+            while len(self.snapshots) > self.maxSnapshots:
+                self.snapshots.popitem(last=False)
+        self._startRefresh()
+        self.wake.set()
+        return snapshot
+
+    def answer(self, method, url, params=None, cookies=None):
+        """
+        :returns: (a reply made from a snapshot, or None to send the request to the listener)
+        """
+        if method != "GET" or getattr(self.local, "loading", False):
+            return None
+        if cookies and any(name in cookies for name in CURSOR_COOKIES):
+            return None
+        database, name, args = splitUrl(url, params)
+        if name is None or name == "system.sql" or name == "system.join" or self._inTransaction(database):
+            return None
+        databaseUrl = url.split("?", 1)[0].rsplit("/", 1)[0]
+        try:
+            if name == "$cmd":
+                command = jsoncodec.loads(args["query"])
+                kind = next(iter(command)) if isinstance(command, dict) and command else None
+                if kind not in ("count", "distinct") or not isinstance(command[kind], str):
+                    return None
+                snapshot = self._snapshot(databaseUrl, command[kind])
+                if snapshot is None or not snapshot.usable():
+                    return self._fallback(snapshot)
+                if kind == "count":
+                    value = [{"count": snapshot.count(command.get("query")), "ok": 1.0}]
+                else:
+                    value = snapshot.distinct(command.get("key"), command.get("query"))
+            else:
+                if any(arg not in _FIND_PARAMS for arg in args):
+                    return None
+                snapshot = self._snapshot(databaseUrl, name)
+                if snapshot is None or not snapshot.usable():
+                    return self._fallback(snapshot)
+                options = dict((arg, jsoncodec.loads(args[arg])) for arg in ("query", "sort", "fields")
+                               if arg in args)
+                value = snapshot.find(options.get("query"), options.get("sort"), options.get("fields"))
+        except (Unsupported, KeyError, ValueError):
+            return self._fallback(snapshot)
+        self.hits += 1
+        return _reply(value)
+
+    def _fallback(self, snapshot):
+        if snapshot is not None:
+            self.fallbacks += 1
+        return None
+
+    def _inTransaction(self, database):
+        if not self.transactions.get(database):
+            return False
+        expired = time.monotonic() - self.transactionSeconds
+        with self.lock:
+            sessions = self.transactions.get(database, {})
+            for session, enabledAt in list(sessions.items()):
+                if enabledAt <= expired:
+                    logging.warning("Snapshots of %s used again: a transaction was not disabled in %.0f seconds",
+                                    database, self.transactionSeconds)
+                    del sessions[session]
+            return bool(sessions)
+
+    def written(self, method, url, params, data, reply, cookies=None):
+        """
+        Bring the snapshots up to date with a request that went to the listener
+        """
+        if method == "GET":
+            database, name, args = splitUrl(url, params)
+            if name not in ("$cmd", "system.sql"):
+                return
+        else:
+            database, name, args = splitUrl(url, params)
+        if reply.status_code not in (200, 201, 202) or name is None:
+            return
+        databaseUrl = url.split("?", 1)[0].rsplit("/", 1)[0]
+        if name == "system.sql":
+            self._staleAll(databaseUrl)
+            return
+        if name == "$cmd":
+            self._command(database, databaseUrl, args, _sessionOf(cookies, reply))
+            return
+        snapshot = self._snapshot(databaseUrl, name, create=False)
+        if snapshot is None:
+            return
+        try:
+            query = jsoncodec.loads(args["query"]) if "query" in args else None
+            if method == "DELETE" and query is None:
+                # Dropped: forget the snapshot
+                with self.lock:
+                    self.snapshots.pop((databaseUrl, name), None)
+            elif method in ("PUT", "DELETE"):
+                n = jsoncodec.loads(reply.content).get("n")
+                snapshot.apply(query, jsoncodec.loads(data) if method == "PUT" else None, n)
+            else:
+                snapshot.markStale()
+        except (ValueError, AttributeError):
+            snapshot.markStale()
+        if snapshot.stale:
+            self.wake.set()
+
+    def _command(self, database, databaseUrl, args, session):
+        try:
+            command = jsoncodec.loads(args["query"])
+            kind = next(iter(command))
+        except (KeyError, ValueError, TypeError, StopIteration):
+            self._staleAll(databaseUrl)
+            return
+        if kind in ("count", "distinct", "collstats", "dbstats"):
+            return
+        if kind == "transaction":
+            with self.lock:
+                if command[kind] == "enable":
+                    self.transactions.setdefault(database, {})[session] = time.monotonic()
+                elif command[kind] == "disable":
+                    self.transactions.get(database, {}).pop(session, None)
+        if kind in ("drop", "create") and isinstance(command[kind], str):
+            with self.lock:
+                self.snapshots.pop((databaseUrl, command[kind]), None)
+            return
+        self._staleAll(databaseUrl)
+
+    def _staleAll(self, databaseUrl):
+        with self.lock:
+            snapshots = [snapshot for key, snapshot in self.snapshots.items() if key[0] == databaseUrl]
+        for snapshot in snapshots:
+            snapshot.markStale()
+        self.wake.set()
+
+    def _refresh(self):
+        while not self.stopping:
+            self.wake.wait(self.refreshSeconds)
+            self.wake.clear()
+            if self.stopping:
+                return
+            due = time.time() - self.refreshSeconds
+            with self.lock:
+                snapshots = list(self.snapshots.values())
+            for snapshot in snapshots:
+                if snapshot.stale or (snapshot.loadedAt or 0) <= due:
+                    self._load(snapshot)
+
+    def _load(self, snapshot):
+        self.local.loading = True
+        try:
+            snapshot.load(self.client.newSession(), self.maxDocuments)
+            self.loads += 1
+        except QueryError as e:
+            logging.info("Snapshot of %s not loaded: %s", snapshot.name, e)
+        except Exception:
+            logging.exception("Snapshot of %s not loaded", snapshot.name)
+        finally:
+            self.local.loading = False
+
+    def stats(self):
+        with self.lock:
+            snapshots = [snapshot.toDict() for snapshot in self.snapshots.values()]
+        return {"hits": self.hits, "fallbacks": self.fallbacks, "loads": self.loads,
+                "refreshSeconds": self.refreshSeconds, "snapshots": snapshots}
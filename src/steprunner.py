@@ -0,0 +1,93 @@
+##
+# Dependency-aware runner for the steps of the sample
+##
+
+import asyncio
+
+import requests
+
+
+class Step:
+    """
+    One unit of work against the listener.
+
+    func is a coroutine function called as func(session, output); it appends
+    its result lines to output. after names the steps that must finish first.
+    """
+    def __init__(self, name, func, after=()):
+        self.name = name
+        self.func = func
+        self.after = tuple(after)
+
+
+class StepsCancelled(Exception):
+    """
+    The run was cancelled; steps that had not started were skipped
+    """
+
+
+async def runSteps(steps, session, limit=4, emit=None, cancelled=None):
+    """
+    Run steps concurrently, each as soon as the steps it depends on are done
+
+    At most limit steps run at the same time. A step may only depend on steps
+    listed before it, so the steps always form an acyclic graph. The output is
+    the output of every step concatenated in list order, no matter in which
+    order the steps finish. A step that fails with a listener error, such as
+    a timeout or an open circuit, ends with an error line in its output; the
+    other steps, including those after it, still run.
+
+    :param emit: (called with each output line as soon as it and every line
+                  before it are known, in output order)
+    :param cancelled: (called before each step starts; once it returns True,
+                       no further step starts and StepsCancelled is raised)
+    :returns: (output lines)
+    """
+    outputs = {}
+    for step in steps:
+        if step.name in outputs:
+            raise ValueError("Duplicate step " + step.name)
+        for name in step.after:
+            if name not in outputs:
+                raise ValueError("Step " + step.name + " depends on unknown or later step " + name)
+        outputs[step.name] = []
+
+    semaphore = asyncio.Semaphore(limit)
+    tasks = {}
+    finished = set()
+    emitted = [0]
+
+    def flush():
+        # Emit the output of the finished steps that no unfinished step precedes
+        while emitted[0] < len(steps) and steps[emitted[0]].name in finished:
+            for line in outputs[steps[emitted[0]].name]:
+                emit(line)
+            emitted[0] += 1
+
+    async def run(step):
+        for name in step.after:
+            await tasks[name]
+        async with semaphore:
+            if cancelled is not None and cancelled():
+                raise StepsCancelled("Cancelled before step " + step.name)
+            try:
+                await step.func(session, outputs[step.name])
+            except requests.RequestException as e:
+                outputs[step.name].append("Error: %s step stopped: %s" % (step.name, e))
+        finished.add(step.name)
+        if emit is not None:
+            flush()
+
+    for step in steps:
+        tasks[step.name] = asyncio.ensure_future(run(step))
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+
+    output = []
+    for step in steps:
+        output.extend(outputs[step.name])
+    return output
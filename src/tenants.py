@@ -0,0 +1,144 @@
+##
+# Isolated copies of the sample workload, run in parallel across databases
+#
+# Each copy is a tenant: a database url and a namespace prefixed to the names
+# of everything it creates. Copies on the same database therefore never touch
+# each other's data, and every copy has its own listener session.
+#
+#   python tenants.py --url http://host1:27018/db --url http://host2:27018/db --copies 8
+##
+
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Tenant:
+    def __init__(self, url, namespace):
+        self.url = url
+        self.namespace = namespace
+
+    def __repr__(self):
+        return "Tenant(%r, %r)" % (self.url, self.namespace)
+
+
+class TenantResult:
+    """
+    Output of one copy, or the exception that stopped it
+    """
+    def __init__(self, tenant, output, error, seconds):
+        self.tenant = tenant
+        self.output = output
+        self.error = error
+        self.seconds = seconds
+
+    @property
+    def errors(self):
+        """
+        Number of steps that reported an error
+        """
+        return sum(1 for line in self.output if line.startswith("Error:"))
+
+    @property
+    def ok(self):
+        return self.error is None and not self.errors
+
+    def toDict(self):
+        return {"url": self.tenant.url, "namespace": self.tenant.namespace, "ok": self.ok,
+                "errors": self.errors, "error": self.error, "lines": len(self.output), "seconds": self.seconds}
+
+
+def makeTenants(urls, copies, prefix=None):
+    """
+    Spread copies over urls round-robin, each with a namespace of its own
+
+    The namespaces share a random prefix, so tenants of two schedules that
+    run at the same time do not collide either.
+
+    :returns: ([Tenant])
+    """
+    if prefix is None:
+        prefix = "t" + uuid.uuid4().hex[:6] + "_"
+    return [Tenant(urls[i % len(urls)], "%s%d_" % (prefix, i)) for i in range(copies)]
+
+
+def _runTenant(run, tenant):
+    start = time.perf_counter()
+    try:
+        output = run(url=tenant.url, namespace=tenant.namespace)
+        error = None
+    except Exception as e:
+        output = []
+        error = "%s: %s" % (type(e).__name__, e)
+    return TenantResult(tenant, output, error, time.perf_counter() - start)
+
+
+def runTenants(run, tenants, workers=4, processes=False, initializer=None):
+    """
+    Call run(url=..., namespace=...) for every tenant, at most workers at a time
+
+    With processes, copies run in worker processes rather than threads; run
+    must then be a module-level function and initializer sets up each worker
+    process, e.g. its own listener client, once.
+
+    :returns: ([TenantResult] in tenant order)
+    """
+    if processes:
+        # Imported here: multiprocessing is only needed by this option
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=initializer)
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+    with pool:
+        futures = [pool.submit(_runTenant, run, tenant) for tenant in tenants]
+        return [future.result() for future in futures]
+
+
+def summarize(results, seconds):
+    """
+    :returns: (dict aggregated over all tenants)
+    """
+    perUrl = {}
+    for result in results:
+        counts = perUrl.setdefault(result.tenant.url, {"copies": 0, "failed": 0})
+        counts["copies"] += 1
+        counts["failed"] += 0 if result.ok else 1
+    durations = sorted(result.seconds for result in results)
+    return {"copies": len(results), "failed": sum(1 for result in results if not result.ok),
+            "seconds": seconds, "slowestSeconds": durations[-1] if durations else 0.0,
+            "fastestSeconds": durations[0] if durations else 0.0, "urls": perUrl}
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Run isolated copies of the sample in parallel")
+    parser.add_argument("--url", action="append", help="database url, may be repeated; default: the sample's url")
+    parser.add_argument("--copies", type=int, default=4, help="number of copies to run")
+    parser.add_argument("--workers", type=int, default=4, help="copies running at the same time")
+    parser.add_argument("--processes", action="store_true", help="run copies in processes instead of threads")
+    parser.add_argument("--verbose", action="store_true", help="print the output of every copy")
+    options = parser.parse_args()
+
+    import python_rest_HelloGalaxy as galaxy
+    tenants = makeTenants(options.url or [galaxy.getDatabaseUrl()], options.copies)
+    start = time.perf_counter()
+    results = runTenants(galaxy.doEverything, tenants, options.workers, options.processes,
+                         initializer=galaxy.ensureClient)
+    summary = summarize(results, time.perf_counter() - start)
+
+    for result in results:
+        print("%-50s %-12s %-6s %3d errors %7.2fs%s" % (
+            result.tenant.url, result.tenant.namespace, "ok" if result.ok else "FAILED", result.errors,
+            result.seconds, "  " + result.error if result.error else ""))
+        if options.verbose:
+            for line in result.output:
+                print("    " + line)
+    print("%d copies, %d failed, %.2fs wall, slowest copy %.2fs" % (
+        summary["copies"], summary["failed"], summary["seconds"], summary["slowestSeconds"]))
+    galaxy.closeClient()
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+from bulkmutate import DELETE, UPDATE, iterPartitions
+
+
+def waves(mutations, **kwargs):
+    result = {}
+    for partition in iterPartitions(mutations, **kwargs):
+        result.setdefault(partition.wave, []).append((partition.kind, partition.query))
+    return [result[wave] for wave in sorted(result)]
+
+
+def test_delete_of_a_renamed_value_runs_after_the_rename():
+    mutations = [({"name": "a"}, {"$set": {"name": "b"}}), ({"name": "b"}, None)]
+    assert waves(mutations) == [[(UPDATE, {"name": "a"})], [(DELETE, {"name": "b"})]]
+
+
+def test_rename_onto_a_value_already_matched_starts_a_wave():
+    mutations = [({"name": "b"}, None), ({"name": "a"}, {"$set": {"name": "b"}})]
+    assert waves(mutations) == [[(DELETE, {"name": "b"})], [(UPDATE, {"name": "a"})]]
+
+
+def test_updates_writing_one_value_share_a_partition():
+    mutations = [({"name": "a"}, {"$set": {"name": "z"}}), ({"name": "b"}, {"$set": {"name": "z"}}),
+                 ({"name": "c"}, None)]
+    assert waves(mutations) == [[(UPDATE, {"name": {"$in": ["a", "b"]}}), (DELETE, {"name": "c"})]]
+
+
+def test_update_of_another_field_keeps_the_wave():
+    mutations = [({"name": "a"}, {"$set": {"pop": 1}}), ({"name": "b"}, None)]
+    assert len(waves(mutations)) == 1
+
+
+def test_unknown_new_values_run_in_a_wave_of_their_own():
+    mutations = [({"name": "a"}, None), ({"name": "b"}, {"$inc": {"name": 1}}),
+                 ({"name": "c"}, {"$rename": {"title": "name"}}), ({"name": "d"}, None)]
+    assert waves(mutations) == [[(DELETE, {"name": "a"})], [(UPDATE, {"name": "b"})], [(UPDATE, {"name": "c"})],
+                                [(DELETE, {"name": "d"})]]
+
+
+def test_unordered_ignores_written_values():
+    mutations = [({"name": "a"}, {"$set": {"name": "b"}}), ({"name": "b"}, None)]
+    assert [partition.wave for partition in iterPartitions(mutations, ordered=False)] == [0, 0]
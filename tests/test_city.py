@@ -0,0 +1,31 @@
+import jsoncodec
+from bulkload import encodeDocument, iterBatches
+from city import City, CityBatch
+
+
+def test_city_is_hashable():
+    seattle = City("Seattle", 652405, 47.6097, 122.3331, 999)
+    assert len({seattle, City.fromDict(seattle.toDict())}) == 1
+
+
+def test_encode_document_matches_dict():
+    seattle = City("Zürich \"old\" town", 652405, 47.6097, 122.3331, 999)
+    assert jsoncodec.loads(encodeDocument(seattle)) == seattle.toDict()
+    assert encodeDocument({"a": 1}) == jsoncodec.dumps({"a": 1})
+
+
+def test_city_batch_round_trip():
+    cities = [City("Seattle", 652405, 47.6097, 122.3331, 999), City("London", 8308000, 51.5072, 0.1275, 44)]
+    assert list(CityBatch(cities)) == cities
+
+
+def test_city_batch_encodes_as_cities():
+    cities = [City("City %d" % i, 1000 + i, i / 8.0, -i / 4.0, i % 7) for i in range(25)]
+    batch = CityBatch(cities)
+    assert jsoncodec.loads(batch.toJSONBytes()) == [city.toDict() for city in cities]
+    assert jsoncodec.loads(batch.toJSONBytes(3, 5)) == [city.toDict() for city in cities[3:5]]
+    assert list(iterBatches(batch, 10)) == list(iterBatches(cities, 10))
+    for batchBytes in (300, 1):
+        bodies = list(iterBatches(batch, 100, batchBytes))
+        assert all(len(body) <= batchBytes or count == 1 for count, body in bodies)
+        assert [doc for count, body in bodies for doc in jsoncodec.loads(body)] == [city.toDict() for city in cities]
@@ -0,0 +1,55 @@
+import io
+
+import pytest
+
+from columnar import FLOAT, INT, TEXT, CsvWriter, GroupAggregate, iterColumnBatches
+
+
+def test_column_widened_when_a_later_batch_holds_text():
+    docs = [{"name": "a", "pop": 1}, {"name": "b", "pop": 2}, {"name": "c", "pop": "many"}, {"name": "d", "pop": 4}]
+    batches = list(iterColumnBatches(docs, batchSize=2))
+    assert batches[0].schema == [("name", TEXT), ("pop", INT)]
+    assert batches[1].schema == [("name", TEXT), ("pop", TEXT)]
+    assert list(batches[1].rows()) == [("c", "many"), ("d", 4)]
+
+    text = io.StringIO()
+    writer = CsvWriter(text, batches[0].schema)
+    for batch in batches:
+        writer.write(batch)
+    assert text.getvalue().splitlines() == ["name,pop", "a,1", "b,2", "c,many", "d,4"]
+
+
+def test_widened_column_stays_text():
+    docs = [{"pop": 1.5}, {"pop": "x"}, {"pop": 3.5}]
+    batches = list(iterColumnBatches(docs, batchSize=1))
+    assert [batch.schema for batch in batches] == [[("pop", FLOAT)], [("pop", TEXT)], [("pop", TEXT)]]
+
+
+def test_aggregate_rejects_text_values():
+    aggregate = GroupAggregate("key", "pop")
+    batches = iterColumnBatches([{"key": 1, "pop": 1}, {"key": 1, "pop": "x"}], batchSize=1)
+    aggregate.update(next(batches))
+    with pytest.raises(ValueError):
+        aggregate.update(next(batches))
+
+
+def test_parquet_rejects_a_changed_column():
+    pytest.importorskip("pyarrow")
+    from columnar import ParquetWriter, SchemaChanged
+    batches = list(iterColumnBatches([{"pop": 1}, {"pop": "x"}], batchSize=1))
+    writer = ParquetWriter(io.BytesIO(), batches[0].schema)
+    writer.write(batches[0])
+    with pytest.raises(SchemaChanged):
+        writer.write(batches[1])
+
+
+def test_aggregate_without_numpy_skips_missing_values():
+    aggregate = GroupAggregate("key", "pop")
+    aggregate.numpy = None
+    schema = [("key", TEXT), ("pop", TEXT)]
+    aggregate.update(next(iterColumnBatches([{"key": "a", "pop": 1}, {"key": "a", "pop": None},
+                                             {"key": "b", "pop": 2}], schema=schema)))
+    aggregate.update(next(iterColumnBatches([{"key": "a", "pop": 3.0}, {"key": "b"}],
+                                            schema=[("key", TEXT), ("pop", FLOAT)])))
+    assert aggregate.result() == {"a": {"count": 2, "sum": 4.0, "mean": 2.0},
+                                  "b": {"count": 1, "sum": 2, "mean": 2.0}}
@@ -0,0 +1,30 @@
+from metrics import ListenerMetrics, OTHER_TARGET
+from resultcache import ResultCache
+
+
+def test_exception_and_reply_on_one_target_render():
+    metrics = ListenerMetrics()
+    metrics.record("find", "city", 0.01, None, "exception")
+    metrics.record("find", "city", 0.01, 120, 200)
+    metrics.record("find", "city", 0.01, 120, 503)
+    text = metrics.render()
+    assert 'listener_errors_total{operation="find",target="city",status="exception"} 1' in text
+    assert 'listener_errors_total{operation="find",target="city",status="503"} 1' in text
+    assert 'listener_requests_total{operation="find",target="city"} 3' in text
+
+
+def test_target_labels_are_capped():
+    metrics = ListenerMetrics(maxTargets=2)
+    for i in range(5):
+        metrics.record("find", "collection%d" % i, 0.01, 10, 200)
+    text = metrics.render()
+    assert 'target="collection1"' in text
+    assert 'target="collection2"' not in text
+    assert 'listener_requests_total{operation="find",target="%s"} 3' % OTHER_TARGET in text
+
+
+def test_cache_counts_are_counters():
+    text = ListenerMetrics().render(cache=ResultCache(maxSize=8))
+    assert "# TYPE listener_cache_hits_total counter" in text
+    assert "# TYPE listener_cache_misses_total counter" in text
+    assert "# TYPE listener_cache_size gauge" in text
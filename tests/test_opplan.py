@@ -0,0 +1,72 @@
+import asyncio
+
+import requests
+
+import jsoncodec
+from opplan import ALL, INSERTS, Find, Insert, Transaction, mergeCalls, runPlan
+
+
+def _reply(status, value):
+    reply = requests.Response()
+    reply.status_code = status
+    reply._content = jsoncodec.dumps(value)
+    return reply
+
+
+class FakeSession:
+    """
+    Inserts at most `limit` documents per POST; every GET succeeds
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.calls = []
+
+    async def post(self, url, data=None, **kwargs):
+        count = len(jsoncodec.loads(data))
+        self.calls.append(("POST", url, count))
+        return _reply(200, {"n": count if self.limit is None else min(count, self.limit), "ok": 1})
+
+    async def get(self, url, params=None, **kwargs):
+        self.calls.append(("GET", url, params))
+        if url.endswith("/$cmd"):
+            return _reply(200, [{"ok": 1.0}])
+        return _reply(200, [{"name": "Seattle"}])
+
+
+def run(session, plan, mode=INSERTS):
+    output = []
+    errors = []
+    asyncio.run(runPlan(session, "http://listener/db", plan, output,
+                        lambda output, message, reply: errors.append(message), mode=mode))
+    return output, errors
+
+
+def test_partial_insert_is_reported():
+    output, errors = run(FakeSession(limit=2), [Insert("city", [{"a": i} for i in range(5)])])
+    assert output == ["Error: Unable to insert documents: inserted 2 of 5"]
+
+
+def test_insert_reports_listener_n():
+    output, errors = run(FakeSession(), [Insert("city", [{"a": i} for i in range(5)])])
+    assert output == ["Inserted 5 documents"]
+
+
+def test_inserts_merge_only_when_opted_in():
+    demo = [Insert("city", [{"a": 1}]), Insert("city", [{"a": 2}, {"a": 3}])]
+    assert len(mergeCalls(demo, ALL)) == 2
+    setup = [Insert("city", [{"a": 1}], merge=True), Insert("city", [{"a": 2}], merge=True)]
+    assert len(mergeCalls(setup, ALL)) == 1
+    session = FakeSession()
+    output, errors = run(session, setup)
+    assert output == ["Inserted 1 documents", "Inserted 1 documents"]
+    assert len(session.calls) == 1
+
+
+def test_query_runs_inside_transaction():
+    output, errors = run(FakeSession(), [
+        Transaction([Insert("city", [{"a": 1}])]),
+        Transaction([Insert("city", [{"a": 2}])], commit=False, then=[Find("city")]),
+    ])
+    assert [line.split(":")[0] for line in output] == [
+        "Transactions enabled", "Inserted 1 documents", "Transactions committed", "Inserted 1 documents",
+        "Transactions rolled back", "query result", "{'name'", "Transactions disabled"]
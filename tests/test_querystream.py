@@ -0,0 +1,93 @@
+import json
+
+import pytest
+import requests
+
+from batchtuner import BatchTuner
+from querystream import iterArray, iterQuery
+from restclient import RestClient
+from resultcache import ResultCache
+from snapshot import SnapshotStore, _Data
+
+DOCUMENTS = [1.5, 22.25, -3e-2, 10, 0, 1E+3, True, None, "Zürich ☃", {"population": 652405, "longitude": 47.6097},
+             [1, [2.5, {"a": "]"}]], -7]
+
+
+@pytest.mark.parametrize("separator", [", ", ",", ",\n  "])
+def test_iter_array_split_at_every_offset(separator):
+    data = ("[" + separator.join(json.dumps(doc, ensure_ascii=False) for doc in DOCUMENTS) + "]").encode("utf-8")
+    for offset in range(len(data) + 1):
+        assert list(iterArray([data[:offset], data[offset:]])) == DOCUMENTS, offset
+
+
+def test_iter_array_one_byte_chunks():
+    data = json.dumps(DOCUMENTS, ensure_ascii=False).encode("utf-8")
+    assert list(iterArray(data[i:i + 1] for i in range(len(data)))) == DOCUMENTS
+
+
+def test_iter_array_number_split_after_point():
+    assert list(iterArray([b"[1.5, 22.", b"25]"])) == [1.5, 22.25]
+
+
+def test_iter_array_single_document():
+    assert list(iterArray([b'{"n": ', b'1}'])) == [{"n": 1}]
+
+
+def test_iter_array_truncated():
+    with pytest.raises(ValueError):
+        list(iterArray([b"[1, 2"]))
+
+
+def listenerReply(docs):
+    reply = requests.Response()
+    reply.status_code = 200
+    reply._content = json.dumps(docs).encode("utf-8")
+    reply._content_consumed = True
+    return reply
+
+
+class StubSession:
+    def __init__(self, reply):
+        self.reply = reply
+
+    def get(self, url, params=None, **kwargs):
+        return self.reply
+
+
+@pytest.fixture
+def snapshotClient():
+    store = SnapshotStore({"city": []})
+    snapshot = store._snapshot(DATABASE_URL, "city")
+    snapshot.data = _Data(CITIES, [])
+    snapshot.stale = False
+    client = RestClient(snapshots=store)
+    yield client
+    client.close()
+
+
+CITIES = [{"name": "Seattle", "population": 652405}, {"name": "London", "population": 8308000}]
+DATABASE_URL = "http://listener:27017/db"
+
+
+def test_tuner_learns_from_listener_replies():
+    tuner = BatchTuner(default=2)
+    assert list(iterQuery(StubSession(listenerReply(CITIES)), DATABASE_URL + "/city", tuner=tuner)) == CITIES
+    assert len(tuner.entries) == 1
+
+
+def test_tuner_ignores_snapshot_replies(snapshotClient):
+    tuner = BatchTuner(default=2)
+    for i in range(5):
+        assert list(iterQuery(snapshotClient.newSession(), DATABASE_URL + "/city", tuner=tuner)) == CITIES
+    assert not tuner.entries
+    assert tuner.batchSize(tuner.key(DATABASE_URL + "/city")) == 2
+
+
+def test_tuner_ignores_cached_replies():
+    cache = ResultCache()
+    # Finds are not cached; any cached reply is made in this process all the same
+    plan = cache.plan("GET", DATABASE_URL + "/$cmd", {"query": '{"count": "city"}'})
+    cache.put(plan, listenerReply(CITIES), cache.version)
+    tuner = BatchTuner(default=2)
+    assert list(iterQuery(StubSession(cache.get(plan)), DATABASE_URL + "/city", tuner=tuner)) == CITIES
+    assert not tuner.entries
@@ -0,0 +1,84 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from restclient import RestClient
+
+
+class FlakyListener:
+    """
+    Replies 503 to the first call to each path, then 200
+    """
+    def __init__(self):
+        self.calls = []
+        listener = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                failed = any(path == self.path.split("?")[0] for path in
+                             (call.split("?")[0] for call in listener.calls))
+                listener.calls.append(self.path)
+                body = json.dumps({"ok": 1, "n": 1}).encode()
+                self.send_response(200 if failed else 503)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self):
+        return "http://127.0.0.1:%d/db" % self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def listener():
+    listener = FlakyListener()
+    yield listener
+    listener.stop()
+
+
+def test_cmd_insert_is_not_sent_twice(listener):
+    client = RestClient(retries=3, backoffFactor=0)
+    command = {"insert": "city", "documents": [{"name": "Seattle"}]}
+    reply = client.request("GET", listener.url() + "/$cmd", params={"query": json.dumps(command)})
+    assert reply.status_code == 503
+    assert len(listener.calls) == 1
+    client.close()
+
+
+def test_find_is_retried(listener):
+    client = RestClient(retries=3, backoffFactor=0)
+    reply = client.request("GET", listener.url() + "/city", params={"query": "{}"})
+    assert reply.status_code == 200
+    assert len(listener.calls) == 2
+    client.close()
+
+
+def test_concurrent_calls_share_one_listener_session():
+    import asyncio
+    from fakelistener import FakeListener
+    from restclient import AsyncListenerSession
+
+    fake = FakeListener(latency=0.01).start()
+    client = RestClient()
+    session = AsyncListenerSession(client.newSession())
+
+    async def run():
+        return await asyncio.gather(*[session.get(fake.url()) for _ in range(4)])
+
+    replies = asyncio.run(run())
+    assert [reply.status_code for reply in replies] == [200] * 4
+    assert next(fake.sessions) - 1 == 1
+    client.close()
+    fake.stop()
@@ -0,0 +1,68 @@
+import pytest
+
+import python_rest_HelloGalaxy as galaxy
+
+
+@pytest.fixture
+def app():
+    return galaxy.app.test_client()
+
+
+@pytest.mark.parametrize("args", ["query=notjson", "sort={", "fields=[1", "batchsize=abc", "batchsize=0"])
+def test_query_rejects_malformed_parameters(app, args):
+    reply = app.get("/query/city?" + args)
+    assert reply.status_code == 400
+    assert "error" in reply.get_json()
+
+
+@pytest.mark.parametrize("args", ["since=abc", "since=-1", "wait=abc", "wait=-5", "wait=nan"])
+def test_poll_job_rejects_malformed_parameters(app, args):
+    job = galaxy.jobs.submit(lambda emit=None, cancelled=None: [])
+    reply = app.get("/jobs/%s?%s" % (job.id, args))
+    assert reply.status_code == 400
+    assert "error" in reply.get_json()
+
+
+def test_poll_job_accepts_numbers(app):
+    job = galaxy.jobs.submit(lambda emit=None, cancelled=None: [])
+    reply = app.get("/jobs/%s?since=0&wait=0.5" % job.id)
+    assert reply.status_code == 200
+
+
+@pytest.mark.parametrize("copies", ["abc", "0", "-2", "1.5"])
+def test_tenant_test_rejects_malformed_copies(app, copies):
+    reply = app.get("/tenanttest?copies=" + copies)
+    assert reply.status_code == 400
+    assert "error" in reply.get_json()
+
+
+def test_ensure_client_keeps_this_process_client():
+    client = galaxy.client
+    galaxy.ensureClient()
+    assert galaxy.client is client
+
+
+@pytest.mark.parametrize("path", ["/export/city?query=notjson", "/export/city?format=parquet&sort={",
+                                  "/aggregate/city?by=name&field=pop&fields=[1"])
+def test_columns_reject_malformed_parameters(app, path):
+    reply = app.get(path)
+    assert reply.status_code == 400
+    assert "error" in reply.get_json()
+
+
+@pytest.mark.parametrize("args", ["field=population", "by=countryCode", "by=&field=population",
+                                  "by=nope&field=population", "by=countryCode&field=nope"])
+def test_aggregate_rejects_unknown_fields(app, monkeypatch, args):
+    docs = [{"countryCode": 1, "population": 10}, {"countryCode": 2, "population": 20}]
+    monkeypatch.setattr(galaxy, "columnBatches", lambda name: galaxy.iterColumnBatches(docs))
+    reply = app.get("/aggregate/city?" + args)
+    assert reply.status_code == 400
+    assert "error" in reply.get_json()
+
+
+def test_export_parquet_without_pyarrow(app, monkeypatch):
+    monkeypatch.setattr(galaxy, "parquetAvailable", lambda: False)
+    monkeypatch.setattr(galaxy, "columnBatches", lambda name: galaxy.iterColumnBatches([{"population": 10}]))
+    reply = app.get("/export/city?format=parquet")
+    assert reply.status_code == 501
+    assert "pyarrow" in reply.get_json()["error"]
@@ -0,0 +1,61 @@
+import requests
+
+import jsoncodec
+from snapshot import SnapshotStore
+
+DATABASE_URL = "http://listener:27017/db"
+
+
+def reply(value, cookies=None):
+    result = requests.Response()
+    result.status_code = 200
+    result._content = jsoncodec.dumps(value)
+    for name, value in (cookies or {}).items():
+        result.cookies.set(name, value)
+    return result
+
+
+def transaction(store, action, session):
+    store.written("GET", DATABASE_URL + "/$cmd", {"query": jsoncodec.dumpsText({"transaction": action})}, None,
+                  reply({"ok": 1}), {"session": session})
+
+
+def suppressed(store):
+    return store._inTransaction("listener:27017/db")
+
+
+def test_transaction_held_per_session():
+    store = SnapshotStore({"city": []})
+    transaction(store, "enable", "1")
+    transaction(store, "enable", "1")
+    transaction(store, "enable", "2")
+    transaction(store, "disable", "1")
+    assert suppressed(store)
+    transaction(store, "disable", "2")
+    assert not suppressed(store)
+
+
+def test_transaction_never_disabled_expires():
+    store = SnapshotStore({"city": []}, transactionSeconds=0)
+    transaction(store, "enable", "1")
+    assert not suppressed(store)
+    assert store.transactions["listener:27017/db"] == {}
+
+
+def test_first_call_of_a_session_uses_the_cookie_it_was_given():
+    store = SnapshotStore({"city": []})
+    store.written("GET", DATABASE_URL + "/$cmd", {"query": '{"transaction": "enable"}'}, None,
+                  reply({"ok": 1}, {"session": "7"}), None)
+    transaction(store, "disable", "7")
+    assert not suppressed(store)
+
+
+def test_refresh_starts_with_the_first_snapshot():
+    store = SnapshotStore({"city": []}, refreshSeconds=3600)
+    store.start(object())
+    assert store.thread is None
+    store._snapshot(DATABASE_URL, "city")
+    try:
+        assert store.thread.is_alive()
+    finally:
+        store.stop()
@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+import requests
+
+from resilience import CircuitBreaker
+from steprunner import Step, runSteps
+
+
+def test_listener_error_fails_only_its_step():
+    async def setup(session, output):
+        output.append("setup")
+
+    async def slow(session, output):
+        output.append("slow started")
+        raise requests.Timeout("read timed out")
+
+    async def broken(session, output):
+        breaker = CircuitBreaker(failures=1)
+        breaker.failure(breaker.acquire("http://listener:27017/db", "find"), "refused")
+        breaker.acquire("http://listener:27017/db", "find")
+
+    async def last(session, output):
+        output.append("last")
+
+    steps = [Step("setup", setup), Step("slow", slow, after=["setup"]), Step("broken", broken),
+             Step("last", last, after=["slow", "broken"])]
+    emitted = []
+    output = asyncio.run(runSteps(steps, None, emit=emitted.append))
+    assert output[:3] == ["setup", "slow started", "Error: slow step stopped: read timed out"]
+    assert output[3].startswith("Error: broken step stopped: Circuit open for find calls")
+    assert output[4:] == ["last"]
+    assert emitted == output
+
+
+def test_other_errors_end_the_run():
+    async def failing(session, output):
+        raise KeyError("bug")
+
+    with pytest.raises(KeyError):
+        asyncio.run(runSteps([Step("failing", failing)], None))